@@ -35,3 +35,9 @@ def createShortcutBar(uiMapFiles=[], customEventTypes=[]):
 def applicationEventRemove(*args, **kwargs):
     if scriptEngine:
         scriptEngine.applicationEventRemove(*args, **kwargs)
+
+def addSessionResetHook(method):
+    # Called on the replay thread between usecases replayed in the same session, see --replay-session.
+    # Should return the application to the state it starts in
+    if scriptEngine:
+        scriptEngine.addSessionResetHook(method)
@@ -0,0 +1,232 @@
+
+""" Replays many usecases against the same program, several at a time. Starting StoryText for each
+one means importing the toolkit and reading the shortcuts and UI map files every time, which for
+console and Tkinter programs is often most of the time taken. So where processes can be forked, these
+are loaded once and each usecase runs in a process forked from that. Elsewhere (Windows, Jython)
+each usecase runs in a new process as it would from the command line. Each usecase runs in its own
+directory, where its standard output and standard error are also written """
+
+import cmdline, definitions
+from gridformatter import GridFormatterWithHeader
+from filepolling import poll_file
+import os, sys, optparse, subprocess, time, traceback
+
+def create_option_parser():
+    usage = """usage: %prog [options] -- [storytext options] <program> <program_args> ...
+
+Replays each of the given usecase files against the program, several at a time, as if by
+'storytext -p <usecase> [storytext options] <program> <program_args>'. Each one is run in a
+subdirectory of the output directory, named after the usecase file, which will contain the files
+'stdout' and 'stderr'. A table of how long each took is printed at the end.
+Mostly useful for console and Tkinter programs, where starting StoryText is relatively costly."""
+    parser = optparse.OptionParser(usage, version="%prog " + definitions.__version__)
+    parser.disable_interspersed_args() # the rest are for storytext
+    parser.add_option("-j", "--jobs", metavar="COUNT", type="int", default=2,
+                      help="number of usecases to run at the same time (default 2)")
+    parser.add_option("-o", "--output-dir", metavar="DIR", default="storytext_batch",
+                      help="directory to run the usecases in (default 'storytext_batch' under the current directory)")
+    parser.add_option("-u", "--usecases", metavar="FILE1,...",
+                      help="usecase files to replay. Anything not given here that follows the options is also taken as usecase files, up to '--'")
+    parser.add_option("-x", "--no-fork", action="store_true", default=False,
+                      help="start each usecase in a new process, even where they could be forked from a process that has already loaded everything")
+    return parser
+
+def canFork():
+    return hasattr(os, "fork")
+
+def splitArguments(args):
+    # Usecase files, then storytext's arguments after "--"
+    if "--" in args:
+        index = args.index("--")
+        return args[:index], args[index + 1:]
+    else:
+        return [], args
+
+def parseStoryTextArguments(storytextArgs):
+    options, args = cmdline.create_option_parser().parse_args(storytextArgs)
+    if not args:
+        raise definitions.UseCaseScriptError, "ERROR: no program given to replay the usecases against"
+    if options.replay or options.record or options.replay_session:
+        raise definitions.UseCaseScriptError, "ERROR: cannot replay or record given scripts with the batch runner, give the usecases to it instead"
+    # Each usecase runs in its own directory
+    args[0] = os.path.abspath(args[0])
+    if options.mapfiles:
+        options.mapfiles = ",".join((os.path.abspath(f) for f in options.mapfiles.split(",")))
+    if options.logconfigfile:
+        options.logconfigfile = os.path.abspath(options.logconfigfile)
+    return options, args
+
+def preload(options):
+    # Everything here is inherited by the forked processes
+    import scriptengine
+    scriptengine.ScriptEngine.getShortcuts()
+    if options.interface != "console":
+        exec "import storytext." + options.interface + "toolkit"
+        import guishared
+        # Reading them only helps if the UI map cache keeps what was read, see uimapcache.py
+        if guishared.UIMapCache.create():
+            guishared.UIMapFileHandler(options.mapfiles.split(","))
+
+def runUsecase(installRoot, usecaseFile, outputDir, options, args):
+    # Runs in the process for the usecase, returns its exit code
+    os.environ["USECASE_REPLAY_SCRIPT"] = usecaseFile
+    cmdline.set_up_environment(options)
+    os.chdir(outputDir)
+    for fd, fileName in [ (1, "stdout"), (2, "stderr") ]:
+        f = open(fileName, "w")
+        os.dup2(f.fileno(), fd)
+        f.close()
+    try:
+        import storytext
+        storytext.scriptEngine = cmdline.create_script_engine(options, installRoot)
+        if options.pollfile:
+            # Relative to the usecase's directory, like the program's own files
+            poll_file(options.pollfile, options.pollfile_event_name, storytext.scriptEngine.applicationEvent)
+        storytext.scriptEngine.run(options, args)
+        return 0
+    except definitions.UseCaseScriptError, e:
+        sys.stderr.write(str(e) + "\n")
+    except Exception:
+        traceback.print_exc()
+    return 1
+
+def runInChild(argv):
+    # Entry point for the process started by UsecaseRun when not forking
+    installRoot, usecaseFile, outputDir = argv[:3]
+    options, args = parseStoryTextArguments(argv[3:])
+    sys.exit(runUsecase(installRoot, usecaseFile, outputDir, options, args))
+
+
+# One usecase running in its own process
+class UsecaseRun:
+    def __init__(self, usecaseFile, outputDir):
+        self.usecaseFile = usecaseFile
+        self.outputDir = outputDir
+        self.process = None
+        self.pid = None
+        self.startTime = None
+        self.wallTime = None
+        self.exitCode = None
+
+    def fork(self, installRoot, options, args):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.startTime = time.time()
+        self.pid = os.fork()
+        if self.pid == 0:
+            # Exit normally rather than with os._exit, so that the program's threads are waited for
+            # and exit handlers (e.g. writing replay traces) are run. Nothing above us catches this.
+            sys.exit(runUsecase(installRoot, self.usecaseFile, self.outputDir, options, args))
+
+    def start(self, installRoot, storytextArgs):
+        libDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = "import sys; sys.path.insert(0, " + repr(libDir) + "); " + \
+               "from storytext.batch import runInChild; runInChild(sys.argv[1:])"
+        self.startTime = time.time()
+        self.process = subprocess.Popen([ sys.executable, "-c", code, installRoot, self.usecaseFile, self.outputDir ] + storytextArgs)
+
+    def poll(self):
+        if self.process:
+            exitCode = self.process.poll()
+        else:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == 0:
+                return False
+            exitCode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if exitCode is None:
+            return False
+        self.wallTime = time.time() - self.startTime
+        self.exitCode = exitCode
+        return True
+
+
+class BatchRunner:
+    pollInterval = 0.01
+    def __init__(self, installRoot, usecaseFiles, outputDir, jobs, storytextArgs, fork):
+        self.installRoot = installRoot
+        self.storytextArgs = storytextArgs
+        self.options, self.args = parseStoryTextArguments(storytextArgs)
+        self.jobs = max(1, jobs)
+        self.fork = fork
+        self.runs = self.makeRuns(usecaseFiles, outputDir)
+        self.wallTime = None
+
+    def makeRuns(self, usecaseFiles, outputDir):
+        runs = []
+        dirNames = set()
+        for usecaseFile in usecaseFiles:
+            if not os.path.isfile(usecaseFile):
+                raise definitions.UseCaseScriptError, "ERROR: no usecase file at " + repr(usecaseFile)
+            dirName = os.path.splitext(os.path.basename(usecaseFile))[0]
+            count = 2
+            while dirName in dirNames:
+                dirName = os.path.splitext(os.path.basename(usecaseFile))[0] + "_" + str(count)
+                count += 1
+            dirNames.add(dirName)
+            runDir = os.path.abspath(os.path.join(outputDir, dirName))
+            if not os.path.isdir(runDir):
+                os.makedirs(runDir)
+            runs.append(UsecaseRun(os.path.abspath(usecaseFile), runDir))
+        return runs
+
+    def startRun(self, run):
+        if self.fork:
+            run.fork(self.installRoot, self.options, self.args)
+        else:
+            run.start(self.installRoot, self.storytextArgs)
+
+    def run(self):
+        if self.fork:
+            preload(self.options)
+        startTime = time.time()
+        waiting = list(self.runs)
+        running = []
+        while waiting or running:
+            while waiting and len(running) < self.jobs:
+                run = waiting.pop(0)
+                self.startRun(run)
+                running.append(run)
+            finished = [ run for run in running if run.poll() ]
+            for run in finished:
+                running.remove(run)
+            if not finished:
+                time.sleep(self.pollInterval)
+        self.wallTime = time.time() - startTime
+
+    def getReport(self):
+        headerRow = [ "Usecase", "Exit code", "Time (s)" ]
+        rows = [ [ run.usecaseFile, str(run.exitCode), "%.3f" % run.wallTime ] for run in self.runs ]
+        totalTime = sum((run.wallTime for run in self.runs))
+        text = GridFormatterWithHeader([ headerRow ], rows, len(headerRow)).__str__()
+        text += "Ran " + str(len(self.runs)) + " usecases in " + ("%.3f" % self.wallTime) + " seconds, " + \
+                str(self.jobs) + " at a time, " + ("%.2f" % (len(self.runs) / max(self.wallTime, 0.001))) + " per second. " + \
+                "One after the other they took " + ("%.3f" % totalTime) + " seconds.\n"
+        return text
+
+    def getFailures(self):
+        return [ run for run in self.runs if run.exitCode != 0 ]
+
+
+def main(installRoot):
+    parser = create_option_parser()
+    options, args = parser.parse_args()
+    usecaseFiles, storytextArgs = splitArguments(args)
+    if options.usecases:
+        usecaseFiles = options.usecases.split(",") + usecaseFiles
+    if not usecaseFiles:
+        parser.print_help()
+        return
+
+    try:
+        runner = BatchRunner(installRoot, usecaseFiles, options.output_dir, options.jobs, storytextArgs,
+                             canFork() and not options.no_fork)
+        runner.run()
+    except definitions.UseCaseScriptError, e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(2)
+
+    sys.stdout.write(runner.getReport())
+    failures = runner.getFailures()
+    if failures:
+        sys.stderr.write("Failed: " + ", ".join((run.usecaseFile for run in failures)) + "\n")
+        sys.exit(1)
@@ -0,0 +1,3 @@
+
+""" Benchmarks of StoryText's core algorithms, run on synthetic data so no GUI toolkit is needed.
+See bin/storytext_benchmark, or runner.py for the options """
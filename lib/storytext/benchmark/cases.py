@@ -0,0 +1,420 @@
+
+""" The benchmarks themselves. Each one generates its input in setUp, which is not timed,
+and then exercises one of StoryText's hot paths in run, which is """
+
+from storytext import replayer, recorder, guishared, filepolling, definitions
+from storytext.registries import WidgetRegistry
+from storytext.gridformatter import GridFormatter
+import synthetic
+import os
+from threading import Event
+
+class Benchmark:
+    name = None
+    def __init__(self, scale, workDir):
+        self.scale = scale
+        self.workDir = workDir
+
+    def scaled(self, count):
+        return max(1, int(count * self.scale))
+
+    def setUp(self):
+        pass
+
+    def getSizes(self):
+        return {}
+
+
+# The cost per command should stay the same however many events there are, so there is one for each size
+class FindCommandName(Benchmark):
+    name = "replayer.findCommandName.100"
+    eventCount = 100
+    def setUp(self):
+        eventNames = synthetic.makeEventNames(self.eventCount)
+        self.replayer = replayer.UseCaseReplayer(None)
+        for eventName in eventNames:
+            self.replayer.addEvent(None, [ eventName ])
+        self.commands = synthetic.makeScriptCommands(eventNames, self.scaled(20000))
+
+    def run(self):
+        for command in self.commands:
+            self.replayer.findCommandName(command)
+
+    def getSizes(self):
+        return { "events" : len(self.replayer.events), "commands" : len(self.commands) }
+
+
+class FindCommandName1k(FindCommandName):
+    name = "replayer.findCommandName.1k"
+    eventCount = 1000
+
+
+class FindCommandName10k(FindCommandName):
+    name = "replayer.findCommandName.10k"
+    eventCount = 10000
+
+
+class FindCommandName100k(FindCommandName):
+    name = "replayer.findCommandName.100k"
+    eventCount = 100000
+
+
+class FindShortcut(Benchmark):
+    name = "shortcuts.findShortcut"
+    def setUp(self):
+        fileNames, shortcutCommands = synthetic.makeShortcutFiles(self.workDir, self.scaled(1000))
+        self.shortcutManager = replayer.ShortcutManager()
+        for fileName in fileNames:
+            self.shortcutManager.add(replayer.ReplayScript(fileName))
+        # Half of them won't match anything, as for most recorded commands
+        otherCommands = synthetic.makeScriptCommands(synthetic.makeEventNames(100), len(shortcutCommands))
+        self.commands = [ c for pair in zip(shortcutCommands, otherCommands) for c in pair ] * 3
+
+    def run(self):
+        for command in self.commands:
+            self.shortcutManager.findShortcut(command)
+
+    def getSizes(self):
+        return { "shortcuts" : len(self.shortcutManager.shortcuts), "commands" : len(self.commands) }
+
+
+class SplitWaitLineForShortcut(Benchmark):
+    name = "recorder.findPossibleSplits"
+    eventCounts = [ 10, 20, 30 ]
+    def setUp(self):
+        # Shortcuts which end by waiting for some of the events on the recorded lines
+        generator = synthetic.makeGenerator(49)
+        self.lines = []
+        shortcuts = []
+        for eventCount in self.eventCounts:
+            for line in synthetic.makeWaitLines(self.scaled(20), eventCount, seed=eventCount):
+                events = replayer.parseWaitCommand(line)
+                waitCommand = self.makeWaitCommand(generator.sample(events, 3))
+                fileName = os.path.join(self.workDir, "shortcut_" + str(len(shortcuts)) + ".usecase")
+                f = open(fileName, "w")
+                f.write("start jobs\n" + waitCommand + "\n")
+                f.close()
+                shortcuts.append(replayer.ReplayScript(fileName))
+                self.lines.append(line)
+        self.recordScript = recorder.RecordScript(os.path.join(self.workDir, "recorded.usecase"), shortcuts)
+        self.recordScript.record("start jobs")
+
+    def makeWaitCommand(self, events):
+        return replayer.assembleWaitCommand(events)
+
+    def run(self):
+        for line in self.lines:
+            eventPairs = self.recordScript.findPossibleSplits(line)
+            self.recordScript.findPartLineCompleting(eventPairs)
+
+    def getSizes(self):
+        return { "lines" : len(self.lines), "eventsPerLine" : self.eventCounts }
+
+
+class SplitWaitLineForDottedShortcut(SplitWaitLineForShortcut):
+    name = "recorder.findPossibleSplits.dotted"
+    def makeWaitCommand(self, events):
+        # As for widget names with a '.' in, which matches any character in shortcuts
+        return replayer.assembleWaitCommand([ (baseEvent.replace(" finished", ".finished"), count) for baseEvent, count in events ])
+
+
+class UIMapBenchmark(Benchmark):
+    sectionCount = 10000
+    def setUp(self):
+        self.uiMapFile = os.path.join(self.workDir, "ui_map.conf")
+        self.eventNames = synthetic.makeEventNames(self.scaled(self.sectionCount))
+        synthetic.makeUIMapFile(self.uiMapFile, self.scaled(self.sectionCount), self.eventNames)
+        self.setCacheDir("")
+
+    def setCacheDir(self, cacheDir):
+        os.environ["STORYTEXT_UIMAP_CACHE"] = cacheDir
+
+    def getSizes(self):
+        return { "sections" : self.scaled(self.sectionCount) }
+
+
+class UIMapParse(UIMapBenchmark):
+    name = "uimap.parse"
+    def run(self):
+        guishared.UIMapFileHandler([ self.uiMapFile ])
+
+
+class UIMapParseCached(UIMapBenchmark):
+    name = "uimap.parseCached"
+    def setUp(self):
+        UIMapBenchmark.setUp(self)
+        self.setCacheDir(os.path.join(self.workDir, "cache"))
+        guishared.UIMapFileHandler([ self.uiMapFile ])
+
+    def run(self):
+        guishared.UIMapFileHandler([ self.uiMapFile ])
+
+
+class UIMapCommandLookup(UIMapBenchmark):
+    name = "uimap.findSectionsAndOptions"
+    def setUp(self):
+        UIMapBenchmark.setUp(self)
+        self.fileHandler = guishared.UIMapFileHandler([ self.uiMapFile ])
+        self.commands = synthetic.makeScriptCommands(self.eventNames, self.scaled(2000))
+
+    def run(self):
+        for command in self.commands:
+            self.fileHandler.findSectionsAndOptions(command)
+            self.fileHandler.splitOptionValue(command)
+
+    def getSizes(self):
+        sizes = UIMapBenchmark.getSizes(self)
+        sizes["commands"] = len(self.commands)
+        return sizes
+
+
+class UIMapWidgetBenchmark(UIMapBenchmark):
+    widgetCount = 20000
+    def setUp(self):
+        UIMapBenchmark.setUp(self)
+        self.uiMap = guishared.UIMap(None, [ self.uiMapFile ])
+        self.widgets = [ synthetic.SyntheticWidgetAdapter(i) for i in range(self.scaled(self.widgetCount)) ]
+
+    def getSizes(self):
+        sizes = UIMapBenchmark.getSizes(self)
+        sizes["widgets"] = len(self.widgets)
+        return sizes
+
+
+class UIMapRename(UIMapBenchmark):
+    name = "uimap.rename.immediate"
+    renameCount = 20
+    deferWrites = False
+    def setUp(self):
+        UIMapBenchmark.setUp(self)
+        self.fileHandler = guishared.UIMapFileHandler([ self.uiMapFile ])
+        if self.deferWrites:
+            self.fileHandler.deferWrites()
+        # As when renaming a usecase in the editor, which changes every entry with that name
+        sections = synthetic.makeGenerator(54).sample(self.fileHandler.sections(), self.renameCount)
+        self.entries = [ (section, self.fileHandler.options(section)[0]) for section in sections ]
+        self.runCount = 0
+
+    def run(self):
+        self.runCount += 1
+        for section, option in self.entries:
+            self.fileHandler.updateOptionValue(section, option, "renamed " + str(self.runCount) + " " + section)
+        self.fileHandler.write()
+
+    def getSizes(self):
+        sizes = UIMapBenchmark.getSizes(self)
+        sizes["renames"] = len(self.entries)
+        sizes["bytesWrittenPerRun"] = self.fileHandler.getBytesWritten() / max(self.runCount, 1)
+        return sizes
+
+
+class UIMapRenameDeferred(UIMapRename):
+    name = "uimap.rename.deferred"
+    deferWrites = True
+
+
+class UIMapIdCombinations(UIMapWidgetBenchmark):
+    name = "uimap.allUIMapIdCombinations"
+    widgetCount = 5000
+    def run(self):
+        for widget in self.widgets:
+            list(self.uiMap.allUIMapIdCombinations(widget))
+
+
+class UIMapFindSections(UIMapWidgetBenchmark):
+    name = "uimap.findSections"
+    def run(self):
+        for widget in self.widgets:
+            self.uiMap.findSections(widget)
+
+
+class UIMapMonitor(UIMapWidgetBenchmark):
+    name = "uimap.monitor.eager"
+    lazyInstrumentation = False
+    def setUp(self):
+        UIMapWidgetBenchmark.setUp(self)
+        self.uiMap.lazyInstrumentation = self.lazyInstrumentation
+        # A usecase referring to a few of the events, as most do
+        self.usecaseFile = os.path.join(self.workDir, "usecase")
+        synthetic.makeUsecaseFile(self.usecaseFile, synthetic.makeGenerator(53).sample(self.eventNames, 50), 200)
+
+    def run(self):
+        self.uiMap.scriptEngine = synthetic.SyntheticReplayScriptEngine(self.usecaseFile)
+        for widget in self.widgets:
+            self.uiMap.monitorWidget(widget)
+
+    def getSizes(self):
+        sizes = UIMapWidgetBenchmark.getSizes(self)
+        sizes["eventsCreated"] = sum(map(len, self.uiMap.scriptEngine.replayer.events.values()))
+        return sizes
+
+
+class UIMapMonitorLazy(UIMapMonitor):
+    name = "uimap.monitor.lazy"
+    lazyInstrumentation = True
+
+
+class GridFormatterLayout(Benchmark):
+    name = "gridformatter.format"
+    def setUp(self):
+        self.grids = [ synthetic.makeGrid(30, 6, seed=i) for i in range(self.scaled(200)) ]
+
+    def run(self):
+        for grid in self.grids:
+            str(GridFormatter(grid, 6, maxWidth=130))
+
+    def getSizes(self):
+        return { "grids" : len(self.grids), "rows" : 30, "columns" : 6 }
+
+
+class DescriberFormatting(Benchmark):
+    name = "describer.getDescription"
+    def setUp(self):
+        self.window, self.widgets = synthetic.makeWidgetTree(self.scaled(5000))
+        self.describer = synthetic.SyntheticDescriber()
+
+    def run(self):
+        self.describer.getDescription(self.window)
+
+    def getSizes(self):
+        return { "widgets" : len(self.widgets) }
+
+
+class InstrumentAndDescribe(Benchmark):
+    name = "dispatch.instrumentAndDescribe"
+    def setUp(self):
+        _, self.widgets = synthetic.makeWidgetTree(self.scaled(50000))
+        self.adapters = synthetic.makeWidgetAdapters(self.widgets)
+
+    def run(self):
+        # Each widget on its own, laying out the whole window would take far longer than finding how to describe them
+        scriptEngine = synthetic.SyntheticScriptEngine()
+        describer = synthetic.SyntheticToolkitDescriber()
+        for adapter in self.adapters:
+            scriptEngine.findEventClassesFor(adapter)
+        for widget in self.widgets:
+            describer.getWidgetDescription(widget)
+
+    def getSizes(self):
+        return { "widgets" : len(self.widgets) }
+
+
+class DescriberStateChanges(Benchmark):
+    name = "describer.findStateChanges.poll"
+    stateChangeMode = "poll"
+    stepCount = 10
+    def setUp(self):
+        self.window, self.widgets = synthetic.makeWidgetTree(self.scaled(20000))
+        self.describer = synthetic.SyntheticDescriber()
+        self.describer.stateChangeMode = self.stateChangeMode
+        self.describer.getDescription(self.window)
+        self.describer.findStateChanges()
+        # Each step changes 1% of the text entries, which is a lot for one action
+        entries = [ widget for widget in self.widgets if isinstance(widget, synthetic.SyntheticEntry) ]
+        self.changingEntries = synthetic.makeGenerator(50).sample(entries, max(1, len(entries) / 100))
+        self.runCount = 0
+
+    def run(self):
+        self.runCount += 1
+        for step in range(self.stepCount):
+            for entry in self.changingEntries:
+                entry.setText("changed " + str(self.runCount) + " " + str(step))
+            self.describer.findStateChanges()
+
+    def getSizes(self):
+        return { "widgetsWithState" : len(self.describer.widgetsWithState), "changedPerStep" : len(self.changingEntries),
+                 "steps" : self.stepCount }
+
+
+class DescriberStateChangesDirty(DescriberStateChanges):
+    name = "describer.findStateChanges.dirty"
+    stateChangeMode = "dirty"
+
+
+class RegistryChurn(Benchmark):
+    name = "registries.churn"
+    windowCount = 20
+    def setUp(self):
+        self.describer = synthetic.SyntheticDescriber()
+
+    def run(self):
+        # Windows keep appearing and being disposed, as in long-running usecases
+        for _ in range(self.windowCount):
+            window, widgets = synthetic.makeWidgetTree(self.scaled(2000))
+            self.describer.getDescription(window)
+            self.describer.findStateChanges()
+            for widget in widgets:
+                WidgetRegistry.forgetWidget(widget)
+
+    def getSizes(self):
+        return { "windows" : self.windowCount, "widgetsPerWindow" : self.scaled(2000),
+                 "widgetsWithStateAtEnd" : len(self.describer.widgetsWithState) }
+
+
+class WidgetCounterNumbering(Benchmark):
+    name = "widgetcounter.getId"
+    def setUp(self):
+        self.describer = synthetic.SyntheticDescriber()
+        self.images = synthetic.makeImages(self.scaled(10000))
+        # Each is then described again, as the same object and as another one with the same data
+        self.imagesAgain = self.images + [ synthetic.SyntheticImage(image.data) for image in self.images ]
+
+    def run(self):
+        counter = guishared.WidgetCounter(self.describer.imagesEqual, self.describer.imagesHash)
+        for image in self.images:
+            counter.getId(image)
+        for image in self.imagesAgain:
+            counter.getWidgetNumber(image)
+
+    def getSizes(self):
+        return { "images" : len(self.images), "lookups" : len(self.images) + len(self.imagesAgain) }
+
+
+# The runner also reports the CPU time used, i.e. how much watching the files costs
+class FilePollingLatency(Benchmark):
+    name = "filepolling.latency.1"
+    fileCount = 1
+    timeout = 10
+    def setUp(self):
+        self.runCount = 0
+
+    def run(self):
+        # Time from the files appearing to the watcher noticing them all
+        self.runCount += 1
+        fileNames = [ os.path.join(self.workDir, "poll" + str(self.runCount) + "_" + str(i)) for i in range(self.fileCount) ]
+        self.remaining = len(fileNames)
+        self.allSeen = Event()
+        for fileName in fileNames:
+            filepolling.poll_file(fileName, None, self.fileSeen)
+        for fileName in fileNames:
+            open(fileName, "w").close()
+        self.allSeen.wait(self.timeout)
+        if not self.allSeen.isSet():
+            raise definitions.UseCaseScriptError, "ERROR: the file watcher only noticed " + str(len(fileNames) - self.remaining) + \
+                " of " + str(len(fileNames)) + " files within " + str(self.timeout) + " seconds"
+
+    def fileSeen(self, *args, **kw):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.allSeen.set()
+
+    def getSizes(self):
+        return { "files" : self.fileCount }
+
+
+class FilePollingLatency10(FilePollingLatency):
+    name = "filepolling.latency.10"
+    fileCount = 10
+
+
+class FilePollingLatency100(FilePollingLatency):
+    name = "filepolling.latency.100"
+    fileCount = 100
+
+
+allBenchmarks = [ FindCommandName, FindCommandName1k, FindCommandName10k, FindCommandName100k, FindShortcut,
+                  SplitWaitLineForShortcut, SplitWaitLineForDottedShortcut, UIMapParse, UIMapParseCached, UIMapCommandLookup,
+                  UIMapRename, UIMapRenameDeferred, UIMapIdCombinations, UIMapFindSections, UIMapMonitor, UIMapMonitorLazy,
+                  GridFormatterLayout, DescriberFormatting, InstrumentAndDescribe,
+                  DescriberStateChanges, DescriberStateChangesDirty, RegistryChurn, WidgetCounterNumbering,
+                  FilePollingLatency, FilePollingLatency10, FilePollingLatency100 ]
@@ -0,0 +1,195 @@
+
+""" Runs the benchmarks, each in its own process so that peak memory can be measured separately,
+and writes the results as JSON. Can also compare them with stored results from an earlier run """
+
+from storytext import definitions
+from storytext.gridformatter import GridFormatterWithHeader
+from cases import allBenchmarks
+import os, sys, optparse, subprocess, tempfile, shutil, timeit, time
+
+try:
+    import json
+except ImportError: # pragma: no cover - Python 2.5
+    import simplejson as json
+
+def create_option_parser():
+    usage = """usage: %prog [options]
+
+Runs StoryText's benchmarks of its core algorithms on synthetic data, which needs no GUI toolkit.
+Results are written as JSON, and can be compared with those from an earlier run to find regressions."""
+    parser = optparse.OptionParser(usage, version="%prog " + definitions.__version__)
+    parser.add_option("-b", "--benchmarks", metavar="NAMES",
+                      help="comma-separated names of benchmarks to run, or their prefixes up to a '.'. Default is to run all of them")
+    parser.add_option("-c", "--compare", metavar="FILENAME",
+                      help="compare results with those stored in FILENAME, and exit with status 1 if any got worse")
+    parser.add_option("-l", "--list", action="store_true", default=False,
+                      help="list the available benchmarks and exit")
+    parser.add_option("-o", "--output", metavar="FILENAME",
+                      help="write the results to FILENAME rather than standard output")
+    parser.add_option("-p", "--in-process", action="store_true", default=False,
+                      help="run all benchmarks in this process. Quicker, but peak memory cannot be measured")
+    parser.add_option("-r", "--repeat", metavar="COUNT", type="int", default=3,
+                      help="number of times to run each benchmark, the fastest time is reported (default 3)")
+    parser.add_option("-s", "--scale", metavar="FACTOR", type="float", default=1.0,
+                      help="multiply the size of all the generated input by FACTOR (default 1.0)")
+    parser.add_option("-t", "--tolerance", metavar="PERCENT", type="float", default=20.0,
+                      help="with --compare, how many percent slower or larger a result can be before it counts as a regression (default 20)")
+    return parser
+
+def findBenchmarks(names):
+    if not names:
+        return allBenchmarks
+    benchmarks = []
+    for name in names.split(","):
+        matching = [ b for b in allBenchmarks if b.name == name or b.name.startswith(name + ".") ]
+        if not matching:
+            raise definitions.UseCaseScriptError, "ERROR: no benchmark named " + repr(name) + ", use --list to see them all"
+        benchmarks += [ b for b in matching if b not in benchmarks ]
+    return benchmarks
+
+def getPeakMemory():
+    # In kilobytes. Not available on Windows or Jython
+    try:
+        import resource
+    except ImportError:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+def getCpuTime():
+    # User and system time of this process, all threads included. Not available on Jython
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    except ImportError: # Windows, where os.times only counts to the clock tick but is there
+        try:
+            userTime, systemTime = os.times()[:2]
+            return userTime + systemTime
+        except (AttributeError, OSError):
+            pass
+
+def runBenchmark(benchmarkClass, scale, repeat):
+    workDir = tempfile.mkdtemp(prefix="storytext_benchmark")
+    try:
+        benchmark = benchmarkClass(scale, workDir)
+        benchmark.setUp()
+        times, cpuTimes = [], []
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            cpuStart = getCpuTime()
+            benchmark.run()
+            times.append(timeit.default_timer() - start)
+            if cpuStart is not None:
+                cpuTimes.append(getCpuTime() - cpuStart)
+        result = { "seconds" : min(times), "allSeconds" : times, "sizes" : benchmark.getSizes() }
+        if cpuTimes:
+            # For the run with the reported time
+            result["cpuSeconds"] = cpuTimes[times.index(min(times))]
+        return result
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def runInChild(args):
+    # Entry point for the process started by runInSubprocess
+    name, scale, repeat = args
+    benchmarkClass = findBenchmarks(name)[0]
+    result = runBenchmark(benchmarkClass, float(scale), int(repeat))
+    result["peakMemoryKb"] = getPeakMemory()
+    sys.stdout.write(json.dumps(result))
+
+def runInSubprocess(benchmarkClass, scale, repeat):
+    libDir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = "import sys; sys.path.insert(0, " + repr(libDir) + "); " + \
+           "from storytext.benchmark.runner import runInChild; runInChild(sys.argv[1:])"
+    env = os.environ.copy()
+    env.pop("USECASE_REPLAY_SCRIPT", None)
+    env.pop("USECASE_RECORD_SCRIPT", None)
+    proc = subprocess.Popen([ sys.executable, "-c", code, benchmarkClass.name, str(scale), str(repeat) ],
+                            stdout=subprocess.PIPE, env=env)
+    output = proc.communicate()[0]
+    if proc.returncode:
+        raise definitions.UseCaseScriptError, "ERROR: benchmark " + benchmarkClass.name + " failed"
+    return json.loads(output)
+
+def runAll(benchmarks, options):
+    results = {}
+    for benchmarkClass in benchmarks:
+        sys.stderr.write("Running " + benchmarkClass.name + "...\n")
+        if options.in_process:
+            results[benchmarkClass.name] = runBenchmark(benchmarkClass, options.scale, options.repeat)
+        else:
+            results[benchmarkClass.name] = runInSubprocess(benchmarkClass, options.scale, options.repeat)
+    return { "storytextVersion" : definitions.__version__,
+             "python" : sys.version.split()[0],
+             "platform" : sys.platform,
+             "date" : time.strftime("%Y-%m-%d %H:%M:%S"),
+             "scale" : options.scale,
+             "repeat" : options.repeat,
+             "benchmarks" : results }
+
+def formatMemory(kb):
+    return str(kb) + " KB" if kb is not None else "-"
+
+def formatChange(old, new):
+    if not old or new is None:
+        return "-"
+    return "%+.1f%%" % (100.0 * (new - old) / old)
+
+def isRegression(old, new, tolerance):
+    return old is not None and new is not None and new > old * (1 + tolerance / 100.0)
+
+def compareResults(baseline, results, tolerance):
+    # Returns the table of changes, and the names of those that got worse by more than the tolerance
+    rows = []
+    regressions = []
+    for name in sorted(results["benchmarks"].keys()):
+        new = results["benchmarks"][name]
+        old = baseline["benchmarks"].get(name)
+        if old is None:
+            rows.append([ name, "-", "%.4f" % new["seconds"], "-", "-", formatMemory(new.get("peakMemoryKb")), "-", "new" ])
+            continue
+        status = "ok"
+        if old.get("sizes") != new.get("sizes"):
+            status = "different sizes"
+        elif isRegression(old["seconds"], new["seconds"], tolerance) or \
+                 isRegression(old.get("peakMemoryKb"), new.get("peakMemoryKb"), tolerance):
+            status = "REGRESSION"
+            regressions.append(name)
+        rows.append([ name, "%.4f" % old["seconds"], "%.4f" % new["seconds"], formatChange(old["seconds"], new["seconds"]),
+                      formatMemory(old.get("peakMemoryKb")), formatMemory(new.get("peakMemoryKb")),
+                      formatChange(old.get("peakMemoryKb"), new.get("peakMemoryKb")), status ])
+    headerRow = [ "Benchmark", "Baseline (s)", "Now (s)", "Change", "Baseline memory", "Now memory", "Change", "Status" ]
+    return str(GridFormatterWithHeader([ headerRow ], rows, len(headerRow))), regressions
+
+def main():
+    parser = create_option_parser()
+    options, args = parser.parse_args()
+    if options.list:
+        for benchmarkClass in allBenchmarks:
+            print benchmarkClass.name
+        return
+
+    try:
+        baseline = None
+        if options.compare:
+            baseline = json.load(open(options.compare))
+        results = runAll(findBenchmarks(options.benchmarks), options)
+    except definitions.UseCaseScriptError, e:
+        sys.stderr.write(str(e) + "\n")
+        sys.exit(2)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        outFile = open(options.output, "w")
+        outFile.write(text + "\n")
+        outFile.close()
+    else:
+        print text
+
+    if baseline is not None:
+        table, regressions = compareResults(baseline, results, options.tolerance)
+        sys.stderr.write(table + "\n")
+        if regressions:
+            sys.stderr.write("Regressions compared to " + options.compare + ": " + ", ".join(regressions) + "\n")
+            sys.exit(1)
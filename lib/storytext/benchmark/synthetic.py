@@ -0,0 +1,307 @@
+
+""" Generators for the synthetic input the benchmarks run on: usecase commands, shortcut libraries,
+UI map files and trees of fake widgets, all of which can be made at any size.
+Everything is generated from a seeded random generator, so the same scale always gives the same input """
+
+from storytext.guishared import Describer, ScriptEngine, WidgetAdapter
+from storytext.replayer import UseCaseReplayer, ReplayScript
+from storytext.definitions import waitCommandName
+import os, random
+
+verbs = [ "press", "select", "enter", "toggle", "open", "close", "expand", "collapse", "drag", "double-click" ]
+nouns = [ "button", "file", "item", "tab", "row", "menu", "dialog", "node", "cell", "field", "option", "view" ]
+widgetTypes = [ "Button", "Text", "Label", "Table", "Tree", "Combo", "List", "Shell" ]
+signatures = [ "Clicked", "Modified", "CellSelection", "Expanded", "Selected", "Typed" ]
+
+def makeGenerator(seed=42):
+    return random.Random(seed)
+
+def makeEventName(generator, i):
+    words = [ generator.choice(verbs) ]
+    for _ in range(generator.randint(1, 4)):
+        words.append(generator.choice(nouns))
+    return " ".join(words) + " " + str(i)
+
+def makeEventNames(count, seed=42):
+    generator = makeGenerator(seed)
+    return [ makeEventName(generator, i) for i in range(count) ]
+
+def makeScriptCommands(eventNames, count, seed=43):
+    # Commands as they appear in usecase files: event names, some with arguments, and some wait commands
+    generator = makeGenerator(seed)
+    commands = []
+    for i in range(count):
+        eventName = generator.choice(eventNames)
+        choice = generator.random()
+        if choice < 0.4:
+            commands.append(eventName + " = value " + str(i))
+        elif choice < 0.5:
+            commands.append(waitCommandName + " " + eventName)
+        else:
+            commands.append(eventName)
+    return commands
+
+def makeWaitLine(generator, eventCount, maxMultiple=3):
+    events = []
+    for i in range(eventCount):
+        event = generator.choice(nouns) + " " + str(i) + " finished"
+        multiple = generator.randint(1, maxMultiple)
+        if multiple > 1:
+            event += " * " + str(multiple)
+        events.append(event)
+    return waitCommandName + " " + ", ".join(events)
+
+def makeWaitLines(count, eventCount, seed=44):
+    generator = makeGenerator(seed)
+    return [ makeWaitLine(generator, eventCount) for _ in range(count) ]
+
+def makeShortcutFiles(dirName, count, seed=45):
+    # Shortcut names come from the file names, see ReplayScript.getShortcutName
+    generator = makeGenerator(seed)
+    fileNames = []
+    commands = []
+    for i in range(count):
+        words = [ generator.choice(verbs), generator.choice(nouns) ]
+        for _ in range(generator.randint(0, 2)):
+            words.insert(generator.randint(1, len(words)), "$")
+        words.append(str(i))
+        fileName = os.path.join(dirName, "_".join(words) + ".shortcut")
+        f = open(fileName, "w")
+        for j in range(generator.randint(2, 6)):
+            f.write(makeEventName(generator, j) + "\n")
+        f.close()
+        fileNames.append(fileName)
+        commands.append(" ".join(words).replace("$", "arg" + str(i)))
+    return fileNames, commands
+
+def makeIdentifiers(i):
+    return [ "Name=widget" + str(i), "Title=Window " + str(i % 50), "Label=label " + str(i),
+             "Tooltip=tip " + str(i % 100), "Type=" + widgetTypes[i % len(widgetTypes)],
+             "Dialog=Dialog " + str(i % 20), "Context=Context " + str(i % 10) ]
+
+def makeUIMapFile(fileName, sectionCount, eventNames, seed=46):
+    # Mostly sections for single names, as people tend to write, with a few for combinations
+    # of identifiers and a few regular expressions
+    generator = makeGenerator(seed)
+    f = open(fileName, "w")
+    sectionsWritten = set()
+    while len(sectionsWritten) < sectionCount:
+        ids = makeIdentifiers(generator.randint(0, sectionCount * 2))
+        choice = generator.random()
+        if choice < 0.7:
+            section = ids[0]
+        elif choice < 0.95:
+            section = ", ".join(sorted(generator.sample(ids[1:], 2), key=ids.index))
+        else:
+            section = ids[4].split("=")[0] + "=" + ids[4].split("=")[1][:3] + ".*"
+        if section in sectionsWritten:
+            continue
+        sectionsWritten.add(section)
+        f.write("[" + section + "]\n")
+        for signature in generator.sample(signatures, generator.randint(1, 3)):
+            f.write(signature + " = " + generator.choice(eventNames) + "\n")
+        f.write("\n")
+    f.close()
+
+
+def makeUsecaseFile(fileName, eventNames, count, seed=52):
+    f = open(fileName, "w")
+    for command in makeScriptCommands(eventNames, count, seed):
+        f.write(command + "\n")
+    f.close()
+
+
+# Just enough of a widget adapter for UIMap to find sections for, and monitor
+class SyntheticWidgetAdapter:
+    def __init__(self, i):
+        self.ids = makeIdentifiers(i)
+        self.widget = SyntheticWidget(self.ids[2])
+
+    def getUIMapIdentifiers(self):
+        return self.ids
+
+    def forgetUIMapIdentifiers(self):
+        pass
+
+    def getType(self):
+        return self.ids[4].split("=")[1]
+
+
+class SyntheticWidget(object):
+    def __init__(self, text):
+        self.text = text
+
+    def isVisible(self):
+        return True
+
+class SyntheticLabel(SyntheticWidget):
+    pass
+
+class SyntheticButton(SyntheticWidget):
+    pass
+
+class SyntheticEntry(SyntheticWidget):
+    def __init__(self, text):
+        SyntheticWidget.__init__(self, text)
+        self.listeners = []
+
+    def setText(self, text):
+        self.text = text
+        for listener in self.listeners:
+            listener()
+
+class SyntheticContainer(SyntheticWidget):
+    def __init__(self, columns):
+        SyntheticWidget.__init__(self, "")
+        self.columns = columns
+        self.children = []
+
+    def getChildren(self):
+        return self.children
+
+# Stand-ins for all the other widget classes real toolkits know about, none of which our widgets are
+otherWidgetClasses = [ type("SyntheticOther" + str(i), (SyntheticWidget,), {}) for i in range(30) ]
+
+def makeWidgetTree(widgetCount, seed=47):
+    generator = makeGenerator(seed)
+    root = SyntheticContainer(1)
+    containers = [ root ]
+    allWidgets = [ root ]
+    while len(allWidgets) < widgetCount:
+        parent = containers.pop(0)
+        for i in range(min(10, widgetCount - len(allWidgets))):
+            choice = generator.random()
+            if i == 0 or choice < 0.15:
+                child = SyntheticContainer(generator.choice([ 1, 2, 3, 4 ]))
+                containers.append(child)
+            elif choice < 0.5:
+                child = SyntheticLabel(generator.choice(nouns) + " " + str(len(allWidgets)))
+            elif choice < 0.75:
+                child = SyntheticButton(generator.choice(verbs) + " " + str(len(allWidgets)))
+            else:
+                child = SyntheticEntry("text " + str(len(allWidgets)) + "\n" * generator.randint(0, 2))
+            parent.children.append(child)
+            allWidgets.append(child)
+    return root, allWidgets
+
+# Just the pixel data, which is what images are numbered by, see WidgetCounter
+class SyntheticImage(object):
+    def __init__(self, data):
+        self.data = data
+
+def makeImages(count, seed=51):
+    # Some are copies of earlier ones, as when the same icon appears in several places
+    generator = makeGenerator(seed)
+    images = []
+    for _ in range(count):
+        if images and generator.random() < 0.1:
+            images.append(SyntheticImage(generator.choice(images).data))
+        else:
+            images.append(SyntheticImage("%0256x" % generator.getrandbits(1024)))
+    return images
+
+def makeGrid(rowCount, columnCount, seed=48):
+    generator = makeGenerator(seed)
+    grid = []
+    for _ in range(rowCount):
+        row = []
+        for _ in range(columnCount):
+            words = [ generator.choice(nouns) for _ in range(generator.randint(0, 4)) ]
+            row.append("\n".join(words) if generator.random() < 0.1 else " ".join(words))
+        grid.append(row)
+    return grid
+
+
+# Describes the synthetic widgets in the same way as the real toolkits describe theirs
+class SyntheticDescriber(Describer):
+    stateWidgets = [ SyntheticEntry ]
+    statelessWidgets = [ SyntheticLabel, SyntheticButton, SyntheticContainer ]
+    ignoreWidgets = []
+    ignoreChildren = ()
+    childrenMethodName = "getChildren"
+    visibleMethodName = "isVisible"
+    def getWindowClasses(self):
+        return ()
+
+    def getTextEntryClass(self):
+        return SyntheticEntry
+
+    def getLayoutColumns(self, widget, childCount, *args):
+        return widget.columns
+
+    def getSyntheticLabelDescription(self, widget):
+        return "'" + widget.text + "'"
+
+    def getSyntheticButtonDescription(self, widget):
+        return "Button '" + widget.text + "'"
+
+    def getSyntheticEntryDescription(self, widget):
+        return "Text entry '" + self.getAndStoreState(widget) + "'"
+
+    def getSyntheticEntryState(self, widget):
+        return widget.text
+
+    def startTrackingChanges(self, widget):
+        if isinstance(widget, SyntheticEntry):
+            widget.listeners.append(lambda: self.markDirty(widget))
+            return True
+        else:
+            return False
+
+    def imagesEqual(self, image1, image2):
+        return image1.data == image2.data
+
+    def imagesHash(self, image):
+        return hash(image.data)
+
+    def getSyntheticContainerDescription(self, widget):
+        return ""
+
+
+# Describes them as if there were as many other kinds of widgets as in a real toolkit
+class SyntheticToolkitDescriber(SyntheticDescriber):
+    stateWidgets = otherWidgetClasses[:15] + SyntheticDescriber.stateWidgets
+    statelessWidgets = otherWidgetClasses[15:] + SyntheticDescriber.statelessWidgets
+
+
+class SyntheticEvent:
+    def __init__(self, name, widget, argumentParseData=None):
+        self.name = name
+        self.widget = widget
+        self.argumentParseData = argumentParseData
+
+    @classmethod
+    def getAssociatedSignatures(cls, widget):
+        return set([ "Clicked" ])
+
+
+# Just enough of a script engine to find the events for our widgets. The more general classes come last
+class SyntheticScriptEngine(ScriptEngine):
+    def __init__(self):
+        self.eventTypes = [ (widgetClass, [ SyntheticEvent ]) for widgetClass in otherWidgetClasses ] + \
+                          [ (SyntheticEntry, [ SyntheticEvent ]), (SyntheticButton, [ SyntheticEvent ]),
+                            (SyntheticWidget, [ SyntheticEvent ]) ]
+        self.eventTypesChanged()
+
+
+def makeWidgetAdapters(widgets):
+    return [ WidgetAdapter(widget) for widget in widgets ]
+
+
+# Replays a usecase without recording, as UIMap sees it
+class SyntheticReplayScriptEngine(ScriptEngine):
+    def __init__(self, usecaseFile):
+        self.enableShortcuts = False
+        self.replayer = UseCaseReplayer(None)
+        self.replayer.scripts.append((ReplayScript(usecaseFile), []))
+
+    def recorderActive(self):
+        return False
+
+    def replayerActive(self):
+        return True
+
+    def _monitorSignal(self, eventNames, signalName, widget, argumentParseData=None):
+        event = SyntheticEvent(eventNames[0], widget, argumentParseData)
+        self.replayer.addEvent(event, eventNames)
+        return event
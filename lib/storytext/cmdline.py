@@ -50,6 +50,8 @@ For fuller documentation refer to the online docs at http://www.texttest.org"""
                       help="Comma separated absolute paths to image files")
     parser.add_option("-r", "--record", 
                       help="record script to FILE. Also enabled via the environment variable USECASE_RECORD_SCRIPT.", metavar="FILE")
+    parser.add_option("--record-flush", metavar="POLICY",
+                      help="when to write recorded lines to the record script. 'line' (the default) writes each one as it is recorded. Otherwise a comma-separated list of 'wait' (at each wait command), 'size:BYTES' (when that much is waiting to be written) and 'time:SECONDS' (that long after the first line waiting to be written), which helps on slow network file systems. Everything is always written when recording stops. Also enabled via the environment variable USECASE_RECORD_FLUSH.")
     parser.add_option("-s", "--supported", action="store_true",
                       help="list which PyGTK widgets and signals are currently supported 'out-of-the-box'")
     parser.add_option("-S", "--screenshot", action="store_true",
@@ -70,6 +72,22 @@ Use any value from the lower list, i.e. the one for automatic logging, without t
 An example would be '-X Menu,ToolBar,Browser' for SWT/Eclipse RCP, or '-X MenuBar,Toolbar,TreeView' for PyGTK.
 Also allow syntax like '-X Menu!File', to exclude all menus except those called 'File'. 
 On Windows, '-X MenuNOTFile' is a temporary alternative to this, working around a Jython bug.""")
+    parser.add_option("--appearance-retry", metavar="SECONDS", type="float",
+                      help="When a command cannot be replayed, only retry it when new widgets appear or existing ones change, giving up after SECONDS. The default is to retry at fixed intervals for 5 seconds. Time spent waiting is reported to the 'replay waits' log. Only works for Swing and SWT/Eclipse currently.")
+    parser.add_option("--replay-session", metavar="FILE1,...",
+                      help="Replay all of the given usecase files one after the other, without restarting the application in between. The GUI log of each is written to a separate file, see --session-log-dir. Leftover dialogs are closed between them, and the application can add further reset actions via storytext.addSessionResetHook. Only works for SWT/Eclipse currently, other interfaces refuse it. Also enabled via the environment variable USECASE_REPLAY_SESSION.")
+    parser.add_option("--session-log-dir", metavar="DIR",
+                      help="With --replay-session, write the GUI log of each usecase to a file in DIR, named after its position in the session and the usecase file. Default is the current directory.")
+    parser.add_option("--replay-trace", metavar="FILE",
+                      help="When replaying, write a trace of how long each part of replaying each command took to FILE, in Chrome's trace-event format (for chrome://tracing or Perfetto). A summary of the slowest commands is written alongside it. Also enabled via the environment variable USECASE_REPLAY_TRACE.")
+    parser.add_option("--state-changes", metavar="MODE",
+                      help="How to find the widgets whose state has changed after each action, for the auto-generated GUI log. 'poll' (the default) reads the state of every widget. 'dirty' only reads those the toolkit has reported changes for, which is much quicker for large GUIs. 'verify' reads every widget but reports on standard error any change that was not reported. Only SWT/Eclipse and Swing report changes currently, other toolkits always read everything.")
+    parser.add_option("--lazy-instrumentation", action="store_true",
+                      help="When only replaying, don't create events for widgets that no command in the usecases or the shortcuts they use can refer to, which is quicker for GUIs with many widgets. Anything those commands turn out to need after all is created when it is first used. Has no effect when recording. Also enabled via the environment variable USECASE_LAZY_INSTRUMENTATION.")
+    parser.add_option("--registry-limit", metavar="COUNT", type="int",
+                      help="Keep information cached about at most COUNT widgets in each of StoryText's caches, e.g. table indexers and menu contexts, dropping the least recently used. Useful for keeping memory down in long-running usecases. Also enabled via the environment variable USECASE_REGISTRY_LIMIT.")
+    parser.add_option("--memory-report", metavar="FILE",
+                      help="At the end of the run, write to FILE how many widgets StoryText was keeping information about, for each kind of information. Also enabled via the environment variable USECASE_MEMORY_REPORT.")
     parser.add_option("--insert-shortcuts", action="store_true", help="Re-record the replay script to the record script without running anything, inserting shortcuts as required")
     return parser
 
@@ -111,6 +129,20 @@ def set_up_environment(options):
         os.environ["USECASE_REPLAY_DELAY"] = max(os.getenv("USECASE_REPLAY_DELAY"), options.delay)
     if options.screenshot:
         os.environ["USECASE_REPLAY_SCREENSHOTS"] = "1"
+    if options.replay_session:
+        os.environ["USECASE_REPLAY_SESSION"] = options.replay_session
+    if options.session_log_dir:
+        os.environ["USECASE_REPLAY_SESSION_LOG_DIR"] = options.session_log_dir
+    if options.replay_trace:
+        os.environ["USECASE_REPLAY_TRACE"] = options.replay_trace
+    if options.record_flush:
+        os.environ["USECASE_RECORD_FLUSH"] = options.record_flush
+    if options.lazy_instrumentation:
+        os.environ["USECASE_LAZY_INSTRUMENTATION"] = "1"
+    if options.registry_limit:
+        os.environ["USECASE_REGISTRY_LIMIT"] = str(options.registry_limit)
+    if options.memory_report:
+        os.environ["USECASE_MEMORY_REPORT"] = options.memory_report
 
 
 def check_python_version():
@@ -4,7 +4,7 @@
     Also allow hierarchical viewing of usecases.
     Tkinter users still need GTK for TextTest to work... """
 
-import gtktoolkit, gtktoolkit.compat, gtk, encodingutils, os, sys, logging, shutil, re
+import gtktoolkit, gtktoolkit.compat, gtk, gobject, encodingutils, os, sys, logging, shutil, re
 from optparse import OptionParser
 
 from ordereddict import OrderedDict
@@ -29,6 +29,9 @@ class UseCaseEditor:
             self.editTitle = self.fileName.replace(os.getenv("TEXTTEST_HOME") + "/", "")
         self.interface = interface
         self.uiMapFileHandler = UIMapFileHandler(mapFiles)
+        # Renaming can change many entries, and the UI map is rewritten in full each time it's written
+        self.uiMapFileHandler.deferWrites()
+        self.uiMapWriteHandler = None
         self.scriptEngine = EditorScriptEngine(uiMapFiles=[])
         self.initShortcutManager()
         self.allEntries = OrderedDict()
@@ -72,6 +75,24 @@ class UseCaseEditor:
         self.isAutoGenerated = len(autoGenerated) > 0
         dialog = self.createDialog(autoGeneratedInfo, commands)
         self.runDialog(dialog, autoGenerated, autoGeneratedInfo)
+        self.writeUIMap()
+
+    def scheduleUIMapWrite(self):
+        # Written when the GUI is next idle, by which time whatever was being changed should be done
+        if self.uiMapWriteHandler is None:
+            self.uiMapWriteHandler = gobject.idle_add(self.writeUIMapWhenIdle)
+
+    def writeUIMapWhenIdle(self):
+        self.uiMapWriteHandler = None
+        self.writeUIMap()
+        return False
+
+    def writeUIMap(self):
+        if self.uiMapWriteHandler is not None:
+            gobject.source_remove(self.uiMapWriteHandler)
+            self.uiMapWriteHandler = None
+        self.uiMapFileHandler.write()
+        logging.getLogger("gui map").debug(self.uiMapFileHandler.getWriteStatistics())
 
     def runDialog(self, dialog, autoGenerated, autoGeneratedInfo):
         response = dialog.run()
@@ -89,7 +110,7 @@ class UseCaseEditor:
                 dialog.destroy()
                 for widgetDescription, signature, signalInfo, eventName in toStore:
                     self.uiMapFileHandler.storeInfo(widgetDescription, signature or signalInfo[-1], eventName)
-                self.uiMapFileHandler.write()
+                self.writeUIMap()
         elif len(autoGenerated) == 0:
             dialog.destroy()
         else:
@@ -717,6 +738,7 @@ class UseCaseEditor:
         with open(fileName, "w") as f:
             for line in lines:
                 f.write(line + "\n")
+        ReplayScript.parsedCache.invalidate(fileName)
         print "Shortcut", repr(name), "created."
         return ReplayScript(fileName)
     
@@ -876,6 +898,7 @@ class UseCaseEditor:
             if self.checkUpdateUIMapEntryNames(dialog, newWidgetDesc, newSignal):
                 dialog.hide()
                 self.uiMapFileHandler.updateSectionAndOptionNames(oldWidgetDescription, newWidgetDesc, oldSignal, newSignal)
+                self.scheduleUIMapWrite()
                 self.updateUIMapPreview(oldWidgetDescription, newWidgetDesc, oldSignal, newSignal)
 
         else:
@@ -1028,6 +1051,7 @@ class UseCaseEditor:
     def updateUsecaseNameInUIMap(self, oldCommand, newCommand):
         for section, option in self.uiMapFileHandler.findSectionsAndOptions(oldCommand):
             self.uiMapFileHandler.updateOptionValue(section, option, newCommand)
+        self.scheduleUIMapWrite()
         
     def updateUsecaseNameInShorcuts(self, oldCommand, newCommand):
         for _, shortcut in self.shortcutManager.getShortcuts():
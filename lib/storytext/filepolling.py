@@ -1,16 +1,135 @@
 
-from threading import Thread
-import os, time
+""" Watching for files appearing or disappearing, e.g. for mutual synchronisation between processes.
+All watched files share one thread: on Linux it waits for inotify events on their directories,
+elsewhere (including Jython) it polls all of them together """
+
+from threading import Thread, Lock
+import os, sys, time, struct
 
 def poll_file(fileName, eventName, appEventMethod):
     eventName = eventName or fileName + " to be updated"
-    startState = os.path.exists(fileName)
-    class PollThread(Thread):
-        def run(self):
-            while os.path.exists(fileName) == startState:
-                time.sleep(0.1)
-            appEventMethod(eventName, category="file poll")
-            
-    thread = PollThread()
-    thread.setDaemon(True)
-    thread.start()
+    def fileChanged():
+        appEventMethod(eventName, category="file poll")
+    FileWatcher.getInstance().watch(fileName, fileChanged)
+
+
+class WatchedFile:
+    def __init__(self, fileName, callback):
+        self.fileName = os.path.abspath(fileName)
+        self.callback = callback
+        self.startState = os.path.exists(self.fileName)
+
+    def hasChanged(self):
+        return os.path.exists(self.fileName) != self.startState
+
+
+# Behaves as a singleton, see getInstance
+class FileWatcher:
+    instance = None
+    def __init__(self):
+        self.watchedFiles = []
+        self.lock = Lock()
+        self.thread = None
+
+    @classmethod
+    def getInstance(cls):
+        if cls.instance is None:
+            try:
+                cls.instance = InotifyFileWatcher()
+            except (ImportError, OSError, AttributeError):
+                # No ctypes (e.g. Jython) or not Linux
+                cls.instance = PollingFileWatcher()
+        return cls.instance
+
+    def watch(self, fileName, callback):
+        watchedFile = WatchedFile(fileName, callback)
+        self.lock.acquire()
+        fallbackWatcher = self.addWatch(watchedFile)
+        if fallbackWatcher is None:
+            self.watchedFiles.append(watchedFile)
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="StoryText file watcher")
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self.lock.release()
+        # Not holding the lock, as the other watcher may call back straight away
+        if fallbackWatcher is not None:
+            fallbackWatcher.watch(fileName, callback)
+        else:
+            # In case it changed before we started watching it
+            self.checkFiles()
+
+    def addWatch(self, watchedFile):
+        # Returns another watcher to use if this one can't watch the file
+        pass
+
+    def checkFiles(self, dirName=None):
+        self.lock.acquire()
+        changedFiles = []
+        for watchedFile in self.watchedFiles:
+            if (dirName is None or os.path.dirname(watchedFile.fileName) == dirName) and watchedFile.hasChanged():
+                changedFiles.append(watchedFile)
+        for watchedFile in changedFiles:
+            self.watchedFiles.remove(watchedFile)
+        self.lock.release()
+        # Don't hold the lock while calling back, callbacks may watch further files
+        for watchedFile in changedFiles:
+            watchedFile.callback()
+
+
+class PollingFileWatcher(FileWatcher):
+    def run(self):
+        while True:
+            time.sleep(0.1)
+            self.checkFiles()
+
+
+class InotifyFileWatcher(FileWatcher):
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    eventHeader = struct.Struct("iIII")
+    def __init__(self):
+        import ctypes, ctypes.util
+        FileWatcher.__init__(self)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError("inotify not available")
+        self.watchDirs = {}
+        # Any directory we can't watch falls back to being polled
+        self.pollingWatcher = None
+
+    def addWatch(self, watchedFile):
+        dirName = os.path.dirname(watchedFile.fileName)
+        if dirName in self.watchDirs.values():
+            return
+        mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+        path = dirName.encode(sys.getfilesystemencoding()) if isinstance(dirName, unicode) else dirName
+        descriptor = self.libc.inotify_add_watch(self.fd, path, mask)
+        if descriptor >= 0:
+            self.watchDirs[descriptor] = dirName
+        else:
+            if self.pollingWatcher is None:
+                self.pollingWatcher = PollingFileWatcher()
+            return self.pollingWatcher
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, 65536)
+            changedDirs = set()
+            pos = 0
+            while pos < len(data):
+                descriptor, mask, _, nameLength = self.eventHeader.unpack_from(data, pos)
+                pos += self.eventHeader.size + nameLength
+                if mask & self.IN_Q_OVERFLOW:
+                    changedDirs.add(None)
+                elif descriptor in self.watchDirs:
+                    changedDirs.add(self.watchDirs[descriptor])
+            if None in changedDirs:
+                self.checkFiles()
+            else:
+                for dirName in changedDirs:
+                    self.checkFiles(dirName)
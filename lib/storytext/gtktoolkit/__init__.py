@@ -67,6 +67,7 @@ class ScriptEngine(storytext.guishared.ScriptEngine):
         for index, (widgetClass, currEventClasses) in enumerate(self.eventTypes):
             if widgetClass in eventTypeReplacements:
                 self.eventTypes[index] = eventTypeReplacements[widgetClass], currEventClasses
+        self.eventTypesChanged()
                 
     def createShortcutBar(self):
         # Standard thing to add at the bottom of the GUI...
@@ -233,7 +234,7 @@ class UseCaseReplayer(storytext.guishared.IdleHandlerUseCaseReplayer):
             self.logger.debug("Disabling all idle handlers")
             self._disableIdleHandlers()
             if self.uiMap:
-                self.uiMap.windows = [] # So we regenerate everything next time around
+                self.uiMap.windows.clear() # So we regenerate everything next time around
 
     def idle_add(self, *args, **kw):
         handler = self.orig_idle_add(*args, **kw)
@@ -85,7 +85,7 @@ class ResponseEvent(SignalEvent):
 
     def findChildWidget(self, widgetAdapter, identifier):
         for child in widgetAdapter.getChildren():
-            if identifier in child.findPossibleUIMapIdentifiers():
+            if identifier in child.getUIMapIdentifiers():
                 return self.widget.get_response_for_widget(child.widget)
 
     def parseId(self, responseId):
@@ -3,9 +3,13 @@
 stuff also applicable even without this """
 
 import scriptengine, replayer, definitions, encodingutils
-import os, sys, logging, subprocess, time, re
+import os, sys, logging, subprocess, time, re, shutil, atexit
 from gridformatter import GridFormatter, GridFormatterWithHeader
+from uimapcache import UIMapCache, ParsedUIMapFile
+from tracing import ReplayTracer
+from registries import WidgetRegistry
 from itertools import izip
+from threading import Condition, Lock
 from random import choice
 
 try:
@@ -21,9 +25,17 @@ if sys.version_info[:2] >= (2, 6):
 else: # pragma: no cover - not currently running older than 2.5 in regular tests
     from ConfigParser26 import ConfigParser, ParsingError #@Reimport
     
+# Finding identifiers can be slow, and they're needed several times when monitoring each widget,
+# so getUIMapIdentifiers keeps them until UIMap.monitorWidget is done with the widget. Toolkits can also
+# provide them beforehand via setUIMapIdentifiers, if they can find them quicker for many widgets at once.
+# They aren't kept any longer, as no toolkit tells us when texts, tooltips or data change
 class WidgetAdapter:
     adapterClass = None
     secondaryIdentifiers = [ "Context", "Dialog" ]
+    identifiersComputed = 0
+    identifiersReused = 0
+    identifierCache = None
+    monitorOrder = None
     @staticmethod
     def setAdapterClass(adapterCls):
         WidgetAdapter.adapterClass = adapterCls
@@ -58,6 +70,10 @@ class WidgetAdapter:
 
     def isInstanceOf(self, widgetClass):
         return isinstance(self.widget, widgetClass)
+
+    def getClassKey(self):
+        # Whatever isInstanceOf depends on, so that what we work out from it can be cached
+        return self.__class__, self.widget.__class__
     
     def getTooltip(self):
         return ""
@@ -96,7 +112,29 @@ class WidgetAdapter:
         return ""
     
     def getUIMapIdentifier(self):
-        return self.findPossibleUIMapIdentifiers()[0]
+        return self.getUIMapIdentifiers()[0]
+
+    def getUIMapIdentifiers(self):
+        if self.identifierCache is not None:
+            WidgetAdapter.identifiersReused += 1
+            return list(self.identifierCache)
+        ids = self.findPossibleUIMapIdentifiers()
+        WidgetAdapter.identifiersComputed += 1
+        self.identifierCache = ids
+        return list(ids)
+
+    def setUIMapIdentifiers(self, ids):
+        if ids is not None:
+            WidgetAdapter.identifiersComputed += 1
+        self.identifierCache = ids
+
+    def forgetUIMapIdentifiers(self):
+        self.identifierCache = None
+
+    @staticmethod
+    def getIdentifierStatistics():
+        return "identifiers found " + str(WidgetAdapter.identifiersComputed) + " times, reused " + \
+               str(WidgetAdapter.identifiersReused) + " times"
     
     def isPreferred(self):
         return False
@@ -204,6 +242,7 @@ class ProgrammaticChangeIntercept(MethodIntercept):
 
 class ScriptEngine(scriptengine.ScriptEngine):
     defaultMapFile = os.path.join(scriptengine.ScriptEngine.storytextHome, "ui_map.conf")
+    eventClassCache = None
     def __init__(self, enableShortcuts=False, uiMapFiles=[ defaultMapFile ],
                  customEventTypes=[], universalLogging=True, binDir="", **kw):
         self.uiMap = self.createUIMap(uiMapFiles)
@@ -232,8 +271,24 @@ class ScriptEngine(scriptengine.ScriptEngine):
                     currEventClasses[0:0] = customEventClasses
                     break
             self.eventTypes.insert(0, (customWidgetClass, customEventClasses))
+        self.eventTypesChanged()
+
+    def eventTypesChanged(self):
+        # Call whenever eventTypes is changed, what we found from the old ones won't be right any more
+        self.eventClassCache = {}
 
     def findEventClassesFor(self, widget):
+        # Depends only on the widget's class, and there are a lot more widgets than classes
+        if self.eventClassCache is None:
+            self.eventClassCache = {}
+        classKey = widget.getClassKey()
+        eventClasses = self.eventClassCache.get(classKey)
+        if eventClasses is None:
+            eventClasses = self.findEventClassesForClass(widget)
+            self.eventClassCache[classKey] = eventClasses
+        return eventClasses
+
+    def findEventClassesForClass(self, widget):
         eventClasses = []
         currClass = None
         for widgetClass, currEventClasses in self.eventTypes:
@@ -348,12 +403,19 @@ class ScriptEngine(scriptengine.ScriptEngine):
                 sep = "NOT" if "NOT" in excludeStr else "!"
                 parts = excludeStr.split(sep)
                 Describer.excludeClassNames[parts[0]] = parts[1:]
+            Describer.describedClassesChanged()
         if options.min_field_widths:
             for subStr in options.min_field_widths.split(","):
                 fieldName, minWidthStr = subStr.split("=")
                 Describer.minFieldWidths[fieldName] = int(minWidthStr)
         if options.primary_key_columns:
             BaseTableIndexer.primaryKeyColumnTexts += options.primary_key_columns.split(",")
+        if options.appearance_retry:
+            ThreadedUseCaseReplayer.appearanceRetryDeadline = options.appearance_retry
+        if options.state_changes:
+            if options.state_changes not in Describer.stateChangeModes:
+                raise definitions.UseCaseScriptError, "ERROR: --state-changes should be one of " + ", ".join(Describer.stateChangeModes)
+            Describer.stateChangeMode = options.state_changes
 
     def run_python_or_java(self, args):
         # Two options here: either a Jython program and hence a .py file, or a Java class
@@ -455,18 +517,40 @@ is also supported but will only have features of the listed type described.
         return cls.columnSignalDescs.get(signalName, signalName)
 
 
+# Writes out the whole file, so with large UI maps callers should make all their changes first, see UIMapFileHandler.deferWrites.
+# The file is written alongside and renamed into place, so that nobody reads it half written
 class WriteParserHandler:
     def __init__(self, fileName, parser):
         self.fileName = fileName
         self.parser = parser
         self.changed = False
+        self.writeCount = 0
+        self.bytesWritten = 0
 
     def write(self):
         if self.changed:
             dirName = os.path.dirname(self.fileName)
             if dirName and not os.path.isdir(dirName):
                 os.makedirs(dirName)
-            self.parser.write(encodingutils.openEncoded(self.fileName, "w"))
+            tmpFile = self.fileName + "." + str(os.getpid()) + ".tmp"
+            try:
+                f = encodingutils.openEncoded(tmpFile, "w")
+                try:
+                    self.parser.write(f)
+                finally:
+                    f.close()
+                bytesWritten = os.path.getsize(tmpFile)
+                if os.path.exists(self.fileName):
+                    shutil.copymode(self.fileName, tmpFile)
+                    if os.pathsep == ";": # Windows, can't rename onto an existing file
+                        os.remove(self.fileName)
+                os.rename(tmpFile, self.fileName)
+            except (IOError, OSError):
+                if os.path.exists(tmpFile):
+                    os.remove(tmpFile)
+                raise
+            self.bytesWritten += bytesWritten
+            self.writeCount += 1
             self.changed = False
 
     def add_section(self, *args):
@@ -477,6 +561,14 @@ class WriteParserHandler:
         self.changed = True
         self.parser.set(*args)
 
+    def remove_option(self, *args):
+        self.changed = True
+        return self.parser.remove_option(*args)
+
+    def remove_section(self, *args):
+        self.changed = True
+        return self.parser.remove_section(*args)
+
     def __getattr__(self, name):
         return getattr(self.parser, name)
     
@@ -485,13 +577,18 @@ class ParserSectionDict(OrderedDict):
     def __init__(self, fileName, *args, **kw):
         OrderedDict.__init__(self, *args, **kw)
         self.readingFiles = fileName
+        self.duplicates = []
         
     def __getitem__(self, key):
         if self.readingFiles:
-            msg = "UI map file(s) at " + self.readingFiles + " has duplicated sections for widgets identified by '" + key + "', the earlier ones will be ignored"
-            sys.stderr.write("WARNING: " + msg + ".\n")
+            self.warnDuplicate(key)
         return OrderedDict.__getitem__(self, key)
 
+    def warnDuplicate(self, key):
+        self.duplicates.append(key)
+        msg = "UI map file(s) at " + self.readingFiles + " has duplicated sections for widgets identified by '" + key + "', the earlier ones will be ignored"
+        sys.stderr.write("WARNING: " + msg + ".\n")
+
     def values(self):
         # Fix for python 2.7... which calls __getitem__ internally
         origFile = self.readingFiles
@@ -500,15 +597,201 @@ class ParserSectionDict(OrderedDict):
         self.readingFiles = origFile
         return ret
     
+# Maps option values back to the sections and options they are stored under, so that
+# finding which UI map entries a command refers to doesn't mean scanning the whole UI map.
+# Positions are remembered so that lookups return entries in the order they appear in the parser.
+# The values are stored raw, so it also counts those that refer to other values with %(name)s
+class UIMapValueIndex:
+    def __init__(self):
+        self.entries = {}
+        self.optionValues = {}
+        self.positions = {}
+        self.valueLengths = set()
+        self.nextPosition = 0
+        self.interpolatedCount = 0
+
+    def getNextPosition(self):
+        self.nextPosition += 1
+        return self.nextPosition
+
+    def addSection(self, section):
+        if section not in self.positions:
+            self.positions[section] = self.getNextPosition()
+
+    def removeSection(self, section, options):
+        for option in options:
+            self.removeOption(section, option)
+        self.positions.pop(section, None)
+
+    def setValue(self, section, option, value):
+        self.addSection(section)
+        key = section, option
+        if key in self.optionValues:
+            self.removeEntry(key)
+        else:
+            self.positions[key] = self.getNextPosition()
+        self.optionValues[key] = value
+        if value:
+            self.entries.setdefault(value, set()).add(key)
+            self.valueLengths.add(len(value))
+            if "%(" in value:
+                self.interpolatedCount += 1
+
+    def removeOption(self, section, option):
+        key = section, option
+        if key in self.optionValues:
+            self.removeEntry(key)
+            del self.optionValues[key]
+            del self.positions[key]
+
+    def removeEntry(self, key):
+        value = self.optionValues[key]
+        if value and "%(" in value:
+            self.interpolatedCount -= 1
+        keys = self.entries.get(value)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self.entries[value]
+
+    def getSortKey(self, key):
+        return self.positions[key[0]], self.positions[key]
+
+    def findPrefixesOf(self, valueString):
+        # Every value that valueString starts with, as (value, section, option)
+        keys = []
+        for length in self.valueLengths:
+            if length <= len(valueString):
+                keys += self.entries.get(valueString[:length], [])
+        keys.sort(key=self.getSortKey)
+        return [ (self.optionValues[key],) + key for key in keys ]
+
+
+# Indexes the section names under every way they could start, so that the sections made up of
+# some of a widget's identifiers can be found without trying every combination of them
+class UIMapSectionIndex:
+    def __init__(self):
+        self.entries = {}
+
+    def getStartsAndRests(self, section):
+        parts = section.split(", ")
+        for i in range(1, len(parts)):
+            yield ", ".join(parts[:i]), ", ".join(parts[i:])
+        yield section, None
+
+    def addSection(self, section):
+        for start, rest in self.getStartsAndRests(section):
+            self.entries.setdefault(start, []).append((section, rest))
+
+    def removeSection(self, section):
+        for start, rest in self.getStartsAndRests(section):
+            sections = self.entries.get(start, [])
+            if (section, rest) in sections:
+                sections.remove((section, rest))
+            if not sections:
+                self.entries.pop(start, None)
+
+    def findCombinations(self, ids):
+        # The index tuples of all combinations of ids that join to make a section name
+        combinations = []
+        for i, identifier in enumerate(ids):
+            for _, rest in self.entries.get(identifier, []):
+                for indices in self.matchRest(rest, ids, i + 1):
+                    combinations.append((i,) + indices)
+        return combinations
+
+    def matchRest(self, rest, ids, start):
+        if rest is None:
+            return [ () ]
+        matches = []
+        for i in range(start, len(ids)):
+            if rest == ids[i]:
+                matches.append((i,))
+            elif rest.startswith(ids[i] + ", "):
+                for indices in self.matchRest(rest[len(ids[i]) + 2:], ids, i + 1):
+                    matches.append((i,) + indices)
+        return matches
+
+
 class UIMapFileParser(ConfigParser):
     def __init__(self, filenames, **kw):
         ConfigParser.__init__(self, **kw)
         # There isn't a nice way to change the behaviour on getting a duplicate section
         # so we use a nasty way :)
         self._sections = ParserSectionDict(",".join(filenames))
+        self.valueIndex = None
+        self.sectionIndex = None
+        self.itemsCache = {}
         
     def optionxform(self, optionstr):
         return optionstr # don't lowercase
+
+    def enableIndexes(self):
+        self.valueIndex = UIMapValueIndex()
+        self.sectionIndex = UIMapSectionIndex()
+        for section in self.sections():
+            self.valueIndex.addSection(section)
+            self.sectionIndex.addSection(section)
+            for option, value in self._sections[section].items():
+                if option != "__name__":
+                    self.valueIndex.setValue(section, option, value)
+
+    def hasSections(self):
+        return len(self._sections) > 0
+
+    def items(self, section, raw=False, vars=None):
+        # Monitoring reads every section each widget matches, and interpolating them every time adds up
+        if raw or vars or self.valueIndex is None:
+            return ConfigParser.items(self, section, raw, vars)
+        items = self.itemsCache.get(section)
+        if items is None:
+            items = self.itemsCache[section] = ConfigParser.items(self, section)
+        return list(items)
+
+    def findValuePrefixes(self, valueString):
+        # The index only knows the raw values in each section, so can't be used if they come from [DEFAULT] or are interpolated
+        if self.defaults() or self.valueIndex.interpolatedCount:
+            return self.scanValuePrefixes(valueString)
+        return self.valueIndex.findPrefixesOf(valueString)
+
+    def scanValuePrefixes(self, valueString):
+        prefixes = []
+        for section in self.sections():
+            for option, value in self.items(section):
+                if value and valueString.startswith(value):
+                    prefixes.append((value, section, option))
+        return prefixes
+
+    def findSectionCombinations(self, ids):
+        return self.sectionIndex.findCombinations(ids)
+
+    def add_section(self, section):
+        ConfigParser.add_section(self, section)
+        if self.valueIndex is not None:
+            self.valueIndex.addSection(section)
+            self.sectionIndex.addSection(section)
+
+    def set(self, section, option, value=None):
+        ConfigParser.set(self, section, option, value)
+        self.itemsCache.clear()
+        if self.valueIndex is not None and section in self._sections:
+            self.valueIndex.setValue(section, option, value)
+
+    def remove_option(self, section, option):
+        existed = ConfigParser.remove_option(self, section, option)
+        self.itemsCache.clear()
+        if existed and self.valueIndex is not None:
+            self.valueIndex.removeOption(section, option)
+        return existed
+
+    def remove_section(self, section):
+        options = self.options(section) if section in self._sections else []
+        existed = ConfigParser.remove_section(self, section)
+        self.itemsCache.clear()
+        if existed and self.valueIndex is not None:
+            self.valueIndex.removeSection(section, options)
+            self.sectionIndex.removeSection(section)
+        return existed
     
     def read(self, filenames):
         for filename in filenames:
@@ -519,29 +802,145 @@ class UIMapFileParser(ConfigParser):
             self._read(fp, filename)
             fp.close()
         self._sections.readingFiles = None
+
+    def readParsed(self, parsedFiles):
+        # Same as read, but from what the cache stored rather than the files themselves
+        for parsedFile in parsedFiles:
+            for name, value in parsedFile.defaults:
+                self._defaults[name] = value
+            for section in parsedFile.duplicates:
+                self._sections.warnDuplicate(section)
+            for section, options in parsedFile.sections:
+                if section in self._sections:
+                    cursect = self._sections[section]
+                else:
+                    cursect = self._dict()
+                    cursect["__name__"] = section
+                    self._sections[section] = cursect
+                for name, value in options:
+                    cursect[name] = value
+        self._sections.readingFiles = None
+
+    def makeParsedFile(self, regexChars):
+        sections = []
+        for section in self.sections():
+            options = [ (name, value) for name, value in self._sections[section].items() if name != "__name__" ]
+            sections.append((section, options))
+        regexSectionNames = [ section for section in self.sections() if regexChars.search(section) != None ]
+        return ParsedUIMapFile(sections, self._defaults.items(), self._sections.duplicates, regexSectionNames)
                 
         
+# The regex sections, combined into as few regular expressions as possible so that finding
+# the first one that matches doesn't mean trying them all in turn. Also knows the literal
+# text that each one must start with, so we can tell quickly when none of them can match.
+class RegexSectionMatcher:
+    metaChars = "^$.[]{}()\\*?+|"
+    maxGroups = 90 # Python limits the number of groups in a regular expression to 100
+    def __init__(self, regexes):
+        self.literalPrefixes = [ self.getLiteralPrefix(regex.pattern) for regex in regexes ]
+        self.matchers = []
+        group = []
+        for regex in regexes:
+            if self.canCombine(regex):
+                if sum((r.groups + 1 for r in group)) + regex.groups + 1 > self.maxGroups:
+                    self.addMatchers(group)
+                    group = []
+                group.append(regex)
+            else:
+                self.addMatchers(group)
+                group = []
+                self.matchers.append((regex, None))
+        self.addMatchers(group)
+
+    def getLiteralPrefix(self, pattern):
+        if "|" in pattern:
+            return ""
+        for i, char in enumerate(pattern):
+            if char in self.metaChars:
+                if char in "*?{": # the character before might not be there
+                    return pattern[:max(i - 1, 0)]
+                else:
+                    return pattern[:i]
+        return pattern
+
+    def canCombine(self, regex):
+        # Flags and back-references would change meaning in a combined expression
+        return "(?" not in regex.pattern and re.search(r"\\[1-9]", regex.pattern) is None
+
+    def addMatchers(self, regexes):
+        if len(regexes) > 1:
+            combinedPattern = "|".join([ "(?P<r" + str(i) + ">" + regex.pattern + ")" for i, regex in enumerate(regexes) ])
+            try:
+                self.matchers.append((re.compile(combinedPattern), [ regex.pattern for regex in regexes ]))
+                return
+            except re.error:
+                pass
+        for regex in regexes:
+            self.matchers.append((regex, None))
+
+    def mayMatchStartingWith(self, text):
+        for prefix in self.literalPrefixes:
+            if prefix.startswith(text) or text.startswith(prefix):
+                return True
+        return False
+
+    def match(self, text):
+        # Returns the pattern of the first regex section that matches, like trying them in order
+        for regex, patterns in self.matchers:
+            match = regex.match(text)
+            if match:
+                if patterns is None:
+                    return regex.pattern
+                else:
+                    return patterns[int(match.lastgroup[1:])]
+
+
 class UIMapFileHandler:
     quoteChars = [ ("'", "APOSTROPHE") ]
     bracketChars = [ ("[", "OPENBRACKET"), ("]", "CLOSEBRACKET")]
     regexChars = re.compile("[\^\$\[\]\{\}\\\*\?\|\+]")
     def __init__(self, uiMapFiles): 
+        self.cache = UIMapCache.create()
+        self.writesDeferred = False
         self.readFiles(uiMapFiles)
         self.regexSections = []
-        for section in self.readParser.sections():
-            if self.regexChars.search(section) != None:
-                try:
-                    self.regexSections.append(re.compile(section))
-                except re.error:
-                    pass
+        for section in self.regexSectionNames:
+            try:
+                self.regexSections.append(re.compile(section))
+            except re.error:
+                pass
+        self.regexMatcher = RegexSectionMatcher(self.regexSections)
                 
     def readFiles(self, uiMapFiles):
-        # See top of file: uses the version from 2.6
-        self.writeParsers = [ WriteParserHandler(f, self.makeParser([ f ])) for f in uiMapFiles ]
+        # Each file is only parsed once, and not at all if the cache has it:
+        # the combined read parser is built from what the write parsers read
+        self.writeParsers = []
+        parsedFiles = []
+        for f in uiMapFiles:
+            parser, parsedFile = self.readFile(f)
+            self.writeParsers.append(WriteParserHandler(f, parser))
+            parsedFiles.append(parsedFile)
         if len(self.writeParsers) == 1:
             self.readParser = self.writeParsers[0]
         else:
-            self.readParser = self.makeParser(uiMapFiles)
+            self.readParser = self.makeParserFromParsed(uiMapFiles, parsedFiles)
+        self.readParser.enableIndexes()
+        self.regexSectionNames = []
+        for parsedFile in parsedFiles:
+            for section in parsedFile.regexSectionNames:
+                if section not in self.regexSectionNames:
+                    self.regexSectionNames.append(section)
+
+    def readFile(self, fileName):
+        parsedFile = self.cache and self.cache.load(fileName)
+        if parsedFile:
+            return self.makeParserFromParsed([ fileName ], [ parsedFile ]), parsedFile
+        
+        parser = self.makeParser([ fileName ])
+        parsedFile = parser.makeParsedFile(self.regexChars)
+        if self.cache:
+            self.cache.store(fileName, parsedFile)
+        return parser, parsedFile
             
     def makeParser(self, filenames):
         parser = UIMapFileParser(filenames, dict_type=OrderedDict)
@@ -551,6 +950,11 @@ class UIMapFileHandler:
         except ParsingError:
             raise definitions.UseCaseScriptError, "ERROR: could not parse UI map file(s) at " + ",".join(filenames)
 
+    def makeParserFromParsed(self, filenames, parsedFiles):
+        parser = UIMapFileParser(filenames, dict_type=OrderedDict)
+        parser.readParsed(parsedFiles)
+        return parser
+
     def storeInfo(self, sectionName, signature, eventName):
         sectionName = self._escape(sectionName, self.bracketChars)
         if not self.readParser.has_section(sectionName):
@@ -583,51 +987,76 @@ class UIMapFileHandler:
 
         if removeSection:
             writeParser.remove_section(section)
-        writeParser.write()
+        self.writeChanges(writeParser)
         return newSectionName
+
+    def deferWrites(self):
+        # Keep changes until write is called, rather than writing the file after each one.
+        # Anything not written by then is written on exit
+        if not self.writesDeferred:
+            self.writesDeferred = True
+            atexit.register(self.write)
+
+    def writeChanges(self, writeParser):
+        if not self.writesDeferred:
+            writeParser.write()
     
     def write(self, *args):
         for parserHandler in self.writeParsers:
             parserHandler.write()
 
+    def getBytesWritten(self):
+        return sum((parserHandler.bytesWritten for parserHandler in self.writeParsers))
+
+    def getWriteStatistics(self):
+        writeCount = sum((parserHandler.writeCount for parserHandler in self.writeParsers))
+        return "UI map files written " + str(writeCount) + " times, " + str(self.getBytesWritten()) + " bytes"
+
     def __getattr__(self, name):
         return getattr(self.readParser, name)
 
     def findSectionsAndOptions(self, valueString):
         details = []
-        for section in self.readParser.sections():
-            for optionName, value in self.readParser.items(section):
-                if value and valueString.startswith(value):
-                    details.append((self._unescape(section, self.bracketChars), optionName))
+        for _, section, optionName in self.readParser.findValuePrefixes(valueString):
+            details.append((self._unescape(section, self.bracketChars), optionName))
         return details
 
     def splitOptionValue(self, valueString):
-        for section in self.readParser.sections():
-            for optionName, value in self.readParser.items(section):
-                if value and valueString.startswith(value):
-                    return value, valueString.replace(value, "").strip()
+        for value, _, _ in self.readParser.findValuePrefixes(valueString):
+            return value, valueString.replace(value, "").strip()
         return None, None
     
     def updateOptionValue(self, section, option, newValue):
         section = self._escape(section, self.bracketChars)
         writeParser = self.findWriteParser(section)
         writeParser.set(section, option, newValue)
-        writeParser.write()
+        self.writeChanges(writeParser)
 
     def hasInfo(self):
-        return len(self.readParser.sections()) > 0
+        # Asked for every widget monitored, so don't list the sections
+        return self.readParser.hasSections()
     
     def getSection(self, section):
         rawSectionName = self._escape(section, self.bracketChars)
         if self.readParser.has_section(rawSectionName):
             return section
         
-        for regex in self.regexSections:
-            if regex.match(rawSectionName):
-                return regex.pattern
+        return self.regexMatcher.match(rawSectionName)
+
+    def findSectionCombinations(self, ids):
+        return self.readParser.findSectionCombinations([ self._escape(i, self.bracketChars) for i in ids ])
+
+    def regexSectionMayStartWith(self, identifier):
+        return len(self.regexSections) > 0 and self.regexMatcher.mayMatchStartingWith(self._escape(identifier, self.bracketChars))
+
+    def findRegexSection(self, section):
+        return self.regexMatcher.match(self._escape(section, self.bracketChars))
 
     def items(self, section):
-        return self.readParser.items(self._escape(section, self.bracketChars))
+        return self.readParser.items(self.escapeSection(section))
+
+    def escapeSection(self, section):
+        return self._escape(section, self.bracketChars)
     
     def escape(self, text):
         return self._escape(text, self.quoteChars + self.bracketChars)
@@ -645,12 +1074,22 @@ class UIMapFileHandler:
             text = text.replace("<" + name + ">", char)
         return text
 
+# With --lazy-instrumentation, when only replaying, widgets are only instrumented for the sections of the UI map
+# (or auto-generated names) that the usecases can refer to. The rest are put off until some command turns out
+# to need them, see instrumentDeferred
 class UIMap:
     ignoreWidgetTypes = []
     def __init__(self, scriptEngine, uiMapFiles):
         self.fileHandler = UIMapFileHandler(uiMapFiles)
         self.scriptEngine = scriptEngine
-        self.windows = []
+        self.windows = WidgetRegistry("UIMap.windows", capped=False, forgettable=False)
+        self.lazyInstrumentation = bool(os.getenv("USECASE_LAZY_INSTRUMENTATION"))
+        self.deferredInstrumentation = WidgetRegistry("UIMap.deferredInstrumentation", capped=False)
+        self.deferredSections = set()
+        self.deferredAutoEventNames = set()
+        self.deferredLock = Lock()
+        self.sectionsReplayable = None, {}
+        self.monitorCount = 0
         self.logger = logging.getLogger("gui map")
         self.logger.debug("Reading ui map files at " + repr(uiMapFiles))
 
@@ -665,12 +1104,17 @@ class UIMap:
 
     def monitorAndStoreWindow(self, window):
         if window not in self.windows:
-            self.windows.append(window)
+            self.windows.add(window)
             self.monitorWindow(WidgetAdapter.adapt(window))
 
     def monitorWindow(self, window):
         self.logger.debug("Monitoring new window with title " + repr(window.getTitle()))
         self.monitor(window)
+        self.logger.debug("Done monitoring window, " + WidgetAdapter.getIdentifierStatistics() + " so far")
+        if len(self.deferredInstrumentation):
+            self.logger.debug("Instrumentation deferred for " + str(len(self.deferredInstrumentation)) + " widgets, from " +
+                              str(len(self.deferredSections)) + " sections and " + str(len(self.deferredAutoEventNames)) +
+                              " auto-generated names")
 
     def monitor(self, widget, excludeWidgets=[]):
         if widget.widget not in excludeWidgets:
@@ -681,19 +1125,42 @@ class UIMap:
         for child in widget.getChildren():
             self.monitor(child, *args, **kw)
 
+    def getReplayableCommands(self):
+        # None unless instrumentation can be lazy. Recording and describing need every widget instrumented
+        if self.lazyInstrumentation and not self.scriptEngine.recorderActive() and not self.scriptEngine.enableShortcuts:
+            replayer = getattr(self.scriptEngine, "replayer", None)
+            if replayer and replayer.isActive():
+                commands = replayer.getReplayableCommands()
+                if not commands.matchesAnything:
+                    return commands
+
     def monitorWidget(self, widget):
-        signaturesInstrumented, autoInstrumented = self.instrumentFromMapFile(widget)
-        if self.scriptEngine.recorderActive() or not self.fileHandler.hasInfo():
-            widgetType = widget.getType()
-            for signature, modifiers in self.findAutoInstrumentSignatures(widget, signaturesInstrumented):
-                identifier = self.getAutoInstrumentIdentifier(widget)
-                autoEventName = "Auto." + widgetType + "." + self.getAutoEventSignatureText(signature, modifiers) + ".'" + identifier + "'"
-                signalName, argumentParseData = self.parseSignature(signature)
-                self.autoInstrument([ autoEventName ], signalName, widget, argumentParseData, widgetType)
-        return autoInstrumented
+        try:
+            replayableCommands = self.getReplayableCommands()
+            if replayableCommands is not None:
+                # So that events instrumented later can be put in the order they would have been in, see UseCaseReplayer.addEvent
+                self.monitorCount += 1
+                widget.monitorOrder = self.monitorCount
+            deferredSections, deferredAutoInfo = [], []
+            signaturesInstrumented, autoInstrumented = self.instrumentFromMapFile(widget, replayableCommands, deferredSections)
+            if self.scriptEngine.recorderActive() or not self.fileHandler.hasInfo():
+                widgetType = widget.getType()
+                for signature, modifiers in self.findAutoInstrumentSignatures(widget, signaturesInstrumented):
+                    identifier = self.getAutoInstrumentIdentifier(widget)
+                    autoEventName = "Auto." + widgetType + "." + self.getAutoEventSignatureText(signature, modifiers) + ".'" + identifier + "'"
+                    if replayableCommands is not None and not replayableCommands.mayStartWith(autoEventName):
+                        deferredAutoInfo.append((signature, [ autoEventName ]))
+                        continue
+                    signalName, argumentParseData = self.parseSignature(signature)
+                    self.autoInstrument([ autoEventName ], signalName, widget, argumentParseData, widgetType)
+            if deferredSections or deferredAutoInfo:
+                self.deferInstrumentation(widget, deferredSections, deferredAutoInfo)
+            return autoInstrumented
+        finally:
+            widget.forgetUIMapIdentifiers()
     
     def getFullWidgetDescriptor(self, widget):
-        basicId = ", ".join(widget.findPossibleUIMapIdentifiers())
+        basicId = ", ".join(widget.getUIMapIdentifiers())
         if basicId.startswith("Name="):
             basicId = basicId.split(", ")[0]
         return basicId
@@ -702,17 +1169,72 @@ class UIMap:
         basicId = self.getFullWidgetDescriptor(widget)
         return self.fileHandler.escape(basicId)
 
-    def instrumentFromMapFile(self, widget):
+    def instrumentFromMapFile(self, widget, replayableCommands=None, deferredSections=None):
         widgetType = widget.getType()
         if widgetType in self.ignoreWidgetTypes:
             return set(), False
         signaturesInstrumented = set()
         autoInstrumented = False
-        for signature, eventNames in self.findAllSignatureInfo(widget):
+        for signature, eventNames in self.findAllSignatureInfo(widget, replayableCommands, deferredSections):
             if self.tryAutoInstrument(eventNames, signature, signaturesInstrumented, widget, widgetType):
                 autoInstrumented = True
         return signaturesInstrumented, autoInstrumented
 
+    def isSectionReplayable(self, section, replayableCommands):
+        # Many widgets share each section, so only look at its event names once
+        if self.sectionsReplayable[0] is not replayableCommands:
+            self.sectionsReplayable = replayableCommands, {}
+        replayable = self.sectionsReplayable[1].get(section)
+        if replayable is None:
+            replayable = any((replayableCommands.mayStartWith(eventName) for _, eventName in self.fileHandler.items(section)))
+            self.sectionsReplayable[1][section] = replayable
+        return replayable
+
+    def deferInstrumentation(self, widget, sections, autoSignatureInfo):
+        self.deferredLock.acquire()
+        try:
+            _, widgetSections, widgetAutoInfo = self.deferredInstrumentation.setdefault(widget.widget, (widget, [], []))
+            widgetSections.extend(sections)
+            widgetAutoInfo.extend(autoSignatureInfo)
+            self.deferredSections.update(map(self.fileHandler.escapeSection, sections))
+            for _, eventNames in autoSignatureInfo:
+                self.deferredAutoEventNames.update(eventNames)
+        finally:
+            self.deferredLock.release()
+
+    def instrumentDeferred(self, scriptCommand, commandName=None):
+        # Instruments deferred events whose names scriptCommand starts with, and which are at least as long as
+        # commandName, the name it matches already if any. Returns whether anything was instrumented for it
+        if not self.deferredSections and not self.deferredAutoEventNames:
+            return False
+        minLength = commandName and len(commandName) or 0
+        self.deferredLock.acquire()
+        try:
+            sections = set((section for value, section, _ in self.fileHandler.findValuePrefixes(scriptCommand) if len(value) >= minLength))
+            sections.intersection_update(self.deferredSections)
+            autoEventNames = set((name for name in self.deferredAutoEventNames if len(name) >= minLength and scriptCommand.startswith(name)))
+            toInstrument = []
+            if sections or autoEventNames:
+                self.deferredSections.difference_update(sections)
+                self.deferredAutoEventNames.difference_update(autoEventNames)
+                for key, (widget, widgetSections, widgetAutoInfo) in self.deferredInstrumentation.items():
+                    sectionsNow = [ s for s in widgetSections if self.fileHandler.escapeSection(s) in sections ]
+                    autoInfoNow = [ info for info in widgetAutoInfo if autoEventNames.intersection(info[1]) ]
+                    if sectionsNow or autoInfoNow:
+                        toInstrument.append((widget, self.getSignatureInfo(sectionsNow, widget) + autoInfoNow))
+                        widgetSections[:] = [ s for s in widgetSections if s not in sectionsNow ]
+                        widgetAutoInfo[:] = [ info for info in widgetAutoInfo if info not in autoInfoNow ]
+                        if not widgetSections and not widgetAutoInfo:
+                            del self.deferredInstrumentation[key]
+        finally:
+            self.deferredLock.release()
+        for widget, signatureInfo in toInstrument:
+            widgetType = widget.getType()
+            for signature, eventNames in signatureInfo:
+                self.logger.debug("Instrumenting deferred " + ",".join(eventNames) + " for widget of type " + widgetType)
+                self.tryAutoInstrument(eventNames, signature, set(), widget, widgetType)
+        return len(toInstrument) > 0
+
     def tryAutoInstrument(self, eventNames, signature, signaturesInstrumented, widget, widgetType):
         try:
             signalName, argumentParseData = self.parseSignature(signature)
@@ -742,9 +1264,21 @@ class UIMap:
                         signatures.append(sigWithModifiers)
         return signatures
     
-    def findAllSignatureInfo(self, widget):
+    def findAllSignatureInfo(self, widget, replayableCommands=None, deferredSections=None):
+        sections = self.findSections(widget)
+        if replayableCommands is not None:
+            replayableSections = []
+            for section in sections:
+                if self.isSectionReplayable(section, replayableCommands):
+                    replayableSections.append(section)
+                else:
+                    deferredSections.append(section)
+            sections = replayableSections
+        return self.getSignatureInfo(sections, widget)
+
+    def getSignatureInfo(self, sections, widget):
         info = OrderedDict()
-        for section in self.findSections(widget):
+        for section in sections:
             self.logger.debug("Reading map file section " + repr(section) + " for widget of type " + widget.getType())
             for signature, eventName in self.fileHandler.items(section):
                 eventNames = info.setdefault(signature, [])
@@ -775,7 +1309,7 @@ class UIMap:
             yield tuple(pool[i] for i in indices)
     
     def allUIMapIdCombinations(self, widget):
-        ids = widget.findPossibleUIMapIdentifiers()
+        ids = widget.getUIMapIdentifiers()
         for i in range(len(ids), 0, -1):
             for sectionNameParts in self.combinations(ids, i):
                 sectionName = ", ".join(sectionNameParts)
@@ -789,14 +1323,34 @@ class UIMap:
             return not sectionName.startswith("Name=")
     
     def findSections(self, widget):
+        # Same as calling fileHandler.getSection for everything from allUIMapIdCombinations, in the same order,
+        # but only considers the combinations that could possibly match something
+        ids = widget.getUIMapIdentifiers()
+        sectionsFound = {}
+        for indices in self.fileHandler.findSectionCombinations(ids):
+            sectionsFound[indices] = self.joinIdentifiers(ids, indices)
+        for indices in self.findRegexSectionCandidates(ids):
+            if indices not in sectionsFound:
+                regexSection = self.fileHandler.findRegexSection(self.joinIdentifiers(ids, indices))
+                if regexSection:
+                    sectionsFound[indices] = regexSection
         sections = []
-        for sectionName in self.allUIMapIdCombinations(widget):
-            self.logger.debug("Looking up section name " + repr(sectionName))
-            actualSection = self.fileHandler.getSection(sectionName)
-            if actualSection:
-                sections.append(actualSection)
+        for indices in sorted(sectionsFound.keys(), key=lambda indices: (-len(indices), indices)):
+            if self.isSensibleSectionName(self.joinIdentifiers(ids, indices), len(indices)):
+                sections.append(sectionsFound[indices])
         return sections
 
+    def joinIdentifiers(self, ids, indices):
+        return ", ".join([ ids[i] for i in indices ])
+
+    def findRegexSectionCandidates(self, ids):
+        for i, identifier in enumerate(ids):
+            if self.fileHandler.regexSectionMayStartWith(identifier):
+                others = range(i + 1, len(ids))
+                for count in range(len(others) + 1):
+                    for otherIndices in self.combinations(others, count):
+                        yield (i,) + otherIndices
+
     def parseSignature(self, signature):
         parts = signature.split(".", 1)
         signalName = parts[0]
@@ -821,6 +1375,32 @@ class UseCaseReplayer(replayer.UseCaseReplayer):
         
     def enableReading(self):
         self.readingEnabled = True
+
+    def findCommandName(self, command):
+        commandName = replayer.UseCaseReplayer.findCommandName(self, command)
+        # Even if some name matches, a deferred one might match more of the command
+        if self.uiMap and self.uiMap.instrumentDeferred(command, commandName):
+            commandName = replayer.UseCaseReplayer.findCommandName(self, command)
+        return commandName
+
+    @staticmethod
+    def getMonitorOrder(event):
+        return getattr(getattr(event, "widget", None), "monitorOrder", None)
+
+    def addEvent(self, event, eventNames):
+        order = self.getMonitorOrder(event)
+        if order is None:
+            return replayer.UseCaseReplayer.addEvent(self, event, eventNames)
+        for name in eventNames:
+            if name not in self.events:
+                self.commandNameIndex.add(name)
+            events = self.events.setdefault(name, [])
+            # Deferred events are instrumented after those of widgets monitored since, but getPossibleEvents
+            # relies on the order they were monitored in
+            pos = len(events)
+            while pos > 0 and self.getMonitorOrder(events[pos - 1]) > order:
+                pos -= 1
+            events.insert(pos, event)
     
     def getParseError(self, scriptCommand):
         widgetDetails = self.uiMap.findWidgetDetails(scriptCommand)
@@ -899,8 +1479,8 @@ class IdleHandlerUseCaseReplayer(UseCaseReplayer):
                 if not handlerActive and self.uiMap: # pragma: no cover - cannot test with replayer disabled
                     # End of shortcut: reset for next time
                     self.logger.debug("Shortcut terminated: Resetting UI map ready for next shortcut")
-                    self.uiMap.windows = [] 
-                    self.events = {}
+                    self.uiMap.windows.clear()
+                    self.clearEvents()
         if self.readingEnabled:
             return self.callReplayHandlerAgain(*args)
         else:
@@ -908,28 +1488,111 @@ class IdleHandlerUseCaseReplayer(UseCaseReplayer):
         
 # Base class for Java replayers, both of which run in a separate thread
 class ThreadedUseCaseReplayer(UseCaseReplayer):
+    # If set, commands that fail are retried only when the toolkit reports new or changed widgets,
+    # giving up after this many seconds. Otherwise we retry at fixed intervals.
+    appearanceRetryDeadline = None
+    def __init__(self, *args, **kw):
+        UseCaseReplayer.__init__(self, *args, **kw)
+        self.readingCondition = Condition()
+        self.widgetChangeCondition = Condition()
+        self.widgetChangeCount = 0
+        self.retryWaits = []
+        self.retryLogger = logging.getLogger("replay waits")
+        self.goneWidgets = set()
+        self.goneWidgetsLock = Lock()
+
+    def traceReplay(self):
+        UseCaseReplayer.traceReplay(self)
+        self.tracer.traceMethods(self, "replay", [ "tryParseRepeatedly", "checkWidgetStatus", "generateEvent" ])
+
+    def enableReading(self):
+        self.readingCondition.acquire()
+        self.readingEnabled = True
+        self.readingCondition.notifyAll()
+        self.readingCondition.release()
+
     def waitForReenable(self):
         self.logger.debug("Waiting for replaying to be re-enabled...")
+        self.readingCondition.acquire()
         while not self.readingEnabled:
-            time.sleep(0.1) # don't use the whole CPU while waiting
+            self.readingCondition.wait()
+        self.readingCondition.release()
+
+    def notifyWidgetsChanged(self):
+        # Called by the toolkits when widgets have appeared, been enabled etc
+        self.widgetChangeCondition.acquire()
+        self.widgetChangeCount += 1
+        self.widgetChangeCondition.notifyAll()
+        self.widgetChangeCondition.release()
+
+    def widgetGone(self, widget):
+        # Called by the toolkits when a widget has been disposed for good.
+        # Its events can't be replayed any more, so they are removed before the next command
+        if self.isActive():
+            self.goneWidgetsLock.acquire()
+            self.goneWidgets.add(widget)
+            self.goneWidgetsLock.release()
+
+    def getEventWidget(self, event):
+        return event.widget.widget
+
+    def removeEventsForGoneWidgets(self):
+        self.goneWidgetsLock.acquire()
+        goneWidgets = self.goneWidgets
+        self.goneWidgets = set()
+        self.goneWidgetsLock.release()
+        if goneWidgets:
+            self.removeEvents([ event for events in self.events.values() for event in events
+                                if self.getEventWidget(event) in goneWidgets ])
+
+    def waitForWidgetChange(self, changeCount, deadline):
+        # Returns False if the deadline passes with nothing changing since changeCount was read
+        self.widgetChangeCondition.acquire()
+        try:
+            while self.widgetChangeCount == changeCount:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.widgetChangeCondition.wait(remaining)
+            return True
+        finally:
+            self.widgetChangeCondition.release()
 
     def describeAndRun(self, describeMethod, replayFailureMethod=None):
+        if self.tracer:
+            describeMethod = self.tracer.wrap("describe", "describe", describeMethod)
         if not self.readingEnabled:
             self.waitForReenable()
         while True:
             if self.delay:
                 self.logger.debug("Sleeping for " + str(self.delay) + " seconds...")
                 time.sleep(self.delay)
+            self.removeEventsForGoneWidgets()
             proceed, wait = self.runNextCommand(describeMethod=describeMethod, replayFailureMethod=replayFailureMethod)
             if not proceed:
+                self.readingCondition.acquire()
                 self.readingEnabled = self.waitingCompleted()
+                self.readingCondition.release()
                 if wait:
                     self.waitForReenable()
                 else:
-                    self.logger.debug("No command to run, no waiting to do: exiting replayer")
-                    break
+                    self.writeRetryReport()
+                    if not self.startNextSessionScript():
+                        self.logger.debug("No command to run, no waiting to do: exiting replayer")
+                        break
+
+    def resetSessionState(self):
+        UseCaseReplayer.resetSessionState(self)
+        self.retryWaits = []
+        Indexer.allIndexers.clear()
 
     def tryParseRepeatedly(self, commandWithArg, replayFailureMethod):
+        if self.appearanceRetryDeadline is None:
+            return self.tryParseAtIntervals(commandWithArg, replayFailureMethod)
+        else:
+            return self.tryParseOnWidgetChanges(commandWithArg, replayFailureMethod)
+
+    def tryParseAtIntervals(self, commandWithArg, replayFailureMethod):
         attemptCount = 50
         command = None
         for attempt in range(attemptCount):
@@ -947,6 +1610,44 @@ class ThreadedUseCaseReplayer(UseCaseReplayer):
                     if replayFailureMethod:
                         replayFailureMethod(str(value), self.events.get(command, []))
                     time.sleep(0.1)
+
+    def tryParseOnWidgetChanges(self, commandWithArg, replayFailureMethod):
+        startTime = time.time()
+        deadline = startTime + self.appearanceRetryDeadline
+        command = None
+        attempt = 0
+        while True:
+            # Read this before trying, so we don't miss changes that happen while we're trying
+            changeCount = self.widgetChangeCount
+            attempt += 1
+            try:
+                command, argumentString = self.parseCommand(commandWithArg)
+                event, parsedArguments = self.checkWidgetStatus(command, argumentString)
+                self.storeRetryWait(commandWithArg, startTime, attempt, succeeded=True)
+                return command, argumentString, event, parsedArguments
+            except definitions.UseCaseScriptError:
+                excInfo = sys.exc_info()
+                self.logger.debug("Error, final event failed, waiting for widgets to change before retrying: " + str(excInfo[1]))
+                if replayFailureMethod:
+                    replayFailureMethod(str(excInfo[1]), self.events.get(command, []))
+                if not self.waitForWidgetChange(changeCount, deadline):
+                    self.storeRetryWait(commandWithArg, startTime, attempt, succeeded=False)
+                    raise excInfo[0], excInfo[1], excInfo[2]
+
+    def storeRetryWait(self, commandWithArg, startTime, attempts, succeeded):
+        self.retryWaits.append((commandWithArg, time.time() - startTime, attempts, succeeded))
+
+    def writeRetryReport(self):
+        waits = [ info for info in self.retryWaits if info[2] > 1 or not info[3] ]
+        if not waits:
+            return
+        self.retryLogger.info("Time spent waiting for widgets before commands could be replayed:")
+        for commandWithArg, waitTime, attempts, succeeded in waits:
+            details = str(attempts) + " attempts" + ("" if succeeded else ", gave up")
+            self.retryLogger.info(("%.3f" % waitTime).rjust(10) + "s (" + details + ") : " + commandWithArg)
+        totalTime = sum((info[1] for info in waits))
+        self.retryLogger.info("Total " + ("%.3f" % totalTime) + "s waiting, for " + str(len(waits)) + " of " +
+                              str(len(self.retryWaits)) + " commands")
         
     def checkAndParse(self, event, compositeEventProxy):
         event.checkWidgetStatus()
@@ -1060,18 +1761,29 @@ class ThreadedUseCaseReplayer(UseCaseReplayer):
         if event:
             self.describeEvent(commandName, argumentString)
             self.writeWarnings(event)
-            event.generate(parsedArguments)
+            self.generateEvent(event, parsedArguments)
         else:
             self.processSignalCommand(argumentString)
+
+    def generateEvent(self, event, parsedArguments):
+        event.generate(parsedArguments)
                 
 
 
+# Numbers things that can't be told apart in any other way, giving equal ones the same number.
+# Comparing with everything numbered so far gets slow when there are many of them, so if given a
+# hash method, which must give equal things the same hash, we only compare with those with the same hash,
+# and those that are the same object. Either way the earliest numbered one that's equal wins.
+# Hashes are stored when things are numbered, so only give a hash method if what it hashes can't change
 class WidgetCounter:
-    def __init__(self, equalityMethod=None):
+    def __init__(self, equalityMethod=None, hashMethod=None):
         self.widgetNumbers = []
         self.nextWidgetNumber = 1
         self.describedNumber = 0
         self.customEqualityMethod = equalityMethod
+        self.hashMethod = hashMethod
+        self.numbersByWidget = {}
+        self.numbersByHash = {}
 
     def widgetsEqual(self, widget1, widget2):
         if self.customEqualityMethod:
@@ -1079,20 +1791,59 @@ class WidgetCounter:
         else:
             return widget1 is widget2
 
-    def getWidgetNumber(self, widget):
-        for currWidget, number in self.widgetNumbers:
+    def isIndexed(self):
+        return self.customEqualityMethod is None or self.hashMethod is not None
+
+    def getHash(self, widget):
+        if self.customEqualityMethod and self.hashMethod:
+            try:
+                return self.hashMethod(widget)
+            except Exception:
+                pass # Compared with everything instead
+
+    def findCandidates(self, widget, hashKey):
+        if not self.isIndexed():
+            return self.widgetNumbers
+        try:
+            candidates = self.numbersByWidget.get(widget, [])
+        except TypeError: # unhashable, so can't be indexed
+            return self.widgetNumbers
+        if self.customEqualityMethod:
+            if hashKey is None:
+                return self.widgetNumbers
+            candidates = candidates + self.numbersByHash.get(hashKey, []) + self.numbersByHash.get(None, [])
+            candidates.sort(key=lambda info: info[1])
+        return candidates
+
+    def findWidgetNumber(self, widget, hashKey):
+        for currWidget, number in self.findCandidates(widget, hashKey):
             if (not hasattr(currWidget, "isDisposed") or not currWidget.isDisposed()) and self.widgetsEqual(widget, currWidget):
                 return number
         return 0
 
+    def getWidgetNumber(self, widget):
+        return self.findWidgetNumber(widget, self.getHash(widget))
+
     def getId(self, widget):
-        number = self.getWidgetNumber(widget)
+        hashKey = self.getHash(widget)
+        number = self.findWidgetNumber(widget, hashKey)
         if not number:
             number = self.nextWidgetNumber
-            self.widgetNumbers.append((widget, self.nextWidgetNumber))
+            self.addWidget(widget, number, hashKey)
             self.nextWidgetNumber += 1
         return str(number)
 
+    def addWidget(self, widget, number, hashKey):
+        info = widget, number
+        self.widgetNumbers.append(info)
+        if self.isIndexed():
+            try:
+                self.numbersByWidget.setdefault(widget, []).append(info)
+            except TypeError:
+                pass # unhashable, will only be found by comparing with everything
+            if self.customEqualityMethod:
+                self.numbersByHash.setdefault(hashKey, []).append(info)
+
     def getWidgetsForDescribe(self):
         widgets = self.widgetNumbers[self.describedNumber:]
         self.describedNumber = len(self.widgetNumbers)
@@ -1109,17 +1860,47 @@ class Describer(object):
     imageDescriptionType = None
     excludeClassNames = {}
     imageCounter = None
+    dispatchGeneration = 0
+    dispatchCache = None
+    dispatchCacheGeneration = None
+    # How findStateChanges decides which widgets to read the state of again, see --state-changes.
+    # "poll" reads all of them, "dirty" only those the toolkit has told us may have changed (see markDirty),
+    # and "verify" reads all of them but reports changes that the toolkit didn't tell us about.
+    stateChangeModes = [ "poll", "dirty", "verify" ]
+    stateChangeMode = "poll"
     def __init__(self):
         self.logger = encodingutils.getEncodedLogger("gui log")
-        self.windows = set()
-        self.widgetsWithState = OrderedDict()
+        # Windows shown again are not described again
+        self.windows = WidgetRegistry("Describer.windows", capped=False, forgettable=False)
+        self.widgetsWithState = WidgetRegistry("Describer.widgetsWithState", capped=False)
+        self.changeTracking = WidgetRegistry("Describer.changeTracking", capped=False)
+        self.trackedWidgets = WidgetRegistry("Describer.trackedWidgets", capped=False)
+        self.dirtyWidgets = set()
+        self.dirtyLock = Lock()
         if Describer.imageCounter is None:
-            Describer.imageCounter = WidgetCounter(self.imagesEqual)
+            Describer.imageCounter = WidgetCounter(self.imagesEqual, self.imagesHash)
         self.structureLog = logging.getLogger("widget structure")
+        tracer = ReplayTracer.getInstance()
+        if tracer:
+            tracer.traceMethods(self, "describe", [ "describe", "describeUpdates", "findStateChanges",
+                                                    "describeStateChanges", "describeAppearedWidgets" ])
 
     def imagesEqual(self, image1, image2):
         return image1 == image2
 
+    def imagesHash(self, image):
+        # Must give the same hash for any images that imagesEqual says are equal
+        return hash(image)
+
+    def resetSession(self):
+        # Forget everything described, so the next usecase in a session describes the GUI as if it had just appeared
+        self.windows.clear()
+        self.widgetsWithState.clear()
+        self.changeTracking.clear()
+        self.trackedWidgets.clear()
+        self.takeDirtyWidgets()
+        Describer.imageCounter = WidgetCounter(self.imagesEqual, self.imagesHash)
+
     def describe(self, window):
         if window in self.windows or not self.checkWindow(window):
             return
@@ -1146,11 +1927,55 @@ class Describer(object):
     def getWindowString(self):
         return "Window"
 
+    def markDirty(self, widget):
+        # Called by the toolkit's listeners, possibly from other threads
+        self.dirtyLock.acquire()
+        self.dirtyWidgets.add(widget)
+        self.dirtyLock.release()
+
+    def takeDirtyWidgets(self):
+        self.dirtyLock.acquire()
+        dirtyWidgets = self.dirtyWidgets
+        self.dirtyWidgets = set()
+        self.dirtyLock.release()
+        return dirtyWidgets
+
+    def startTrackingChanges(self, widget):
+        # Return True if markDirty will now be called whenever the widget's state might change.
+        # By default we don't know about any changes, so widgets are always polled
+        return False
+
+    def isChangeTracked(self, widget):
+        tracked = self.changeTracking.get(widget)
+        if tracked is None:
+            tracked = self.changeTracking[widget] = self.startTrackingChanges(widget)
+            if tracked:
+                self.trackedWidgets.add(widget)
+            # Anything could have happened before we started tracking it
+            self.markDirty(widget)
+        return tracked
+
+    def findWidgetsToCheck(self, dirtyWidgets):
+        if self.stateChangeMode == "dirty":
+            # Widgets we haven't tried to track yet are checked, and the attempt made, in findStateChanges
+            allWidgets = self.widgetsWithState.keys()
+            toCheck = dirtyWidgets.union(self.trackedWidgets.getUnknown(allWidgets))
+            return [ (widget, self.widgetsWithState[widget]) for widget in allWidgets if widget in toCheck ]
+        else:
+            return self.widgetsWithState.items()
+
+    def reportMissedChange(self, widget, oldState, state):
+        sys.stderr.write("WARNING: no change was reported for " + widget.__class__.__name__ + " widget, whose state changed from " +
+                         repr(oldState) + " to " + repr(state) + "\n")
+
     def findStateChanges(self, *args):
         defunctWidgets = []
         stateChanges = []
-        for widget, oldState in self.widgetsWithState.items():
+        dirtyWidgets = self.takeDirtyWidgets() if self.stateChangeMode != "poll" else set()
+        for widget, oldState in self.findWidgetsToCheck(dirtyWidgets):
             if not self.shouldCheckForUpdates(widget, *args):
+                if widget in dirtyWidgets:
+                    self.markDirty(widget) # for when we do check it
                 continue
             
             try:
@@ -1166,12 +1991,19 @@ class Describer(object):
                 defunctWidgets.append(widget)
                 continue
 
+            if self.stateChangeMode == "verify" and state != oldState and \
+                   widget in self.trackedWidgets and widget not in dirtyWidgets:
+                self.reportMissedChange(widget, oldState, state)
+            if self.stateChangeMode != "poll":
+                self.isChangeTracked(widget)
             if state != oldState:
                 stateChanges.append((widget, oldState, state))
                 self.widgetsWithState[widget] = state
             
         for widget in defunctWidgets:
             del self.widgetsWithState[widget]
+            self.changeTracking.pop(widget, None)
+            self.trackedWidgets.discard(widget)
         return stateChanges
 
     def shouldCheckForUpdates(self, *args):
@@ -1234,22 +2066,45 @@ class Describer(object):
     def describeClass(cls, className):
         return cls.excludeClassNames.get(className) != []
     
+    @classmethod
+    def describedClassesChanged(cls):
+        # Call whenever stateWidgets, statelessWidgets, ignoreWidgets or excludeClassNames are changed
+        Describer.dispatchGeneration += 1
+
+    def getDispatchCache(self):
+        # How to describe each class of widget, see findDescriptionMethodName and findStateMethodName
+        if self.dispatchCache is None or self.dispatchCacheGeneration != Describer.dispatchGeneration:
+            self.dispatchCache = {}
+            self.dispatchCacheGeneration = Describer.dispatchGeneration
+        return self.dispatchCache
+
     def getWidgetDescription(self, widget):
+        dispatchCache = self.getDispatchCache()
+        key = "description", widget.__class__
+        if key not in dispatchCache:
+            dispatchCache[key] = self.findDescriptionMethodName(widget)
+        methodName = dispatchCache[key]
+        if methodName:
+            return getattr(self, methodName)(widget)
+        elif methodName is None:
+            return self.widgetTypeDescription(widget.__class__.__name__) # pragma: no cover - should be unreachable
+        else:
+            return ""
+
+    def findDescriptionMethodName(self, widget):
+        # Returns "" for widgets we don't describe, None for those we don't know about
         for widgetClass in self.stateWidgets + self.statelessWidgets:
             if isinstance(widget, widgetClass):
                 describeClassName = widgetClass.__name__
                 actualClassName = widget.__class__.__name__
                 if self.describeClass(describeClassName) and self.describeClass(actualClassName):
-                    methodName = "get" + describeClassName.replace("$", "") + "Description"
-                    return getattr(self, methodName)(widget)
+                    return "get" + describeClassName.replace("$", "") + "Description"
                 else:
                     return ""
 
         for widgetClass in self.ignoreWidgets:
             if isinstance(widget, widgetClass):
                 return ""
-        
-        return self.widgetTypeDescription(widget.__class__.__name__) # pragma: no cover - should be unreachable
 
     def widgetTypeDescription(self, typeName): # pragma: no cover - should be unreachable
         return "A widget of type '" + typeName + "'" 
@@ -1259,11 +2114,20 @@ class Describer(object):
         return state.strip()
 
     def getSpecificState(self, widget):
+        dispatchCache = self.getDispatchCache()
+        key = "state", widget.__class__
+        if key not in dispatchCache:
+            dispatchCache[key] = self.findStateMethodName(widget)
+        methodName = dispatchCache[key]
+        if methodName:
+            return getattr(self, methodName)(widget)
+        else:
+            return ""
+
+    def findStateMethodName(self, widget):
         for widgetClass in self.stateWidgets:
             if isinstance(widget, widgetClass):
-                methodName = "get" + widgetClass.__name__ + "State"
-                return getattr(self, methodName)(widget)
-        return ""
+                return "get" + widgetClass.__name__ + "State"
 
     def addMultilineData(self, elements, rows, separator=""):
         for elIx, el in enumerate(elements):
@@ -1594,7 +2458,9 @@ class Describer(object):
         return "'" + oldRow.strip() + "'" +  " changed to " + "'" + newRow.strip() + "'"
 
 class Indexer:
-    allIndexers = {}
+    # Not capped: indexers connect listeners to their widgets and remember the names they have given out,
+    # so one made again would give different names while the old one would go on listening
+    allIndexers = WidgetRegistry("Indexer.allIndexers", capped=False)
     def __init__(self, widget):
         self.widget = widget
         self.logger = logging.getLogger("Indexer")
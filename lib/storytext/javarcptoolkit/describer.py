@@ -9,6 +9,7 @@ from org.eclipse.ui.internal import WorkbenchImages, IWorkbenchGraphicConstants
 class Describer(swtdescriber.Describer):
     swtdescriber.Describer.stateWidgets = [ ExpandableComposite ] + swtdescriber.Describer.stateWidgets
     swtdescriber.Describer.ignoreChildren = (ExpandableComposite,) + swtdescriber.Describer.ignoreChildren
+    swtdescriber.Describer.describedClassesChanged()
     def buildImages(self):
         swtdescriber.Describer.buildImages(self)
         self.buildImagesFromBundles()
@@ -26,6 +27,7 @@ class Describer(swtdescriber.Describer):
         for bundle in InternalPlatform.getDefault().getBundleContext().getBundles():
             usedTypes = []
             name = bundle.getSymbolicName()
+            cacheFile = self.imageDescriber.openCacheFile("bundle " + name)
             imageTypes = bundleImageTypes.get(name, allImageTypes)
             if name not in bundleImageTypes:
                 self.logger.debug("Bundle " + name + " not cached, trying all image types!")
@@ -33,8 +35,10 @@ class Describer(swtdescriber.Describer):
                 self.logger.debug("Searching bundle " + name + " for images of type " + imageType)
                 images = bundle.findEntries("/", "*." + imageType, True)
                 if images and images.hasMoreElements():
-                    self.storeAllImages(images)
+                    self.storeAllImages(images, cacheFile, self.getBundleStamp(bundle))
                     usedTypes.append(imageType)
+            if cacheFile:
+                cacheFile.save()
             if writeCache:
                 bundleImageTypes[name] = usedTypes
         if writeCache:
@@ -42,11 +46,15 @@ class Describer(swtdescriber.Describer):
             pprint(bundleImageTypes, f)
             f.close()
 
-    def storeAllImages(self, entries):
+    def getBundleStamp(self, bundle):
+        # Images in bundles can only change when the bundle is updated
+        return str(bundle.getVersion()), bundle.getLastModified()
+
+    def storeAllImages(self, entries, cacheFile=None, stamp=None):
         while entries.hasMoreElements():
             url = entries.nextElement()
             self.logger.debug("Storing image data for file " + str(url) + " from bundles.")
-            self.imageDescriber.storeImageData(url)
+            self.imageDescriber.storeImageData(url, cacheFile, url.getPath(), stamp)
                         
     def getExpandableCompositeState(self, widget):
         return widget.isExpanded()
@@ -1,8 +1,10 @@
 import storytext.guishared, time, os, threading, sys
 import simulator, describer, util
+from storytext.registries import WidgetRegistry
 
 from java.awt import Frame, AWTEvent, Toolkit
-from java.awt.event import AWTEventListener, ComponentEvent, ContainerEvent
+from java.awt.event import AWTEventListener, ComponentEvent, ContainerEvent, HierarchyEvent
+from java.beans import PropertyChangeListener
 from java.lang import Thread, Runtime
 
 from javax.swing import JButton, JComboBox, JComponent, JDialog, JFrame, JList, JMenuItem, JPopupMenu, JSpinner, \
@@ -89,7 +91,15 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
         self.listenForComponents()
         self.physicalEventManager = simulator.PhysicalEventManager()
         self.physicalEventManager.startListening()
-        self.appearedWidgets = set()
+        # Widgets can be shown again after being removed, so forgetting them here would monitor them twice
+        self.appearedWidgets = WidgetRegistry("UseCaseReplayer.appearedWidgets", capped=False, forgettable=False)
+        self.enabledListener = self.makeEnabledListener()
+
+    def makeEnabledListener(self):
+        class EnabledListener(PropertyChangeListener):
+            def propertyChange(listenerSelf, event):#@NoSelf
+                self.notifyWidgetsChanged()
+        return EnabledListener()
 
     def listenForComponents(self):
         class NewComponentListener(AWTEventListener):
@@ -102,8 +112,12 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
                     storytext.guishared.catchAll(self.handleNewComponent, event.getSource())
                 elif event.getID() == ContainerEvent.COMPONENT_ADDED:
                     storytext.guishared.catchAll(self.handleNewComponent, event.getChild())
+                elif event.getID() == HierarchyEvent.HIERARCHY_CHANGED and \
+                         event.getChangeFlags() & HierarchyEvent.DISPLAYABILITY_CHANGED and not event.getComponent().isDisplayable():
+                    # Removed from its window, or the window was disposed
+                    storytext.guishared.catchAll(WidgetRegistry.forgetWidget, event.getComponent())
 
-        eventMask = AWTEvent.COMPONENT_EVENT_MASK | AWTEvent.CONTAINER_EVENT_MASK
+        eventMask = AWTEvent.COMPONENT_EVENT_MASK | AWTEvent.CONTAINER_EVENT_MASK | AWTEvent.HIERARCHY_EVENT_MASK
         util.runOnEventDispatchThread(Toolkit.getDefaultToolkit().addAWTEventListener, NewComponentListener(), eventMask)
 
     def handleNewComponent(self, widget):
@@ -124,9 +138,12 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
                 self.setAppeared(widget.getParent())
         if self.loggerActive and (isWindow or inWindow or popupMenu):
             self.describer.setWidgetShown(widget)
+        self.notifyWidgetsChanged()
 
     def setAppeared(self, widget):
         self.appearedWidgets.add(widget)
+        if self.appearanceRetryDeadline is not None and isinstance(widget, JComponent):
+            widget.addPropertyChangeListener("enabled", self.enabledListener)
         if hasattr(widget, "getComponents"):
             for child in widget.getComponents():
                 self.setAppeared(child)
@@ -10,6 +10,8 @@ from javax.swing import JButton, JCheckBox, JComboBox, JDialog, JFileChooser, JF
 from javax.swing.plaf.basic import BasicInternalFrameTitlePane, BasicOptionPaneUI, BasicSplitPaneDivider
 from javax.swing.table import JTableHeader, TableCellRenderer
 from javax.swing.text import JTextComponent
+from javax.swing.event import ChangeListener, DocumentListener
+from java.beans import PropertyChangeListener
 
 
 class Describer(storytext.guishared.Describer):
@@ -30,6 +32,38 @@ class Describer(storytext.guishared.Describer):
         self.widgetsAppeared = []
         self.tabsDescribed = set()
         
+    def startTrackingChanges(self, widget):
+        # Things with bound properties and models we can listen to. Tables, trees, lists etc
+        # have too many ways of changing, so they are still polled
+        if not isinstance(widget, (JLabel, JButton, JTextComponent, JProgressBar)):
+            return False
+
+        class ChangeTracker(PropertyChangeListener, ChangeListener, DocumentListener):
+            def propertyChange(listenerSelf, event): #@NoSelf
+                if event.getPropertyName() == "document":
+                    event.getNewValue().addDocumentListener(listenerSelf)
+                self.markDirty(widget)
+
+            def stateChanged(listenerSelf, event): #@NoSelf
+                self.markDirty(widget)
+
+            def insertUpdate(listenerSelf, event): #@NoSelf
+                self.markDirty(widget)
+
+            def removeUpdate(listenerSelf, event): #@NoSelf
+                self.markDirty(widget)
+
+            def changedUpdate(listenerSelf, event): #@NoSelf
+                self.markDirty(widget)
+
+        tracker = ChangeTracker()
+        widget.addPropertyChangeListener(tracker)
+        if isinstance(widget, JTextComponent):
+            widget.getDocument().addDocumentListener(tracker)
+        elif not isinstance(widget, JLabel):
+            widget.addChangeListener(tracker)
+        return True
+
     def describeWithUpdates(self):
         self.logger.debug("Describing with updates...")
         stateChanges = self.findStateChanges()
@@ -384,6 +418,12 @@ class Describer(storytext.guishared.Describer):
             return icon1.getImage() == icon2.getImage()
         else:
             return storytext.guishared.Describer.imagesEqual(self, icon1, icon2)
+
+    def imagesHash(self, icon):
+        if hasattr(icon, "getImage"):
+            return hash(icon.getImage())
+        else:
+            return storytext.guishared.Describer.imagesHash(self, icon)
     
     def describeStateChangeGroups(self, widgets, stateChanges):
         for widget in widgets:
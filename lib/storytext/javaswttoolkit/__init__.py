@@ -26,6 +26,7 @@ class ScriptEngine(storytext.guishared.ScriptEngine):
 
     def importCustomEventTypesFromSimulator(self, eventTypes):
         self.eventTypes = eventTypes
+        self.eventTypesChanged()
         storytext.guishared.ScriptEngine.importCustomEventTypes(self, "storytext.javaswttoolkit.nattablesimulator", "nebula")
         storytext.guishared.ScriptEngine.importCustomEventTypes(self, "customwidgetevents") 
         
@@ -56,8 +57,11 @@ class ScriptEngine(storytext.guishared.ScriptEngine):
 
         
 class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
+    supportsSessions = True
     def __init__(self, *args, **kw):
         # Set up used for recording
+        self.monitor = None
+        self.describer = None
         storytext.guishared.ThreadedUseCaseReplayer.__init__(self, *args, **kw)
         self.setThreadCallbacks()
 
@@ -67,6 +71,27 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
         else:
             self.uiMap.scriptEngine.setTestThreadAction(self.setUpMonitoring)
 
+    def getEventWidget(self, event):
+        # Our widget adapters wrap SWTBot widgets, which wrap the SWT ones
+        return getattr(event.widget.widget, "widget", None)
+
+    def removeEvents(self, events):
+        # Events are added on the UI thread, as widgets are monitored
+        from simulator import runOnUIThread
+        runOnUIThread(storytext.guishared.ThreadedUseCaseReplayer.removeEvents, self, events)
+
+    def _parseAndProcess(self, command, *args, **kw):
+        # Each hand-off to the UI thread costs a round trip, so say how many each command needed
+        from simulator import UIThreadCalls
+        callsBefore = UIThreadCalls.count
+        try:
+            storytext.guishared.ThreadedUseCaseReplayer._parseAndProcess(self, command, *args, **kw)
+        finally:
+            calls = UIThreadCalls.count - callsBefore
+            self.logger.debug("Made " + str(calls) + " calls to the UI thread for command " + repr(command))
+            if self.tracer:
+                self.tracer.addCounter("UI thread calls", { "calls" : calls })
+
     def getMonitorClass(self):
         return self.importClass("WidgetMonitor", [ "customwidgetevents", self.__class__.__module__ + ".simulator" ])
 
@@ -95,9 +120,25 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
         # (replayer constructed before Eclipse classloader set)
         describer = self.getDescriber()
         runOnUIThread(describer.addFilters, monitor.getDisplay())
+        # Kept for resetting between usecases in a session
+        self.monitor, self.describer = monitor, describer
         def describe():
             runOnUIThread(describer.describeWithUpdates, monitor.getActiveShell)
         self.describeAndRun(describe, monitor.handleReplayFailure)
+
+    def resetSessionState(self):
+        storytext.guishared.ThreadedUseCaseReplayer.resetSessionState(self)
+        if self.monitor:
+            from simulator import runOnUIThread
+            runOnUIThread(self.closeLeftoverShells)
+            runOnUIThread(self.describer.resetSession)
+
+    def closeLeftoverShells(self):
+        # Dialogs and the like left open by the previous usecase. Top-level windows are part of the application
+        for shell in reversed(self.monitor.getDisplay().getShells()):
+            if not shell.isDisposed() and shell.getParent() is not None:
+                self.logger.debug("Closing shell " + repr(shell.getText()) + " left open by previous usecase")
+                shell.close()
         
     def shouldReraise(self, e, clsName, modNames):
         msg = str(e).strip()
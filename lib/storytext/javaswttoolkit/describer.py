@@ -2,14 +2,15 @@
 import storytext.guishared, util, types, logging, sys, os
 from storytext.definitions import UseCaseScriptError
 from storytext.gridformatter import GridFormatter
+from storytext.registries import WidgetRegistry
 
 
 from browserhtmlparser import BrowserHtmlParser
-from java.util import Date
+from imagecache import ImageCache
+from java.util import Arrays, Date
 from java.io import File, FilenameFilter
 
 from array import array
-from ordereddict import OrderedDict
 
 from org.eclipse.jface.resource import ImageDescriptor
 
@@ -89,69 +90,184 @@ class ColorNameFinder:
         
 colorNameFinder = ColorNameFinder()
 
+# Image data we know the name of, along with its fingerprints, see ImageDescriber.getFingerprint.
+# When those came from the image cache, the data is only loaded from the URL if we need to compare it
+class KnownImage:
+    def __init__(self, data=None, url=None, size=None, fingerprints={}):
+        self.data = data
+        self.url = url
+        self.size = size or (data.width, data.height)
+        self.fingerprints = dict(fingerprints)
+
+    def getData(self):
+        if self.data is None and self.url is not None:
+            self.data = loadImageData(self.url)
+            self.url = None # Don't try again if it can't be loaded
+        return self.data
+
+
+def loadImageData(url):
+    imgDesc = ImageDescriptor.createFromURL(url)
+    if imgDesc is not None:
+        newImage = imgDesc.createImage()
+        try:
+            return newImage.getImageData()
+        finally:
+            newImage.dispose()
+
+
+# Finds names for images by comparing their pixel data with that of the images we know about.
+# Comparing with every known image of the same size is slow when there are thousands of them,
+# so they are indexed by a hash of their data and we only compare with those whose hash matches.
+# How data is compared depends on the image, see imageDataMatches, so each way has its own index.
+# Each index is built when first needed. Greyed out images are costly to make, so are only made for the
+# stored images of the same size as one we couldn't otherwise find. What we know about the stored images
+# is cached between runs, see imagecache.py, so that they don't all need decoding at startup
 class ImageDescriber:
     systemIcons = [(SWT.ICON_CANCEL, "cancel"), (SWT.ICON_ERROR, "error"), (SWT.ICON_INFORMATION, "information"), 
                    (SWT.ICON_QUESTION, "question"), (SWT.ICON_SEARCH, "search"), (SWT.ICON_WARNING, "warning"), (SWT.ICON_WORKING, "working")]
 
     def __init__(self):
-        self.storedImages = {}
-        self.imageToName = {}
+        self.storedImageNames = set()
+        self.storedImages = []
+        self.storedImagesBySize = {}
+        self.systemImages = None
         self.renderedImages = []
+        self.imageIndex = {}
+        self.imagesIndexed = {}
+        self.imageToName = WidgetRegistry("ImageDescriber.imageToName")
+        self.imageCache = ImageCache.create()
         
     def addRenderedImage(self, image, name):
-        self.renderedImages.append((image, name))
+        self.renderedImages.append((name, KnownImage(image.getImageData())))
                 
     def getPixels(self, data):
         pixels = array('i', (0, ) * data.width * data.height)
         data.getPixels(0, 0, data.width * data.height, pixels, 0)
         return pixels
 
+    def hasExcessData(self, data):
+        return data.width * data.depth / 8 < data.bytesPerLine
+
     def imageDataMatches(self, data, data2, hasExcessData):
         if hasExcessData:
             return self.getPixels(data) == self.getPixels(data2)
         else:
             return data.data == data2.data
 
+    def getFingerprint(self, data, hasExcessData):
+        values = self.getPixels(data) if hasExcessData else data.data
+        return data.width, data.height, Arrays.hashCode(values)
+
+    def getKnownImageFingerprint(self, image, hasExcessData):
+        if hasExcessData not in image.fingerprints:
+            image.fingerprints[hasExcessData] = self.getFingerprint(image.getData(), hasExcessData)
+        return image.fingerprints[hasExcessData]
+
+    def getSystemImages(self):
+        if self.systemImages is None:
+            self.systemImages = []
+            for iconId, iconName in self.systemIcons:
+                iconImage = Display.getCurrent().getSystemImage(iconId)
+                if iconImage:
+                    self.systemImages.append((iconName, KnownImage(iconImage.getImageData())))
+        return self.systemImages
+
+    def makeGreyedImage(self, knownImage):
+        data = knownImage.getData()
+        if data is None:
+            return
+        image = Image(Display.getCurrent(), data)
+        greyedImage = Image(Display.getCurrent(), image, SWT.IMAGE_GRAY)
+        try:
+            return KnownImage(greyedImage.getImageData())
+        finally:
+            greyedImage.dispose()
+            image.dispose()
+
+    def indexImages(self, kind, images, hasExcessData, makeImage=None):
+        # Indexes any images added since we last looked. If hasExcessData is None, compare as each image requires
+        indexed = self.imagesIndexed.get((kind, hasExcessData), 0)
+        for position in range(indexed, len(images)):
+            name, image = images[position]
+            if makeImage:
+                image = makeImage(image)
+                if image is None:
+                    continue
+            imageHasExcess = self.hasExcessData(image.getData()) if hasExcessData is None else hasExcessData
+            key = kind, imageHasExcess, self.getKnownImageFingerprint(image, imageHasExcess)
+            self.imageIndex.setdefault(key, []).append((position, name, image))
+        self.imagesIndexed[kind, hasExcessData] = len(images)
+
+    def findIndexedImage(self, kind, data, excessDataOptions, fingerprints):
+        # Hashes can clash, so check the data really matches. If several do, the first one added wins
+        matches = []
+        for hasExcessData in excessDataOptions:
+            if hasExcessData not in fingerprints:
+                fingerprints[hasExcessData] = self.getFingerprint(data, hasExcessData)
+            key = kind, hasExcessData, fingerprints[hasExcessData]
+            for position, name, image in self.imageIndex.get(key, []):
+                imgData = image.getData()
+                if imgData is not None and self.imageDataMatches(data, imgData, hasExcessData):
+                    matches.append((position, name))
+        if matches:
+            return min(matches)[1]
+
     def getImageName(self, image):
         name = self.imageToName.get(image)
+        if name is None:
+            name = self.findImageName(image.getImageData())
+            if name is not None:
+                self.imageToName[image] = name
+        return name
+
+    def findImageName(self, data):
+        hasExcessData = self.hasExcessData(data)
+        fingerprints = {}
+        self.indexImages("stored", self.storedImages, hasExcessData)
+        name = self.findIndexedImage("stored", data, [ hasExcessData ], fingerprints)
+        if name is not None:
+            return os.path.basename(name)
+        self.indexImages("system", self.getSystemImages(), hasExcessData)
+        name = self.findIndexedImage("system", data, [ hasExcessData ], fingerprints)
+        if name is not None:
+            return "system_" + name
+        self.indexImages("rendered", self.renderedImages, hasExcessData)
+        name = self.findIndexedImage("rendered", data, [ hasExcessData ], fingerprints)
         if name is not None:
-            return name
-
-        data = image.getImageData()
-        hasExcessData = data.width * data.depth / 8 < data.bytesPerLine
-        imageDict = self.storedImages.get((data.width, data.height), {})
-        for name, imgData in imageDict.items():
-            if self.imageDataMatches(data, imgData, hasExcessData):
-                baseName = os.path.basename(name)
-                self.imageToName[image] = baseName             
-                return baseName
-        for iconId, iconName in self.systemIcons:
-            iconImage = Display.getCurrent().getSystemImage(iconId)
-            if iconImage and self.imageDataMatches(data, iconImage.getImageData(), hasExcessData):
-                return "system_" + iconName
-        for img, imgName in self.renderedImages:
-            if self.imageDataMatches(data, img.getImageData(), hasExcessData):
-                return "rendered_" + imgName
-        # Last chance, see if the image has been greyed out 
-        for name, imgData in imageDict.items():
-            greyedImg = Image(Display.getCurrent(), Image(Display.getCurrent(), imgData), SWT.IMAGE_GRAY)
-            greyedData = greyedImg.getImageData()
-            hasGreyedExcessData = greyedData.width * greyedData.depth / 8 < greyedData.bytesPerLine
-            if self.imageDataMatches(data, greyedData, hasGreyedExcessData):
-                greyedName =  os.path.basename(name) + "', 'greyed out"
-                self.imageToName[image] = greyedName             
-                return greyedName
+            return "rendered_" + name
+        # Last chance, see if the image has been greyed out. These are compared as the greyed out image requires
+        size = data.width, data.height
+        self.indexImages(("greyed", size), self.storedImagesBySize.get(size, []), None, self.makeGreyedImage)
+        name = self.findIndexedImage(("greyed", size), data, [ False, True ], fingerprints)
+        if name is not None:
+            return os.path.basename(name) + "', 'greyed out"
        
-    def storeImageData(self, url):
-        imgDesc = ImageDescriptor.createFromURL(url)
+    def openCacheFile(self, source):
+        if self.imageCache:
+            return self.imageCache.open(source)
+
+    def storeImageData(self, url, cacheFile=None, cacheKey=None, stamp=None):
+        # If the cache knows the image, we don't load it until we need to compare its data
+        info = cacheFile and cacheFile.get(cacheKey, stamp)
+        if info:
+            width, height, fingerprints = info
+            image = KnownImage(url=url, size=(width, height), fingerprints=fingerprints)
+        else:
+            data = loadImageData(url)
+            if data is None:
+                return
+            image = KnownImage(data)
+            for hasExcessData in [ False, True ]:
+                self.getKnownImageFingerprint(image, hasExcessData)
+            if cacheFile:
+                cacheFile.set(cacheKey, stamp, (data.width, data.height, image.fingerprints))
         name = url.getFile()
-        if imgDesc is not None:
-            newImage = imgDesc.createImage()
-            data = newImage.getImageData()
-            imageDict = self.storedImages.setdefault((data.width, data.height), OrderedDict())
-            if name not in imageDict:
-                imageDict[name] = data
-            newImage.dispose()
+        key = image.size + (name,)
+        if key not in self.storedImageNames:
+            self.storedImageNames.add(key)
+            self.storedImages.append((name, image))
+            self.storedImagesBySize.setdefault(image.size, []).append((name, image))
 
 
 class Describer(storytext.guishared.Describer):
@@ -180,19 +296,31 @@ class Describer(storytext.guishared.Describer):
         storytext.guishared.Describer.__init__(self)
         self.canvasCounter = storytext.guishared.WidgetCounter()
         self.contextMenuCounter = storytext.guishared.WidgetCounter(self.contextMenusEqual)
-        self.customTooltipCounter = storytext.guishared.WidgetCounter(self.tooltipsEqual)
+        self.customTooltipCounter = storytext.guishared.WidgetCounter(self.tooltipsEqual, self.tooltipsHash)
         self.widgetsAppeared = []
         self.widgetsMoved = []
         self.parentsResized = set()
-        self.widgetsDescribed = set()
+        self.widgetsDescribed = WidgetRegistry("Describer.widgetsDescribed", capped=False)
         self.browserStates = {}
         self.clipboardText = None
         self.screenshotNumber = 0
         self.handleImages()
         self.colorsAdded = False
         self.canvasDescriberClasses = canvasDescriberClasses
-        self.tabOrders = {}
+        self.tabOrders = WidgetRegistry("Describer.tabOrders", capped=False)
         
+    def resetSession(self):
+        storytext.guishared.Describer.resetSession(self)
+        self.canvasCounter = storytext.guishared.WidgetCounter()
+        self.contextMenuCounter = storytext.guishared.WidgetCounter(self.contextMenusEqual)
+        self.customTooltipCounter = storytext.guishared.WidgetCounter(self.tooltipsEqual, self.tooltipsHash)
+        self.widgetsAppeared = []
+        self.widgetsMoved = []
+        self.parentsResized = set()
+        self.widgetsDescribed.clear()
+        self.browserStates = {}
+        self.tabOrders.clear()
+
     def handleImages(self):
         if self.imageDescriptionType:
             self.buildImages()
@@ -202,17 +330,22 @@ class Describer(storytext.guishared.Describer):
 
     def buildImagesFromPaths(self):
         for path in self.imagePaths:
-            self.findFiles(File(os.path.expandvars(path)))
+            pathAsFile = File(os.path.expandvars(path))
+            cacheFile = self.imageDescriber.openCacheFile(pathAsFile.getAbsolutePath())
+            self.findFiles(pathAsFile, cacheFile)
+            if cacheFile:
+                cacheFile.save()
     
-    def findFiles(self, pathAsFile):
+    def findFiles(self, pathAsFile, cacheFile=None):
         if pathAsFile.isFile() and self.isImageType(pathAsFile.getName()):
             path = pathAsFile.toURI().toURL()
             self.logger.debug("Storing image data for file " + str(path) + " from given path.")
-            self.imageDescriber.storeImageData(path)
+            stamp = pathAsFile.lastModified(), pathAsFile.length()
+            self.imageDescriber.storeImageData(path, cacheFile, pathAsFile.getAbsolutePath(), stamp)
         elif pathAsFile.isDirectory():
             for f in pathAsFile.listFiles():
                 if f is not None:
-                    self.findFiles(f)
+                    self.findFiles(f, cacheFile)
 
     def isImageType(self, fileName):
         return fileName.endswith(".gif") or fileName.endswith(".png") or fileName.endswith(".jpg")
@@ -251,6 +384,10 @@ class Describer(storytext.guishared.Describer):
         if isinstance(widget, Control):
             self.parentsResized.add(widget)
             self.parentsResized.add(widget.getParent())
+
+    def setWidgetDisposed(self, widget):
+        self.setWidgetResized(widget) # Being disposed is the ultimate resize :)
+        self.windows.discard(widget)
                     
     def addFilters(self, display):
         class ShowListener(Listener):
@@ -269,11 +406,42 @@ class Describer(storytext.guishared.Describer):
             def handleEvent(listenerSelf, e): #@NoSelf
                 storytext.guishared.catchAll(self.setWidgetResized, e.widget)
 
+        class DisposeListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                storytext.guishared.catchAll(self.setWidgetDisposed, e.widget)
+
         display.addFilter(SWT.Show, ShowListener())
         display.addFilter(SWT.Paint, PaintListener())
         display.addFilter(SWT.Move, MoveListener())
         display.addFilter(SWT.Resize, ResizeListener())
-        display.addFilter(SWT.Dispose, ResizeListener()) # Being disposed is the ultimate resize :)
+        display.addFilter(SWT.Dispose, DisposeListener())
+        if self.stateChangeMode != "poll":
+            self.addChangeFilters(display)
+
+    def addChangeFilters(self, display):
+        # Anything whose state changes is nearly always repainted, which also catches changes made by the application
+        class ChangeListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                storytext.guishared.catchAll(self.setWidgetChanged, e.widget)
+
+        class ShowHideListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                storytext.guishared.catchAll(self.setWidgetChanged, e.widget, parentChanged=True)
+
+        for eventType in [ SWT.Paint, SWT.Modify, SWT.Selection, SWT.DefaultSelection, SWT.Expand, SWT.Collapse ]:
+            display.addFilter(eventType, ChangeListener())
+        display.addFilter(SWT.Show, ShowHideListener())
+        display.addFilter(SWT.Hide, ShowHideListener())
+
+    def setWidgetChanged(self, widget, parentChanged=False):
+        if isinstance(widget, Control):
+            self.markDirty(widget)
+            if parentChanged and widget.getParent() is not None:
+                self.markDirty(widget.getParent())
+
+    def startTrackingChanges(self, widget):
+        # Shell titles and menus aren't painted by SWT, so there's nothing to tell us they changed
+        return isinstance(widget, Control) and not isinstance(widget, Shell)
 
     def getScreenshotFileName(self, screenshotDir):
         return os.path.join(screenshotDir, "screenshot" + str(self.screenshotNumber) + ".png")
@@ -511,18 +679,27 @@ class Describer(storytext.guishared.Describer):
     def getCoolBarState(self, coolbar):
         return colorNameFinder.getNameForWidget(coolbar.getBackground())
 
+    # Menu items can change, so the context menu counter has no hash method and compares with everything
+    def getContextMenuItems(self, menu):
+        return [ (item.getText(), item.getEnabled()) for item in menu.getItems() ]
+
     def contextMenusEqual(self, menu1, menu2):
-        return [ (item.getText(), item.getEnabled()) for item in menu1.getItems() ] == \
-               [ (item.getText(), item.getEnabled()) for item in menu2.getItems() ]
+        return self.getContextMenuItems(menu1) == self.getContextMenuItems(menu2)
 
     def imagesEqual(self, image1, image2):
         return image1.getImageData().data == image2.getImageData().data
 
+    def imagesHash(self, image):
+        return Arrays.hashCode(image.getImageData().data)
+
     def tooltipsEqual(self, data1, data2):
         tip1, widget1 = data1
         tip2, widget2 = data2
         return tip1 == tip2 and widget1 == widget2
 
+    def tooltipsHash(self, data):
+        return hash(data)
+
     def getCanvasDescription(self, widget):
         return self.getAndStoreState(widget)
     
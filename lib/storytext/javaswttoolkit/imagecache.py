@@ -0,0 +1,104 @@
+
+""" On-disk cache of what we need to know about the images StoryText names things after: their size
+and fingerprints, see ImageDescriber. Finding these means decoding every image in the image paths
+and, for RCP, every plugin bundle, which with tens of thousands of icons takes a while at every startup.
+With the cache, images are only decoded when a fingerprint matches one that is being described.
+There is one cache file for each image path and bundle, each entry in which is only used as long as
+the image's stamp (its modification time and size, or its bundle's version) has not changed """
+
+import os
+from storytext import privatedir
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from hashlib import md5
+except ImportError: # pragma: no cover - Python 2.4
+    from md5 import new as md5
+
+# Increase if the fingerprints or what is stored about each image change
+formatVersion = 1
+
+# The cached images from one image path or bundle. Entries that aren't looked up are dropped when saving,
+# so that images removed since don't build up
+class ImageCacheFile:
+    def __init__(self, fileName, source):
+        self.fileName = fileName
+        self.source = source
+        self.entries = self.read()
+        self.entriesUsed = {}
+        self.changed = False
+
+    def getHeader(self):
+        return formatVersion, self.source
+
+    def read(self):
+        try:
+            f = open(self.fileName, "rb")
+            try:
+                header, entries = pickle.loads(f.read())
+            finally:
+                f.close()
+        except Exception:
+            # Missing, or written by some other version: just decode the images again
+            return {}
+        if header == self.getHeader():
+            return entries
+        else:
+            return {}
+
+    def get(self, key, stamp):
+        cachedStamp, info = self.entries.get(key, (None, None))
+        if cachedStamp is not None and cachedStamp == stamp:
+            self.entriesUsed[key] = stamp, info
+            return info
+
+    def set(self, key, stamp, info):
+        self.entriesUsed[key] = stamp, info
+        self.changed = True
+
+    def save(self):
+        if not self.changed and len(self.entriesUsed) == len(self.entries):
+            return
+        # Write to a temporary file and rename it into place, so that other processes
+        # reading the cache at the same time never see a partially written file
+        tmpFile = self.fileName + "." + str(os.getpid()) + ".tmp"
+        try:
+            f = open(tmpFile, "wb")
+            try:
+                pickle.dump((self.getHeader(), self.entriesUsed), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.pathsep == ";" and os.path.exists(self.fileName): # Windows, can't rename onto an existing file
+                os.remove(self.fileName)
+            os.rename(tmpFile, self.fileName)
+        except (IOError, OSError):
+            # Not being able to cache isn't a problem, it just makes the next startup slower
+            if os.path.exists(tmpFile):
+                try:
+                    os.remove(tmpFile)
+                except OSError:
+                    pass
+
+
+class ImageCache:
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    @classmethod
+    def create(cls):
+        # Setting the variable to an empty string turns caching off.
+        # The cache is unpickled, so it is only used if nobody else can write to it
+        cacheDir = privatedir.find("STORYTEXT_IMAGE_CACHE", "image_cache")
+        if cacheDir:
+            return cls(cacheDir)
+
+    def open(self, source):
+        # source is the absolute path of an image directory, or something naming a bundle
+        if isinstance(source, unicode):
+            source = source.encode("utf-8")
+        fileName = os.path.join(self.cacheDir, md5(source).hexdigest() + ".pickle")
+        return ImageCacheFile(fileName, source)
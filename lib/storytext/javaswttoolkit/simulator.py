@@ -2,6 +2,7 @@
 import storytext.guishared, util, logging, os, time, sys
 from storytext.definitions import UseCaseScriptError
 from storytext import applicationEvent, applicationEventDelay, applicationEventRemove
+from storytext.registries import WidgetRegistry
 from difflib import SequenceMatcher
 
 from java.lang import Boolean, IllegalStateException, IndexOutOfBoundsException, RuntimeException, NullPointerException, Exception
@@ -10,12 +11,12 @@ from java.util import ArrayList
 from threading import Lock
 
 from org.eclipse.jface.bindings.keys import KeyStroke
-from org.eclipse.swt import SWT
+from org.eclipse.swt import SWT, SWTException
 from org.eclipse.swt.browser import Browser, ProgressListener
 from org.eclipse.swt.custom import  CCombo, CTabFolder, CTabFolder2Adapter
 from org.eclipse.swt.graphics import Point
-from org.eclipse.swt.widgets import Button, Combo, Control, DateTime, Event, ExpandBar, Label, Link, List, Listener, Menu, MenuItem, \
-    Shell, Spinner, Table, TableColumn, TabFolder, Text, ToolItem, Tree
+from org.eclipse.swt.widgets import Button, Combo, Control, DateTime, Display, Event, ExpandBar, Label, Link, List, Listener, Menu, \
+    MenuItem, Shell, Spinner, Table, TableColumn, TabFolder, Text, ToolItem, Tree
 
 from org.hamcrest.core import IsAnything
 
@@ -40,7 +41,20 @@ class PythonResult(Result):
     def run(self):
         return self.method(*self.args)
 
+# Counts the times we've had to wait for the UI thread, which is most of the cost of talking to SWT.
+# Calls made on the UI thread itself run straight away, so aren't counted. Other threads may call at the same time
+class UIThreadCalls:
+    count = 0
+    lock = Lock()
+    @classmethod
+    def increment(cls):
+        cls.lock.acquire()
+        cls.count += 1
+        cls.lock.release()
+
 def runOnUIThread(method, *args):
+    if Display.getCurrent() is None:
+        UIThreadCalls.increment()
     try:
         return UIThreadRunnable.syncExec(PythonResult(method, args))
     except IllegalStateException:
@@ -51,8 +65,59 @@ def runOnUIThread(method, *args):
         e.printStackTrace()
         raise
 
+# Collects queries about widgets so that they can all be made with one trip to the UI thread,
+# rather than one each, which adds up when monitoring a whole shell. Each query is stored in the
+# snapshot under the key it was added with. Queries on widgets disposed in the meantime give the default
+# instead, as do any that fail unexpectedly, after reporting why
+class UIThreadQuery:
+    def __init__(self):
+        self.queries = []
+
+    def add(self, key, method, *args, **kw):
+        self.queries.append((key, method, args, kw.get("default")))
+
+    def makeQueries(self):
+        results = {}
+        for key, method, args, default in self.queries:
+            try:
+                results[key] = method(*args)
+            except WidgetNotFoundException:
+                results[key] = default
+            except SWTException, e:
+                if e.code != SWT.ERROR_WIDGET_DISPOSED:
+                    self.reportError()
+                results[key] = default
+            except (RuntimeException, StandardError):
+                self.reportError()
+                results[key] = default
+        return results
+
+    def reportError(self):
+        sys.stderr.write("ERROR: failed to query widget, ignoring it:\n" + storytext.guishared.getExceptionString() + "\n")
+
+    def run(self):
+        if self.queries:
+            return UIThreadSnapshot(runOnUIThread(self.makeQueries))
+        else:
+            return UIThreadSnapshot({})
+
+
+class UIThreadSnapshot:
+    def __init__(self, results):
+        self.results = results
+
+    def __getattr__(self, name):
+        try:
+            return self.results[name]
+        except KeyError:
+            raise AttributeError, name
+
+    def get(self, key, default=None):
+        return self.results.get(key, default)
+
+
 class WidgetAdapter(storytext.guishared.WidgetAdapter):
-    popupMenuContexts = {}
+    popupMenuContexts = WidgetRegistry("WidgetAdapter.popupMenuContexts", refreshOnLookup=True)
     contextFinders = []
     def getChildWidgets(self):
         return [] # don't use this...
@@ -100,6 +165,10 @@ class WidgetAdapter(storytext.guishared.WidgetAdapter):
         return data.getAction().getId() if hasattr(data, "getAction") else ""
     
     def findPossibleUIMapIdentifiers(self):
+        # Finding each identifier needs the UI thread, so find them all with one trip there
+        return runOnUIThread(self.findIdentifiersOnUIThread)
+
+    def findIdentifiersOnUIThread(self):
         ids = storytext.guishared.WidgetAdapter.findPossibleUIMapIdentifiers(self)
         actionId = self.getActionId()
         if actionId:
@@ -134,7 +203,7 @@ class WidgetAdapter(storytext.guishared.WidgetAdapter):
         if widget:
             adapter = WidgetMonitor.makeAdapter(widget)
             if adapter:
-                return adapter.findPossibleUIMapIdentifiers()[0].replace("Label=", "").replace("=", ":")
+                return adapter.getUIMapIdentifier().replace("Label=", "").replace("=", ":")
             
         return "Popup Menu"
     
@@ -224,6 +293,18 @@ class SignalEvent(storytext.guishared.GuiEvent):
         # If there are events for other shells, implies we should delay as we're in a dialog
         return DisplayFilter.instance.otherEventCount(event, self.isTriggeringEvent)
 
+    def checkWidgetStatus(self):
+        # The checks all need the UI thread, so make them all with one trip there
+        error = runOnUIThread(self.findWidgetStatusError)
+        if error:
+            raise error
+
+    def findWidgetStatusError(self):
+        try:
+            storytext.guishared.GuiEvent.checkWidgetStatus(self)
+        except UseCaseScriptError, e:
+            return e
+
     def widgetDisposed(self):
         return runOnUIThread(self.widget.widget.widget.isDisposed)
 
@@ -1346,7 +1427,7 @@ class DisplayFilter:
         self.widgetEventTypes = widgetEventTypes
         self.eventsFromUser = []
         self.delayedAppEvents = []
-        self.itemTextCache = {}
+        self.itemTextCache = WidgetRegistry("DisplayFilter.itemTextCache", refreshOnLookup=True)
         self.logger = logging.getLogger("storytext record")
         DisplayFilter.instance = self
         
@@ -1615,8 +1696,8 @@ class WidgetMonitor:
                   }
     def __init__(self, uiMap):
         self.bot = self.createSwtBot()
-        self.widgetsMonitored = set()
-        self.allMenus = set()
+        self.widgetsMonitored = WidgetRegistry("WidgetMonitor.widgetsMonitored", capped=False)
+        self.allMenus = WidgetRegistry("WidgetMonitor.allMenus", capped=False)
         self.uiMap = uiMap
         # Do this here, when things will be loaded with the right classloader
         # Might affect which event types are used. Has to be set up like this so RCP works.
@@ -1715,6 +1796,19 @@ class WidgetMonitor:
         runOnUIThread(display.addFilter, SWT.Show, monitorListener)
         runOnUIThread(display.addFilter, SWT.Paint, monitorListener)
         runOnUIThread(display.addFilter, SWT.Selection, monitorListener)
+
+        class DisposeListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                storytext.guishared.catchAll(self.widgetDisposed, e.widget)
+
+        runOnUIThread(display.addFilter, SWT.Dispose, DisposeListener())
+
+    def widgetDisposed(self, widget):
+        # Disposed widgets never come back, so we can forget we monitored them too
+        WidgetRegistry.forgetWidget(widget)
+        for registry in [ self.widgetsMonitored, self.allMenus, self.uiMap.windows ]:
+            registry.discard(widget)
+        self.uiMap.scriptEngine.replayer.widgetGone(widget)
         
     def widgetShown(self, e):
         if self.shouldMonitor(e.widget):
@@ -1722,6 +1816,12 @@ class WidgetMonitor:
                 e.widget.addListener(e.type, EventFinishedListener(e, self.monitorWidgetsFromEvent))
             else:
                 self.monitorNewWidgets(e.widget, e.type == SWT.Show)
+        elif e.type == SWT.Paint:
+            # No SWT event for enabling widgets, but they get repainted when it happens
+            self.notifyReplayerWidgetsChanged()
+
+    def notifyReplayerWidgetsChanged(self):
+        self.uiMap.scriptEngine.replayer.notifyWidgetsChanged()
             
     def shouldMonitor(self, widget):
         # Don't try to monitor widgets before the shells they appear in!
@@ -1746,7 +1846,8 @@ class WidgetMonitor:
             self.allMenus.add(parent)
         self.monitorAllWidgets(widgets)
         self.uiMap.logger.debug("Done Monitoring all widgets after showing/painting " + 
-                                parent.__class__.__name__ + " " + str(id(parent)) + ".")
+                                parent.__class__.__name__ + " " + str(id(parent)) + ", " +
+                                storytext.guishared.WidgetAdapter.getIdentifierStatistics() + " so far.")
         
     def findDescendants(self, widget):
         if isinstance(widget, Menu):
@@ -1778,9 +1879,19 @@ class WidgetMonitor:
             self.widgetsMonitored.update(newWidgets)
         finally:
             self.widgetMonitorLock.release()
-        for widget in self.makeAdapters(newWidgets):
+        adapters = self.makeAdapters(newWidgets)
+        # Identifying a widget makes many queries on the UI thread, so identify them all in one go
+        query = UIThreadQuery()
+        for i, adapter in enumerate(adapters):
+            query.add(i, adapter.findIdentifiersOnUIThread)
+        snapshot = query.run()
+        for i, widget in enumerate(adapters):
+            # Kept only while it's monitored, see guishared.WidgetAdapter
+            widget.setUIMapIdentifiers(snapshot.get(i))
             self.uiMap.monitorWidget(widget)
             self.monitorAsynchronousUpdates(widget)
+        if newWidgets:
+            self.notifyReplayerWidgetsChanged()
 
     def monitorAsynchronousUpdates(self, widget):
         # Browsers load their stuff in the background, must wait for them to finish
@@ -1832,26 +1943,33 @@ class WidgetMonitor:
         return menus
 
     @classmethod
-    def findSwtbotClass(cls, widget, widgetClass):
+    def findSwtbotClass(cls, widget, widgetClass, style=None):
         defaultClass, styleClasses = cls.swtbotMap.get(widgetClass)
         for currStyle, styleClass in styleClasses:
-            if runOnUIThread(widget.getStyle) & currStyle:
+            if style is None:
+                style = runOnUIThread(widget.getStyle)
+            if style & currStyle:
                 return styleClass
         return defaultClass
 
     def makeAdapters(self, widgets):
+        # Find all the styles we need with one trip to the UI thread
+        query = UIThreadQuery()
+        for widget in widgets:
+            query.add(widget, widget.getStyle)
+        styles = query.run()
         adapters = []
         for widget in widgets:
-            adapter = self.makeAdapter(widget, self.uiMap.logger)
+            adapter = self.makeAdapter(widget, self.uiMap.logger, styles.get(widget))
             if adapter:
                 adapters.append(adapter)
         return adapters
 
     @classmethod
-    def makeAdapter(cls, widget, logger=None):
+    def makeAdapter(cls, widget, logger=None, style=None):
         for widgetClass in cls.swtbotMap.keys():
             if isinstance(widget, widgetClass):
-                swtbotClass = cls.findSwtbotClass(widget, widgetClass)
+                swtbotClass = cls.findSwtbotClass(widget, widgetClass, style)
                 try:
                     return WidgetAdapter.adapt(swtbotClass(widget))
                 except RuntimeException, e:
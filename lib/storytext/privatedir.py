@@ -0,0 +1,44 @@
+""" Directories where StoryText keeps files between runs: caches of parsed files and recording journals.
+Later runs load what is in them, so each directory must belong to the current user and be writable by
+nobody else. Otherwise another user could plant a file there that runs code or writes usecases in our name. """
+
+import os, sys, stat, tempfile
+
+checkedDirs = {}
+
+# The default is in the local temporary directory, named after the user so that users don't collide
+def getDefault(name):
+    userName = os.getenv("USER", os.getenv("USERNAME", ""))
+    return os.path.join(tempfile.gettempdir(), "storytext_" + name + "_" + userName)
+
+def find(envVar, name):
+    # Setting the variable to an empty string turns the feature off
+    dirName = os.getenv(envVar)
+    if dirName is None:
+        dirName = getDefault(name)
+    if dirName and makePrivate(dirName):
+        return dirName
+
+def makePrivate(dirName):
+    # Creates the directory only we can use, or checks that an existing one is like that
+    if dirName not in checkedDirs:
+        checkedDirs[dirName] = checkPrivate(dirName)
+    return checkedDirs[dirName]
+
+def checkPrivate(dirName):
+    try:
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName, 0700)
+        if not hasattr(os, "getuid"): # Windows, where the temporary directory belongs to the user anyway
+            return True
+        statInfo = os.stat(dirName)
+    except OSError:
+        return False
+    if statInfo.st_uid != os.getuid():
+        problem = "it belongs to another user"
+    elif statInfo.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        problem = "other users can write to it"
+    else:
+        return True
+    sys.stderr.write("WARNING: not using the directory at " + repr(dirName) + ", as " + problem + ".\n")
+    return False
@@ -1,10 +1,11 @@
 
 """ Generic recorder classes. GUI-specific stuff is in guishared.py """
 
-import os, sys, signal, logging
+import os, sys, signal, logging, atexit, time, errno, shutil
 from copy import copy
-import replayer, encodingutils
+import replayer, encodingutils, privatedir
 from definitions import *
+from scheduler import ReplayScheduler
 from threading import Lock
 
 try:
@@ -12,24 +13,258 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
-# This function has been copied from stackoverflow. It finds all partitions of a set.
-def partitions(set_):
-    if not set_:
-        yield []
-        return
-    for i in xrange(2**len(set_)/2):
-        parts = [set(), set()]
-        for item in set_:
-            parts[i&1].add(item)
-            i >>= 1
-        for b in partitions(parts[1]):
-            yield [parts[0]]+b
+try:
+    from hashlib import md5
+except ImportError: # pragma: no cover - Python 2.4
+    from md5 import new as md5
+
+try:
+    import fcntl
+except ImportError: # Windows, Jython
+    fcntl = None
+
+# When recorded lines are written to the usecase file: see the --record-flush option.
+# The default is to flush every line as soon as it's recorded.
+class RecordFlushPolicy:
+    def __init__(self, text=""):
+        self.everyLine = not text or text == "line"
+        self.onWait = False
+        self.maxSize = None
+        self.delay = None
+        if not self.everyLine:
+            for part in text.split(","):
+                self.parsePart(part.strip(), text)
+
+    @classmethod
+    def fromEnvironment(cls):
+        return cls(os.getenv("USECASE_RECORD_FLUSH", ""))
+
+    def parsePart(self, part, text):
+        try:
+            if part == "wait":
+                self.onWait = True
+                return
+            elif part.startswith("size:"):
+                self.maxSize = int(part[5:])
+                return
+            elif part.startswith("time:"):
+                self.delay = float(part[5:])
+                return
+        except ValueError:
+            pass
+        raise UseCaseScriptError, "ERROR: could not parse record flush policy " + repr(text) + \
+              ", should be 'line' or a comma-separated list of 'wait', 'size:BYTES' and 'time:SECONDS'"
+
+    def shouldFlush(self, line, bufferedSize):
+        return self.everyLine or (self.onWait and line.startswith(waitCommandName)) or \
+               (self.maxSize is not None and bufferedSize >= self.maxSize)
+
+
+# Writes recorded lines to a usecase file, buffering them according to the flush policy.
+# Flushing can be slow on network file systems, hence the buffering. Buffered lines are also
+# appended to a journal in the local temporary directory, which is removed once they are flushed:
+# if the process dies before it can flush them, they are recovered by the next recorder to start.
+# The journal is locked while its process lives, and records which file it belongs to and that file's
+# inode and size, so that the lines are only recovered to the file that they were missing from.
+class RecordFileWriter:
+    journalDir = privatedir.getDefault("record_journals")
+    # Those with buffered lines to flush at exit
+    liveWriters = set()
+    def __init__(self, fileName, flushPolicy, mode="w"):
+        self.fileName = fileName
+        self.flushPolicy = flushPolicy
+        self.file = encodingutils.openEncoded(fileName, mode)
+        self.lock = Lock()
+        self.buffer = []
+        self.bufferedSize = 0
+        self.journalFd = None
+        self.journalFile = None
+        self.flushCall = None
+        self.flushCount = 0
+        self.flushTimes = []
+        if not flushPolicy.everyLine:
+            self.liveWriters.add(self)
+
+    def write(self, line):
+        # File is in binary mode, must use correct line ending explicitly, "\n" will be UNIX line endings on all platforms
+        text = line + os.linesep
+        self.lock.acquire()
+        try:
+            self.buffer.append(text)
+            self.bufferedSize += len(text)
+            if self.flushPolicy.shouldFlush(line, self.bufferedSize):
+                self._flush()
+            else:
+                self.writeJournal(text)
+                if self.flushPolicy.delay is not None and self.flushCall is None:
+                    self.flushCall = ReplayScheduler.getInstance().schedule(self.flushPolicy.delay, self.flush)
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        # Called from the scheduler thread for time-based flushing, as well as from the recorder
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        if self.flushCall:
+            self.flushCall.cancel()
+            self.flushCall = None
+        if not self.buffer or self.file.closed:
+            return
+        start = time.time()
+        for text in self.buffer:
+            self.file.write(text)
+        self.file.flush()
+        self.flushTimes.append(time.time() - start)
+        self.flushCount += 1
+        self.buffer = []
+        self.bufferedSize = 0
+        self.removeJournal()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._flush()
+            if not self.file.closed:
+                self.file.close()
+        finally:
+            self.lock.release()
+        self.liveWriters.discard(self)
+
+    @classmethod
+    def flushAll(cls):
+        for writer in list(cls.liveWriters):
+            writer.flush()
+
+    def getJournalFile(self):
+        path = os.path.abspath(self.fileName)
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        return os.path.join(self.journalDir, str(os.getpid()) + "_" + md5(path).hexdigest() + ".journal")
+
+    def writeJournal(self, text):
+        # Plain os.write, so the data is with the OS even if the process then dies
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        try:
+            if self.journalFd is None:
+                if not privatedir.makePrivate(self.journalDir):
+                    return
+                self.journalFile = self.getJournalFile()
+                self.journalFd = os.open(self.journalFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                if fcntl:
+                    fcntl.flock(self.journalFd, fcntl.LOCK_EX)
+                # Everything before this is flushed, so this is what the lines should be appended to
+                statInfo = os.stat(self.fileName)
+                os.write(self.journalFd, os.path.abspath(self.fileName).encode("utf-8") + "\n" + \
+                         str(statInfo.st_ino) + " " + str(statInfo.st_size) + "\n")
+            os.write(self.journalFd, text)
+        except (IOError, OSError):
+            # Not being able to journal only matters if we crash
+            self.journalFd = None
+
+    def removeJournal(self):
+        if self.journalFd is not None:
+            try:
+                os.close(self.journalFd)
+                os.remove(self.journalFile)
+            except OSError:
+                pass
+            self.journalFd = None
+
+    def getStatistics(self):
+        if self.flushTimes:
+            averageMs = 1000 * sum(self.flushTimes) / len(self.flushTimes)
+            return "Flushed " + repr(self.fileName) + " " + str(self.flushCount) + " times, average %.2f ms, longest %.2f ms" % \
+                   (averageMs, 1000 * max(self.flushTimes))
+        else:
+            return "Never flushed " + repr(self.fileName)
+
+    @classmethod
+    def recoverJournals(cls, recordedFiles=[]):
+        # Journals left by processes that no longer exist contain lines they never flushed.
+        # recordedFiles are about to be recorded afresh, which would throw away any lines recovered to them
+        if not os.path.isdir(cls.journalDir) or not privatedir.makePrivate(cls.journalDir):
+            return
+        if fcntl is None and not hasattr(os, "kill"):
+            return
+        recordedFiles = map(os.path.abspath, recordedFiles)
+        for journalName in os.listdir(cls.journalDir):
+            journalFile = os.path.join(cls.journalDir, journalName)
+            try:
+                pid = int(journalName.split("_")[0])
+                f = open(journalFile, "rb")
+                try:
+                    # Keep it locked until it's removed, so no other recorder recovers it too
+                    if cls.isAbandoned(f, pid):
+                        cls.recoverJournal(f, journalFile, pid, recordedFiles)
+                finally:
+                    f.close()
+            except (ValueError, IOError, OSError):
+                pass
+
+    @classmethod
+    def recoverJournal(cls, f, journalFile, pid, recordedFiles):
+        fileName = f.readline().rstrip("\n").decode("utf-8")
+        inode, size = map(int, f.readline().split())
+        text = f.read()
+        if text and os.path.abspath(fileName) in recordedFiles:
+            recoveredFile = fileName + ".recovered"
+            cls.appendText(recoveredFile, text)
+            sys.stderr.write("NOTE: recovered recorded lines that were never written to " + repr(fileName) + \
+                             " by process " + str(pid) + ", which seems to have crashed. As that file is being recorded again, " + \
+                             "they have been saved to " + repr(recoveredFile) + ".\n")
+        elif text and os.path.isfile(fileName):
+            statInfo = os.stat(fileName)
+            if (statInfo.st_ino, statInfo.st_size) != (inode, size):
+                sys.stderr.write("WARNING: not recovering recorded lines that were never written to " + repr(fileName) + \
+                                 " by process " + str(pid) + ", as that file has changed since. They are in " + repr(journalFile) + ".\n")
+                return
+            cls.appendText(fileName, text)
+            sys.stderr.write("NOTE: recovered recorded lines that were never written to " + repr(fileName) + \
+                             " by process " + str(pid) + ", which seems to have crashed.\n")
+        os.remove(journalFile)
+
+    @staticmethod
+    def appendText(fileName, text):
+        scriptFile = open(fileName, "ab")
+        scriptFile.write(text)
+        scriptFile.close()
+
+    @classmethod
+    def isAbandoned(cls, f, pid):
+        if fcntl:
+            # Its process holds the lock as long as it lives, even if its PID has since been reused
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                return False
+        else:
+            return not cls.isRunning(pid)
+
+    @staticmethod
+    def isRunning(pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except OSError, e:
+            return e.errno != errno.ESRCH
+
+atexit.register(RecordFileWriter.flushAll)
+
 
 # Take care not to record empty files...
 class RecordScript:
-    def __init__(self, scriptName, shortcuts):
+    def __init__(self, scriptName, shortcuts, flushPolicy=None):
         self.scriptName = scriptName
-        self.fileForAppend = None
+        self.flushPolicy = flushPolicy or RecordFlushPolicy()
+        self.writer = None
+        self.writerStatistics = None
         self.shortcutTrackers = []
         self.initShortcutManager(shortcuts)
         self.registerShortcuts()
@@ -72,34 +307,74 @@ class RecordScript:
             
         return None, None, None
     
-    def isSplittable(self, line):
-        return line.startswith(waitCommandName) and ("," in line or "*" in line)
-    
-    @staticmethod
-    def splitLine(line):
-        eventPairs = set()
+    def findPossibleSplits(self, line):
+        # Trying every split of the line is exponential in the number of events.
+        # So just look for the splits that give what the trackers are waiting for
         parsedEvents = replayer.parseWaitCommand(line)
-        for part in partitions(parsedEvents):
-            if len(part) == 2:
-                pair = frozenset([ replayer.assembleWaitCommand(part[0]), replayer.assembleWaitCommand(part[1])])
-                eventPairs.add(pair)
-
-        for i, (baseEvent, count) in enumerate(parsedEvents):
-            otherEvents = parsedEvents[:i] + parsedEvents[i+1:]
-            if count > 1:
-                for j in range(1, count):
-                    currEvent = [ (baseEvent, j) ]
-                    currOthers = otherEvents + [ (baseEvent, count - j)]
-                    parts = (replayer.assembleWaitCommand(currEvent), replayer.assembleWaitCommand(currOthers))
-                    partSet = frozenset(parts)
-                    eventPairs.add(partSet if len(partSet) == 2 else parts)
+        eventPairs = []
+        for tracker in self.shortcutTrackers:
+            if tracker.isWaitingForLastCommand():
+                eventPair = self.findSplitMatching(tracker.currRegexp, parsedEvents)
+                if eventPair and eventPair not in eventPairs:
+                    eventPairs.append(eventPair)
         return eventPairs
 
+    @staticmethod
+    def findSplitMatching(regexp, parsedEvents):
+        # Each event the regexp waits for must match a different one of the line's events, in the sorted order
+        # assembleWaitCommand gives. Either some events are taken whole, or the count of one of them is split,
+        # and then the part with it is either just that event or has all the others too.
+        # So keep the matches so far that end with the earliest event: taking whole events other than each event
+        # that could be split (or any events, for None), and splitting each of those events' counts
+        eventRegexps = replayer.ReplayScript.parseWaitRegexp(regexp.pattern)
+        if eventRegexps is None:
+            return
+        allCandidates = []
+        for eventRegexp, count in eventRegexps:
+            candidates = []
+            for i, (baseEvent, eventCount) in enumerate(parsedEvents):
+                if count <= eventCount and eventRegexp.match(baseEvent):
+                    candidates.append(((replayer.assembleWaitEvent(baseEvent, count), i), count < eventCount))
+            allCandidates.append((candidates, count))
+
+        splittable = set([ key[1] for candidates, _ in allCandidates for key, splitsCount in candidates if splitsCount ])
+        wholeMatches = dict((i, []) for i in list(splittable) + [ None ])
+        splitMatches = {}
+        for candidates, count in allCandidates:
+            newWholeMatches, newSplitMatches = {}, {}
+            for matches, newMatches, isSplit in [ (wholeMatches, newWholeMatches, False), (splitMatches, newSplitMatches, True) ]:
+                for other, match in matches.items():
+                    for key, splitsCount in candidates:
+                        i = key[1]
+                        if match and key <= match[-1][0]:
+                            continue
+                        if splitsCount and (isSplit or i != other):
+                            continue
+                        elif not splitsCount and i == other:
+                            continue
+                        target = newSplitMatches if splitsCount else newMatches
+                        if other not in target or key < target[other][-1][0]:
+                            target[other] = match + [ (key, count) ]
+            wholeMatches, splitMatches = newWholeMatches, newSplitMatches
+
+        for match, countSplit in [ (wholeMatches.get(None), False) ] + [ (m, True) for m in splitMatches.values() ]:
+            if match:
+                counts = dict((i, count) for (_, i), count in match)
+                otherEvents = [ (baseEvent, eventCount - counts.get(i, 0)) for i, (baseEvent, eventCount) in enumerate(parsedEvents)
+                                if eventCount > counts.get(i, 0) ]
+                if otherEvents and (not countSplit or len(match) == 1 or len(otherEvents) == 1):
+                    command = replayer.assembleWaitCommand([ (parsedEvents[i][0], count) for (_, i), count in match ])
+                    if regexp.match(command):
+                        return command, replayer.assembleWaitCommand(otherEvents)
+
+    def isSplittable(self, line):
+        return line.startswith(waitCommandName) and ("," in line or "*" in line)
+    
     def record(self, line):
         try:
             bestTracker = self.findCompletedTracker(line)
             if bestTracker is None and self.isSplittable(line):
-                eventPairs = self.splitLine(line)
+                eventPairs = self.findPossibleSplits(line)
                 partLine, partTracker, otherPartLine = self.findPartLineCompleting(eventPairs)
                 if partLine is not None:
                     self.recordWithTracker(partLine, partTracker)
@@ -112,11 +387,16 @@ class RecordScript:
             sys.stderr.write("ERROR: Unable to record " + repr(line) + " to file " + repr(self.scriptName) + "\n") 
     
     def _record(self, line):
-        if not self.fileForAppend:
-            self.fileForAppend = encodingutils.openEncoded(self.scriptName, "w")
-        # File is in binary mode, must use correct line ending explicitly, "\n" will be UNIX line endings on all platforms
-        self.fileForAppend.write(line + os.linesep)
-        self.fileForAppend.flush()
+        if not self.writer:
+            self.writer = RecordFileWriter(self.scriptName, self.flushPolicy)
+        self.writer.write(line)
+
+    def hasRecorded(self):
+        return self.writer is not None
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
     
     def registerShortcuts(self):
         for _, shortcut in self.shortcutManager.shortcuts:
@@ -127,11 +407,10 @@ class RecordScript:
         self.shortcutTrackers.append(ShortcutTracker(shortcut, self.shortcutManager))
     
     def unregisterShortcut(self, shortcut):
-        shortcuts = [s for s in self.shortcutManager.shortcuts]
         trackers = [t for t in self.shortcutTrackers]
-        for regexp, script in shortcuts:
+        for _, script in self.shortcutManager.shortcuts:
             if script.name == shortcut.name:
-                self.shortcutManager.shortcuts.remove((regexp,script))
+                self.shortcutManager.unregister(script)
                 break
         for tracker in trackers:
             if tracker.replayScript.name == shortcut.name:
@@ -139,20 +418,48 @@ class RecordScript:
                 break
 
     def close(self):
-        if self.fileForAppend:
-            if not self.fileForAppend.closed:
-                self.fileForAppend.close()
-            self.fileForAppend = None
+        if self.writer:
+            self.writer.close()
+            self.writerStatistics = self.writer.getStatistics()
+            self.writer = None
+
+    def getStatistics(self):
+        if self.writer:
+            return self.writer.getStatistics()
+        else:
+            return self.writerStatistics or "Nothing recorded to " + repr(self.scriptName)
 
     def rerecord(self, newCommands):
         self.close()
-        os.remove(self.scriptName)
-        for command in newCommands:
-            self._record(command)
+        if not newCommands:
+            # Nothing left to record, so no file either
+            os.remove(self.scriptName)
+            replayer.ReplayScript.parsedCache.invalidate(self.scriptName)
+            return
+        # Write the new version alongside and rename it into place, so the file is never seen half-written
+        tmpName = self.scriptName + "." + str(os.getpid()) + ".tmp"
+        try:
+            tmpFile = encodingutils.openEncoded(tmpName, "w")
+            try:
+                for command in newCommands:
+                    tmpFile.write(command + os.linesep)
+            finally:
+                tmpFile.close()
+            shutil.copymode(self.scriptName, tmpName)
+            if os.pathsep == ";": # Windows, can't rename onto an existing file
+                os.remove(self.scriptName)
+            os.rename(tmpName, self.scriptName)
+        except (IOError, OSError):
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        replayer.ReplayScript.parsedCache.invalidate(self.scriptName)
+        self.writer = RecordFileWriter(self.scriptName, self.flushPolicy, mode="a")
     
     def rename(self, newName):
         self.close()
         os.rename(self.scriptName, newName)
+        replayer.ReplayScript.parsedCache.invalidate(newName)
         self.scriptName = newName
 
 
@@ -168,7 +475,7 @@ class ShortcutTracker:
         self.reset()
 
     def reset(self):
-        self.replayScript = replayer.ReplayScript(self.replayScript.name, ignoreComments=True)
+        self.replayScript = replayer.ReplayScript.fromCache(self.replayScript.name, ignoreComments=True)
         self.currentShortcuts = []
         self.commandsForMatch = copy(self.commandsForMismatch)
         self.argsUsed = []
@@ -179,6 +486,9 @@ class ShortcutTracker:
     def hasStarted(self):
         return self.commandsForMismatch != self.commandsForMatch
 
+    def isWaitingForLastCommand(self):
+        return self.currRegexp is not None and self.isCurrentScript() and self.replayScript.hasTerminated()
+
     def updateCompletes(self, line):
         if self.currRegexp is None:
             return False # We already reached the end and should forever be ignored...
@@ -279,7 +589,7 @@ class ShortcutTracker:
         if nestedShortcut and self.replayScript.name == nestedShortcut.name:
             return None
         while  nestedShortcut:
-            newScript = replayer.ReplayScript(nestedShortcut.name, ignoreComments=True)
+            newScript = replayer.ReplayScript.fromCache(nestedShortcut.name, ignoreComments=True)
             self.visitedShortcuts.append(newScript)
             self.currentShortcuts.append(newScript)
             nestedShortcut = self.findNestedShortcut(self.currentShortcuts[-1] if not self.isCurrentScript() else self.replayScript)
@@ -295,7 +605,7 @@ class ShortcutTracker:
         return self.replayScript.getCommandRegexp()
     
     def findNestedShortcut(self, replayScript):
-        scriptCommand = replayScript.getCommand(matching=self.shortcutManager.getRegexps())
+        scriptCommand = replayScript.getCommand(matching=self.shortcutManager.getMatchers())
         if scriptCommand:
             shortcut, args = self.shortcutManager.findShortcut(scriptCommand)
             if replayScript == self.replayScript:
@@ -329,8 +639,10 @@ class UseCaseRecorder:
         self.delayedEvents = []
         self.applicationEventLock = Lock()
         self.hasAutoRecordings = False
+        self.flushPolicy = RecordFlushPolicy.fromEnvironment()
         recordScript = os.getenv("USECASE_RECORD_SCRIPT")
         if recordScript:
+            RecordFileWriter.recoverJournals([ recordScript ])
             self.addScript(recordScript, shortcuts)
             if os.pathsep != ";": # Not windows! os.name and sys.platform don't give this information if using Jython
                 self.addSignalHandlers()
@@ -351,7 +663,7 @@ class UseCaseRecorder:
         self.comments.append(comment)
 
     def addScript(self, scriptName, shortcuts=[]):
-        self.scripts.append(RecordScript(scriptName, shortcuts))
+        self.scripts.append(RecordScript(scriptName, shortcuts, self.flushPolicy))
 
     def closeScripts(self, exitHook):
         if any((c is not None for c in self.comments)):
@@ -361,6 +673,8 @@ class UseCaseRecorder:
                 self.recordComments()
         for script in self.scripts:
             script.close()
+            self.logger.debug(script.getStatistics())
+        self.logger.debug(replayer.ReplayScript.parsedCache.getStatistics())
     
     def addSignalHandlers(self):
         signal.signal = self.appRegistersSignal
@@ -388,7 +702,8 @@ class UseCaseRecorder:
 
     def terminateScript(self):
         script = self.scripts.pop()
-        if script.fileForAppend:
+        if script.hasRecorded():
+            script.flush()
             return script
 
     def recordSignal(self, signum, stackFrame):
@@ -396,6 +711,8 @@ class UseCaseRecorder:
         self.record(signalCommandName + " " + self.signalNames[signum])
         self.processDelayedEvents(self.delayedEvents)
         self.delayedEvents = []
+        for script in self.scripts:
+            script.flush()
         # Reset the handler and send the signal to ourselves again...
         realHandler = self.realSignalHandlers[signum]
         # If there was no handler-override installed, resend the signal with the handler reset
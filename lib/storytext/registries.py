@@ -0,0 +1,228 @@
+
+""" Registries of what StoryText needs to remember about each widget: its last described state,
+its indexer, whether it has been monitored, and so on. Left to themselves these keep every widget
+the application has ever shown alive for the whole run, which in long-running usecases adds up to a
+lot of memory. So the toolkits tell us when widgets are disposed or removed from their windows
+(see forgetWidget), and those whose Python objects live exactly as long as the widgets themselves
+(e.g. Tkinter) can have them referred to weakly instead. Elsewhere, such as for Java widgets in Jython,
+the Python objects can come and go while the widget is still there. Registries that only cache things
+that can be worked out again can also be capped in size via --registry-limit, and a report of how large
+each one got can be written at the end of the run via --memory-report """
+
+from gridformatter import GridFormatterWithHeader
+import os, atexit, weakref, encodingutils
+
+try:
+    from collections import OrderedDict
+except ImportError: # pragma: no cover - Python 2.5
+    from ordereddict import OrderedDict
+
+# For widgets that can't be referred to weakly, so that they can be stored alongside weak references
+class StrongReference(object):
+    __slots__ = [ "obj" ]
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __call__(self):
+        return self.obj
+
+    def __hash__(self):
+        return hash(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, StrongReference) and self.obj == other.obj
+
+
+# Behaves like a dictionary, or a set if add/discard/update are used, keyed on widgets.
+# Iterates in the order widgets were first added, or last looked up if refreshOnLookup is set.
+# Registries of which widgets have been monitored aren't forgettable: if such a widget were shown
+# again we'd monitor it twice. Toolkits whose widgets can't come back discard them explicitly
+class WidgetRegistry:
+    allRegistries = []
+    useWeakReferences = False
+    reportRegistered = False
+    missing = object()
+    def __init__(self, name, capped=True, refreshOnLookup=False, forgettable=True):
+        self.name = name
+        self.capped = capped
+        self.refreshOnLookup = refreshOnLookup
+        self.forgettable = forgettable
+        self.data = OrderedDict()
+        self.limit = None
+        self.limitChecked = False
+        self.peakSize = 0
+        self.evictedCount = 0
+        self.collectedCount = 0
+        self.forgottenCount = 0
+        self.allRegistries.append(weakref.ref(self))
+        self.registerReport()
+
+    @classmethod
+    def registerReport(cls):
+        if not cls.reportRegistered:
+            cls.reportRegistered = True
+            atexit.register(cls.writeMemoryReport)
+
+    @classmethod
+    def forgetWidget(cls, widget):
+        # Called by the toolkits on their UI thread, when a widget has been disposed or removed from its window
+        for registry in cls.getAllRegistries():
+            if registry.forgettable:
+                registry.forget(widget)
+
+    @classmethod
+    def getAllRegistries(cls):
+        # Those made by e.g. describers which have since gone aren't kept
+        registries = [ registry for registry in (ref() for ref in cls.allRegistries) if registry is not None ]
+        if len(registries) < len(cls.allRegistries):
+            cls.allRegistries = map(weakref.ref, registries)
+        return registries
+
+    def getLimit(self):
+        # Read when first needed, the environment isn't always set up when the registries are made
+        if not self.limitChecked:
+            self.limitChecked = True
+            if self.capped:
+                limit = os.getenv("USECASE_REGISTRY_LIMIT")
+                if limit:
+                    self.limit = max(1, int(limit))
+        return self.limit
+
+    def makeKey(self, widget):
+        if self.useWeakReferences:
+            try:
+                return weakref.ref(widget)
+            except TypeError:
+                return StrongReference(widget)
+        else:
+            return widget
+
+    def makeStoredKey(self, widget):
+        if self.useWeakReferences:
+            try:
+                return weakref.ref(widget, self.removeCollected)
+            except TypeError:
+                return StrongReference(widget)
+        else:
+            return widget
+
+    def getWidget(self, key):
+        if self.useWeakReferences:
+            return key()
+        else:
+            return key
+
+    def removeCollected(self, key):
+        if self.data.pop(key, self.missing) is not self.missing:
+            self.collectedCount += 1
+
+    def __getitem__(self, widget):
+        key = self.makeKey(widget) if self.useWeakReferences else widget
+        value = self.data[key]
+        if self.refreshOnLookup:
+            del self.data[key]
+            self.data[self.makeStoredKey(widget)] = value
+        return value
+
+    def __setitem__(self, widget, value):
+        key = self.makeKey(widget) if self.useWeakReferences else widget
+        if key in self.data:
+            self.data[key] = value
+            return
+        self.data[self.makeStoredKey(widget)] = value
+        limit = self.getLimit()
+        if limit is not None:
+            while len(self.data) > limit:
+                del self.data[iter(self.data).next()]
+                self.evictedCount += 1
+        self.peakSize = max(self.peakSize, len(self.data))
+
+    def __delitem__(self, widget):
+        del self.data[self.makeKey(widget)]
+
+    def __contains__(self, widget):
+        if self.useWeakReferences:
+            return self.makeKey(widget) in self.data
+        else:
+            return widget in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def getUnknown(self, widgets):
+        # Those of the given widgets that aren't in the registry, quicker than checking them one at a time
+        if self.useWeakReferences:
+            return [ widget for widget in widgets if widget not in self ]
+        else:
+            data = self.data
+            return [ widget for widget in widgets if widget not in data ]
+
+    def get(self, widget, default=None):
+        if widget in self:
+            return self[widget]
+        else:
+            return default
+
+    def setdefault(self, widget, default):
+        if widget in self:
+            return self[widget]
+        self[widget] = default
+        return default
+
+    def pop(self, widget, *args):
+        return self.data.pop(self.makeKey(widget), *args)
+
+    def keys(self):
+        if self.useWeakReferences:
+            return [ widget for widget in map(self.getWidget, self.data.keys()) if widget is not None ]
+        else:
+            return self.data.keys()
+
+    def values(self):
+        return [ value for _, value in self.items() ]
+
+    def items(self):
+        if self.useWeakReferences:
+            return [ (widget, value) for widget, value in ((self.getWidget(key), value) for key, value in self.data.items())
+                     if widget is not None ]
+        else:
+            return self.data.items()
+
+    def clear(self):
+        self.data.clear()
+
+    def add(self, widget):
+        self[widget] = True
+
+    def update(self, widgets):
+        for widget in widgets:
+            self[widget] = True
+
+    def discard(self, widget):
+        self.pop(widget, None)
+
+    def forget(self, widget):
+        if self.pop(widget, self.missing) is not self.missing:
+            self.forgottenCount += 1
+
+    @classmethod
+    def getMemoryReport(cls):
+        headerRow = [ "Registry", "Size", "Peak size", "Limit", "Evicted", "Collected", "Forgotten" ]
+        rows = []
+        for registry in cls.getAllRegistries():
+            rows.append([ registry.name, str(len(registry)), str(registry.peakSize), str(registry.getLimit() or "-"),
+                          str(registry.evictedCount), str(registry.collectedCount), str(registry.forgottenCount) ])
+        return GridFormatterWithHeader([ headerRow ], rows, len(headerRow)).__str__() + "\n"
+
+    @classmethod
+    def writeMemoryReport(cls):
+        fileName = os.getenv("USECASE_MEMORY_REPORT")
+        if fileName:
+            f = encodingutils.openEncoded(fileName, "w")
+            try:
+                f.write(cls.getMemoryReport())
+            finally:
+                f.close()
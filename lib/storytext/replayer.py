@@ -1,12 +1,15 @@
 
 """ Generic recorder classes. GUI-specific stuff is in guishared.py """
 
-import os, sys, signal, time, re
+import os, sys, signal, time, re, logging
 from filepolling import poll_file
 import encodingutils
-from threading import Thread, Timer, Lock
+from threading import Lock
+from scheduler import ReplayScheduler, ReplayWorker
+from tracing import ReplayTracer
 from definitions import *
 from copy import copy
+from bisect import bisect_left
 
 try:
     from collections import OrderedDict
@@ -25,25 +28,93 @@ def parseMultiples(text):
 def parseWaitCommand(line):
     return map(parseMultiples, line[len(waitCommandName) + 1:].split(", "))
 
+def assembleWaitEvent(baseEvent, count):
+    postfix = " * " + str(count) if count > 1 else ""
+    return baseEvent + postfix
+
 def assembleWaitCommand(parsedEvents):
-    events = []
-    for baseEvent, count in parsedEvents:
-        postfix = " * " + str(count) if count > 1 else ""
-        events.append(baseEvent + postfix)
+    events = [ assembleWaitEvent(baseEvent, count) for baseEvent, count in parsedEvents ]
     return waitCommandName + " " + ", ".join(sorted(events))
 
+def readScriptCommands(scriptName, ignoreComments):
+    if not os.path.isfile(scriptName):
+        raise UseCaseScriptError, "Cannot replay script " + repr(scriptName) + ", no such file or directory."
+    commands = []
+    for line in encodingutils.openEncoded(scriptName):
+        line = line.strip("\r\n")
+        if not ignoreComments or (line != "" and line[0] != "#"):
+            commands.append(line)
+    return commands
+
+
+# Process-wide store of parsed script files, for things like the recorder's shortcut trackers
+# which would otherwise re-read the same shortcut file every time they reset.
+# Entries are checked against the file's modification time and size each time, which may not
+# change if a file is rewritten quickly: so anything here that writes script files invalidates them
+class ParsedScriptCache:
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def getFileStamp(self, scriptName):
+        try:
+            info = os.stat(scriptName)
+            return info.st_mtime, info.st_size
+        except OSError:
+            pass
+
+    def getCommands(self, scriptName, ignoreComments):
+        key = os.path.abspath(scriptName), ignoreComments
+        self.lock.acquire()
+        try:
+            stamp = self.getFileStamp(scriptName)
+            entry = self.entries.get(key)
+            if entry and entry[1] == stamp:
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            commands = readScriptCommands(scriptName, ignoreComments)
+            self.entries[key] = commands, stamp
+            return commands
+        finally:
+            self.lock.release()
+
+    def invalidate(self, scriptName):
+        self.lock.acquire()
+        for ignoreComments in [ False, True ]:
+            self.entries.pop((os.path.abspath(scriptName), ignoreComments), None)
+        self.lock.release()
+
+    def clear(self):
+        self.entries = {}
+
+    def getStatistics(self):
+        return "Parsed script cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + \
+            str(len(self.entries)) + " scripts stored"
+
+
 class ReplayScript(object):
-    def __init__(self, scriptName, ignoreComments=False):
-        self.commands = []
+    regexpCache = {}
+    waitRegexpCache = {}
+    countRegexp = re.compile(r"(.*) \\\* ([0-9]+)$")
+    parsedCache = ParsedScriptCache()
+    def __init__(self, scriptName, ignoreComments=False, commands=None):
         self.exitObservers = []
         self.pointer = 0
         self.name = scriptName
-        if not os.path.isfile(scriptName):
-            raise UseCaseScriptError, "Cannot replay script " + repr(scriptName) + ", no such file or directory."
-        for line in encodingutils.openEncoded(scriptName):
-            line = line.strip("\r\n")
-            if not ignoreComments or (line != "" and line[0] != "#"):
-                self.commands.append(line)
+        if commands is None:
+            self.commands = readScriptCommands(scriptName, ignoreComments)
+        else:
+            self.commands = commands
+
+    @classmethod
+    def fromCache(cls, scriptName, ignoreComments=False):
+        commands = cls.parsedCache.getCommands(scriptName, ignoreComments)
+        # The script may add to its commands (see addWaitCommand), so don't share the cached list
+        return cls(scriptName, ignoreComments, commands=list(commands))
                 
     def __copy__(self):
         obj_copy = object.__new__(type(self))
@@ -89,8 +160,35 @@ class ReplayScript(object):
         # handle unnumbered variables, and make sure we don't match anything longer
         return text.replace("$", "(.*)") + "$"
     
+    @classmethod
+    def parseWaitRegexp(cls, pattern):
+        # The regexps for each event in a wait command's pattern from transformToRegexp, and the count each one waits for
+        prefix = waitCommandName + " "
+        if not pattern.startswith(prefix) or not pattern.endswith("$"):
+            return
+        eventRegexps = cls.waitRegexpCache.get(pattern)
+        if eventRegexps is None:
+            eventRegexps = []
+            for eventPattern in pattern[len(prefix):-1].split(", "):
+                match = cls.countRegexp.match(eventPattern)
+                if match:
+                    eventPattern, count = match.group(1), int(match.group(2))
+                else:
+                    count = 1
+                try:
+                    eventRegexps.append((re.compile(eventPattern + "$"), count))
+                except re.error:
+                    return
+            cls.waitRegexpCache[pattern] = eventRegexps
+        return eventRegexps
+
     def getRegexp(self, command):
-        return re.compile(self.transformToRegexp(command)) if command else None
+        if command:
+            # Don't rely on the re module's cache, which is far too small for a big shortcut library
+            regexp = self.regexpCache.get(command)
+            if regexp is None:
+                regexp = self.regexpCache.setdefault(command, re.compile(self.transformToRegexp(command)))
+            return regexp
 
     def hasTerminated(self):
         return self.pointer >= len(self.commands)
@@ -195,12 +293,61 @@ class ReplayScript(object):
         self.name = newPath
         
         
+# Finds the shortcuts whose regexps could match a command without trying all of them.
+# Each shortcut is filed under the literal text its name starts with (everything before
+# the first argument), so only those whose literal prefix the command starts with are tried.
+# Candidates come back in the order they were added, as tie-breaking depends on this.
+class ShortcutMatcher:
+    nonLiteralChars = "$.\\"
+    def __init__(self):
+        self.buckets = {}
+        self.nextIndex = 0
+
+    def getLiteralPrefix(self, shortcut):
+        name = shortcut.getShortcutName()
+        for pos, char in enumerate(name):
+            if char in self.nonLiteralChars:
+                return name[:pos]
+        return name
+
+    def add(self, regexp, shortcut):
+        prefix = self.getLiteralPrefix(shortcut)
+        self.buckets.setdefault(prefix, []).append((self.nextIndex, regexp, shortcut))
+        self.nextIndex += 1
+
+    def remove(self, shortcut):
+        for prefix, entries in self.buckets.items():
+            for entry in entries:
+                if entry[2] is shortcut:
+                    entries.remove(entry)
+                    if len(entries) == 0:
+                        del self.buckets[prefix]
+                    return
+
+    def findCandidates(self, command):
+        candidates = []
+        for length in range(len(command) + 1):
+            candidates += self.buckets.get(command[:length], [])
+        candidates.sort()
+        return [ (regexp, shortcut) for _, regexp, shortcut in candidates ]
+
+    def match(self, command):
+        # Behaves like a compiled regexp, so can be passed as "matching" to ReplayScript.getCommand
+        for regexp, _ in self.findCandidates(command):
+            match = regexp.match(command)
+            if match:
+                return match
+
+
 class ShortcutManager:
     def __init__(self):
         self.shortcuts = []
+        self.matcher = ShortcutMatcher()
         
     def add(self, shortcut):
-        self.shortcuts.append((shortcut.getShortcutRegexp(), shortcut))
+        regexp = shortcut.getShortcutRegexp()
+        self.shortcuts.append((regexp, shortcut))
+        self.matcher.add(regexp, shortcut)
 
     def getShortcuts(self):
         # Drop the trailing $ from the pattern
@@ -208,10 +355,13 @@ class ShortcutManager:
     
     def getRegexps(self):
         return [ r for r, _ in self.shortcuts ]
+
+    def getMatchers(self):
+        return [ self.matcher ] if self.shortcuts else []
     
     def findShortcut(self, command):
         bestShortcut, bestArgs = None, []
-        for regex, shortcut in self.shortcuts:
+        for regex, shortcut in self.matcher.findCandidates(command):
             match = regex.match(command)
             if match:
                 args = list(match.groups())
@@ -228,45 +378,230 @@ class ShortcutManager:
         argLength1 = sum(map(len, args1))
         argLength2 = sum(map(len, args2))
         return argLength1 < argLength2
+
+    def unregister(self, shortcut):
+        for entry in self.shortcuts:
+            if entry[1] is shortcut:
+                self.shortcuts.remove(entry)
+                self.matcher.remove(shortcut)
+                return
     
     def remove(self, shortcut):
-        self.shortcuts.remove((shortcut.getShortcutRegexp(), shortcut))
+        self.unregister(shortcut)
         os.remove(shortcut.name)
         
     def rename(self, oldName, newName):
         shortcut = self.findShortcut(oldName)[0]
-        self.shortcuts.remove((shortcut.getShortcutRegexp(), shortcut))
+        self.unregister(shortcut)
         shortcut.rename(newName)
         self.add(shortcut)
-    
-    
+
+
+# Word-level prefix trie over the registered event names, so that finding the longest
+# event name a script line starts with costs time proportional to the length of the line
+# rather than the number of events. Gives the same answer as comparing with startswith
+# against every name: all words but the last must match exactly, the last may be a prefix
+# of the corresponding word in the command.
+class CommandNameIndex:
+    def __init__(self):
+        self.root = self.makeNode()
+
+    @staticmethod
+    def makeNode():
+        # Full words leading onwards, and final words of names that stop here
+        return {}, set()
+
+    def add(self, eventName):
+        words = eventName.split(" ")
+        node = self.root
+        for word in words[:-1]:
+            node = node[0].setdefault(word, self.makeNode())
+        node[1].add(words[-1])
+
+    def remove(self, eventName):
+        words = eventName.split(" ")
+        path = []
+        node = self.root
+        for word in words[:-1]:
+            path.append((node, word))
+            node = node[0].get(word)
+            if node is None:
+                return
+        node[1].discard(words[-1])
+        # Prune branches that no longer lead anywhere
+        for parent, word in reversed(path):
+            child = parent[0][word]
+            if child[0] or child[1]:
+                break
+            del parent[0][word]
+
+    def clear(self):
+        self.root = self.makeNode()
+
+    def findLongestPrefix(self, command):
+        longest = ""
+        offset = 0
+        node = self.root
+        for word in command.split(" "):
+            children, finalWords = node
+            for length in range(len(word), -1, -1):
+                if word[:length] in finalWords:
+                    # Deeper matches are always longer, so only the last one found counts
+                    longest = command[:offset + length]
+                    break
+            node = children.get(word)
+            if node is None:
+                break
+            offset += len(word) + 1
+        return longest
+
+
+# The commands a replay can run, with shortcuts expanded, so we can tell which event names it might refer to
+# without creating all the events, see --lazy-instrumentation. Where arguments can't be filled in, anything
+# that starts with, or is a prefix of, the text before them might be referred to
+class ReplayableCommandIndex:
+    def __init__(self, commands):
+        self.commands = []
+        self.literalPrefixes = set()
+        self.literalLengths = set()
+        self.matchesAnything = False
+        for command in commands:
+            pos = command.find("$")
+            if pos == -1:
+                self.commands.append(command)
+            elif pos == 0:
+                self.matchesAnything = True
+            else:
+                literal = command[:pos]
+                self.commands.append(literal)
+                self.literalPrefixes.add(literal)
+                self.literalLengths.add(len(literal))
+        self.commands.sort()
+
+    def mayStartWith(self, text):
+        # Whether some command might start with text. Those that do are together in sorted order
+        if self.matchesAnything:
+            return True
+        pos = bisect_left(self.commands, text)
+        if pos < len(self.commands) and self.commands[pos].startswith(text):
+            return True
+        return any((text[:length] in self.literalPrefixes for length in self.literalLengths if length <= len(text)))
+
+
+# Sends what is logged while replaying each usecase of a session to its own file, see --replay-session
+class SessionLogRedirector:
+    loggerNames = [ "gui log", "storytext replay log" ]
+    def __init__(self, logDir):
+        self.logDir = logDir
+        self.handler = None
+
+    def getLogFileName(self, scriptName, number):
+        # Usecase files often have the same name in different directories, as with TextTest
+        baseName = os.path.splitext(os.path.basename(scriptName))[0]
+        return os.path.join(self.logDir, str(number) + "_" + baseName + ".log")
+
+    def redirect(self, scriptName, number):
+        if not os.path.isdir(self.logDir):
+            os.makedirs(self.logDir)
+        handler = logging.FileHandler(self.getLogFileName(scriptName, number), "w")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for loggerName in self.loggerNames:
+            logger = logging.getLogger(loggerName)
+            if self.handler:
+                logger.removeHandler(self.handler)
+            else:
+                # Replaces wherever it was configured to go, for the rest of the session
+                logger.handlers = []
+                logger.propagate = 0
+            logger.addHandler(handler)
+        if self.handler:
+            self.handler.close()
+        self.handler = handler
+
+
 class UseCaseReplayer:
+    # Whether the toolkit can reset the GUI between usecases, so that several can be replayed in one session
+    supportsSessions = False
     def __init__(self, recorder, timeout=60):
         self.logger = encodingutils.getEncodedLogger("storytext replay log")
         self.scripts = []
         self.shortcutManager = ShortcutManager()
         self.events = {}
+        self.commandNameIndex = CommandNameIndex()
+        self.replayableCommands = None
         self.appEventLock = Lock()
         self.waitingForEvents = []
         self.applicationEventNames = set()
-        self.replayThread = None
+        self.replayWorker = None
         self.timeDelayNextCommand = 0
         self.eventHappenedMessage = ""
         self.appEventTimer = None
         self.appEventTimeout = timeout
+        self.waitStartTime = None
+        self.tracer = ReplayTracer.getInstance()
+        if self.tracer:
+            self.traceReplay()
         # For things like comments, and hand-added mutual synch events, which cannot be recorded
         # Do not use for other purposes! The recorder should be as independent of the replayer as possible
         self.recorder = recorder
         if os.name == "posix":
             os.setpgrp() # Makes it easier to kill subprocesses
 
+        # A session replays several usecases one after the other, see startNextSessionScript
+        self.sessionScripts = []
+        self.sessionScriptNumber = 0
+        self.sessionResetHooks = []
+        self.sessionLogRedirector = None
         replayScript = os.getenv("USECASE_REPLAY_SCRIPT")
+        sessionScripts = os.getenv("USECASE_REPLAY_SESSION")
         if replayScript:
             self.scripts.append((ReplayScript(replayScript), []))
+        elif sessionScripts:
+            if not self.supportsSessions:
+                raise UseCaseScriptError, "ERROR: cannot replay usecases in a session with this interface, " + \
+                      "--replay-session (USECASE_REPLAY_SESSION) only works for SWT/Eclipse currently"
+            self.sessionScripts = sessionScripts.split(",")
+            self.sessionLogRedirector = SessionLogRedirector(os.getenv("USECASE_REPLAY_SESSION_LOG_DIR", os.getcwd()))
+            self.startSessionScript()
                 
     def isActive(self):
         return len(self.scripts) > 0
 
+    def traceReplay(self):
+        self.tracer.traceCommands(self, "parseAndProcess")
+        self.tracer.traceMethods(self, "replay", [ "parseCommand", "processCommand" ])
+
+    def addSessionResetHook(self, method):
+        self.sessionResetHooks.append(method)
+
+    def startSessionScript(self):
+        scriptName = self.sessionScripts.pop(0)
+        self.sessionScriptNumber += 1
+        self.sessionLogRedirector.redirect(scriptName, self.sessionScriptNumber)
+        self.logger.debug("Starting usecase " + repr(scriptName) + " in session")
+        self.scripts.append((ReplayScript(scriptName), []))
+
+    def startNextSessionScript(self):
+        # Returns whether there was another usecase to replay. Only the threaded replayers call this
+        if not self.sessionScripts:
+            return False
+        for method in self.sessionResetHooks:
+            method()
+        self.resetSessionState()
+        self.startSessionScript()
+        return True
+
+    def resetSessionState(self):
+        # The next usecase should start as if nothing had been replayed before it
+        if self.appEventTimer:
+            self.appEventTimer.cancel()
+            self.appEventTimer = None
+        self.waitingForEvents = []
+        self.applicationEventNames = set()
+        self.eventHappenedMessage = ""
+        self.timeDelayNextCommand = 0
+        self.waitStartTime = None
+
     def registerShortcut(self, shortcut):
         self.shortcutManager.add(shortcut)
 
@@ -275,8 +610,54 @@ class UseCaseReplayer:
     
     def addEvent(self, event, eventNames):
         for name in eventNames:
+            if name not in self.events:
+                self.commandNameIndex.add(name)
             self.events.setdefault(name, []).append(event)
-    
+
+    def removeEvents(self, events):
+        events = set(events)
+        if not events:
+            return
+        for name, currEvents in self.events.items():
+            remaining = [ e for e in currEvents if e not in events ]
+            if len(remaining) == 0:
+                del self.events[name]
+                self.commandNameIndex.remove(name)
+            elif len(remaining) < len(currEvents):
+                self.events[name] = remaining
+
+    def clearEvents(self):
+        self.events = {}
+        self.commandNameIndex.clear()
+
+    def getReplayableCommands(self):
+        # Everything that's left to replay, including the usecases still to come in a session
+        if self.replayableCommands is None:
+            commands = []
+            expanded = set()
+            for script, args in self.scripts:
+                self.expandShortcuts(script.commands[script.pointer:], script, args, commands, expanded)
+            for scriptName in self.sessionScripts:
+                script = ReplayScript.fromCache(scriptName)
+                self.expandShortcuts(script.commands, script, [], commands, expanded)
+            self.replayableCommands = ReplayableCommandIndex(commands)
+        return self.replayableCommands
+
+    def expandShortcuts(self, scriptCommands, script, args, commands, expanded):
+        # Arguments are cycled through as the script goes, see ReplayScript.getArgument
+        args = list(args)
+        for command in scriptCommands:
+            if not ReplayScript.isComment(command):
+                command = script.replaceArgs(command, args)
+                shortcut, shortcutArgs = self.shortcutManager.findShortcut(command)
+                if shortcut:
+                    key = shortcut.name, tuple(shortcutArgs)
+                    if key not in expanded:
+                        expanded.add(key)
+                        self.expandShortcuts(shortcut.commands, shortcut, shortcutArgs, commands, expanded)
+                else:
+                    commands.append(command)
+
     def writeRecursiveError(self, script, arguments):
         sys.stderr.write("ERROR: Cannot execute shortcut command '" + script.getShortcutNameWithArgs(arguments) + "' - shortcut is trying to call itself!\n")
 
@@ -299,7 +680,7 @@ class UseCaseReplayer:
 
     def runScript(self, script, arguments, enableReading):
         if self.shortcutManager.shortcuts:
-            scriptCommands = script.getCommands(arguments, matching=self.shortcutManager.getRegexps())
+            scriptCommands = script.getCommands(arguments, matching=self.shortcutManager.getMatchers())
             if scriptCommands:
                 while ReplayScript.isComment(scriptCommands[0]):
                     self.handleComment(scriptCommands[0])
@@ -323,12 +704,12 @@ class UseCaseReplayer:
             return True
         
     def enableReading(self):
-        # By default, we create a separate thread for background execution
+        # By default, we run commands in a background thread, reused each time we resume after a wait
         # GUIs will want to do this as idle handlers
-        self.logger.debug("Spawning replay thread...")
-        self.replayThread = Thread(target=self.runCommands)
-        self.replayThread.start()
-        #gtk.idle_add(method)
+        self.logger.debug("Waking replay thread...")
+        if self.replayWorker is None:
+            self.replayWorker = ReplayWorker(self.runCommands)
+        self.replayWorker.wake()
 
     def resetWaitingInfo(self):
         self.eventHappenedMessage = self.makeAppEventMessage()
@@ -336,9 +717,12 @@ class UseCaseReplayer:
         self.applicationEventNames = set()
 
     def notifyWaitingCompleted(self):
-        if self.replayThread:
-            self.replayThread.join()
-                
+        if self.replayWorker:
+            self.replayWorker.waitUntilIdle()
+
+        if self.waitStartTime is not None:
+            self.tracer.traceWait(self.waitingForEvents, self.waitStartTime, self.waitingCompleted())
+            self.waitStartTime = None
         self.resetWaitingInfo()
         self.enableReading()
 
@@ -391,8 +775,11 @@ class UseCaseReplayer:
         return set(self.waitingForEvents).issubset(self.applicationEventNames)
 
     def runCommands(self):
-        while self.runNextCommand()[0]:
-            pass
+        # Returns whether we're suspended waiting for something, i.e. whether we expect to be re-enabled
+        while True:
+            proceed, wait = self.runNextCommand()
+            if not proceed:
+                return wait
 
     def getCommands(self):
         script, scriptArgs = self.scripts[-1]
@@ -540,25 +927,25 @@ class UseCaseReplayer:
         if command.startswith(signalCommandName):
             return signalCommandName
 
-        longestEventName = ""
-        for eventName in self.events.keys():
-            if command.startswith(eventName) and len(eventName) > len(longestEventName):
-                longestEventName = eventName
-        return longestEventName            
+        return self.commandNameIndex.findLongestPrefix(command)
+
+    def startTimer(self, subTimersLeft, subTimerTimeout):
+        if subTimersLeft:
+            self.appEventTimer = ReplayScheduler.getInstance().schedule(subTimerTimeout, self.subTimerExpired,
+                                                                        subTimersLeft - 1, subTimerTimeout)
+        else:
+            self.appEventTimer = None
+            self.timeoutApplicationEvents()
 
-    def startTimer(self, timer):
-        self.appEventTimer = timer
-        self.appEventTimer.start()
+    def subTimerExpired(self, *args):
+        if self.appEventTimer is not None: # i.e. not cancelled in the meantime
+            self.startTimer(*args)
 
     def setAppEventTimer(self):
         # Break the timer up into 5 sub-timers
         # The point is to prevent timing out too early if the process gets suspended
         subTimerCount = 5 # whatever
-        subTimerTimeout = float(self.appEventTimeout) / subTimerCount
-        timer = Timer(subTimerTimeout, self.timeoutApplicationEvents)
-        for _ in range(subTimerCount - 1):
-            timer = Timer(subTimerTimeout, self.startTimer, [ timer ])
-        self.startTimer(timer)
+        self.startTimer(subTimerCount, float(self.appEventTimeout) / subTimerCount)
     
     def handleMutualSynchWait(self, eventName):
         fileName = eventName.replace(" ", "_")
@@ -588,6 +975,8 @@ class UseCaseReplayer:
         self.waitingForEvents = allEventsToWaitFor
         complete = self.waitingCompleted()
         if not complete:
+            if self.tracer and self.waitStartTime is None:
+                self.waitStartTime = time.time()
             self.setAppEventTimer()
         self.appEventLock.release()
         return complete
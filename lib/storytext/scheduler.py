@@ -0,0 +1,138 @@
+
+""" Shared background threads for the replayer. Rather than starting new threads for every
+timeout and every resumption of replay, one scheduler thread runs all the timed callbacks
+and one worker thread per replayer is reused to run the commands """
+
+from threading import Thread, Condition, Lock, currentThread
+from traceback import format_exception
+import heapq, time, sys
+
+class ScheduledCall:
+    def __init__(self, dueTime, method, args):
+        self.dueTime = dueTime
+        self.method = method
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __cmp__(self, other):
+        return cmp(self.dueTime, other.dueTime)
+
+    def __lt__(self, other):
+        return self.dueTime < other.dueTime
+
+
+# Behaves as a singleton, see getInstance. Keeps the pending calls in a heap ordered by
+# due time, and sleeps on a condition until the next one is due or a new one is added.
+class ReplayScheduler:
+    instance = None
+    instanceLock = Lock()
+    def __init__(self):
+        self.pendingCalls = []
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, name="StoryText scheduler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @classmethod
+    def getInstance(cls):
+        # Threads may ask for it at the same time, and there must only ever be one scheduler thread
+        cls.instanceLock.acquire()
+        try:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
+        finally:
+            cls.instanceLock.release()
+
+    def schedule(self, delay, method, *args):
+        call = ScheduledCall(time.time() + delay, method, args)
+        self.condition.acquire()
+        heapq.heappush(self.pendingCalls, call)
+        self.condition.notify()
+        self.condition.release()
+        return call
+
+    def getNextCall(self):
+        self.condition.acquire()
+        try:
+            while True:
+                while self.pendingCalls and self.pendingCalls[0].cancelled:
+                    heapq.heappop(self.pendingCalls)
+                if not self.pendingCalls:
+                    self.condition.wait()
+                    continue
+                remaining = self.pendingCalls[0].dueTime - time.time()
+                if remaining <= 0:
+                    return heapq.heappop(self.pendingCalls)
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            call = self.getNextCall()
+            # Must not hold the lock here, callbacks are free to schedule new calls
+            if not call.cancelled:
+                self.runCall(call)
+
+    def runCall(self, call):
+        # Everything timed runs on this thread, so one failing callback mustn't stop all the others
+        try:
+            call.method(*call.args)
+        except:
+            sys.stderr.write("ERROR: exception in scheduled call to " + repr(call.method) + ", continuing:\n" + \
+                             "".join(format_exception(*sys.exc_info())))
+
+
+# Thread that runs the given method each time it is woken, instead of a new thread each time.
+# The method should return True if it expects to be woken again: if not, the thread
+# exits, so that it doesn't prevent the process from terminating.
+class ReplayWorker:
+    def __init__(self, method):
+        self.method = method
+        self.condition = Condition()
+        self.wakeRequested = False
+        self.running = False
+        self.thread = None
+
+    def wake(self):
+        self.condition.acquire()
+        self.wakeRequested = True
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name="StoryText replay")
+            self.thread.start()
+        else:
+            self.condition.notifyAll()
+        self.condition.release()
+
+    def waitUntilIdle(self):
+        if currentThread() is self.thread:
+            return
+        self.condition.acquire()
+        while self.running:
+            self.condition.wait()
+        self.condition.release()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while True:
+                while not self.wakeRequested:
+                    self.condition.wait()
+                self.wakeRequested = False
+                self.running = True
+                self.condition.release()
+                try:
+                    expectWake = self.method()
+                finally:
+                    self.condition.acquire()
+                    self.running = False
+                    self.condition.notifyAll()
+                if not expectWake and not self.wakeRequested:
+                    self.thread = None
+                    return
+        finally:
+            self.condition.release()
@@ -49,7 +49,7 @@ class ScriptEngine:
         for fileName in sorted(os.listdir(home)):
             if fileName.endswith(".shortcut"):
                 fullPath = os.path.join(home, fileName)
-                shortcuts.append(replayer.ReplayScript(fullPath, ignoreComments=True))
+                shortcuts.append(replayer.ReplayScript.fromCache(fullPath, ignoreComments=True))
         return shortcuts
 
     def createReplayer(self, **kw):
@@ -77,6 +77,9 @@ class ScriptEngine:
         if self.recorderActive():
             self.recorder.unregisterApplicationEvent(*args, **kw)
 
+    def addSessionResetHook(self, method):
+        self.replayer.addSessionResetHook(method)
+
     def run(self, options, args):
         if len(args) == 0:
             return False
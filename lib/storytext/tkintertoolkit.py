@@ -11,6 +11,9 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+# Tkinter widget objects are held by their parents until they are destroyed, so nothing else needs to hold them
+guishared.WidgetRegistry.useWeakReferences = True
+
 def getWidgetOption(widget, optionName):
     try:
         return widget.cget(optionName)
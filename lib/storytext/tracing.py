@@ -0,0 +1,133 @@
+
+""" Optional tracing of where the time goes when replaying: parsing commands, checking widgets,
+generating events, describing the GUI and waiting for application events. Enabled by the --replay-trace
+option, when it writes the trace in Chrome's trace-event format, which can be viewed in chrome://tracing
+or Perfetto, along with a summary of the slowest commands. When it's not enabled nothing is wrapped,
+so it costs nothing """
+
+from gridformatter import GridFormatterWithHeader
+from threading import Lock, currentThread
+import os, time, atexit, encodingutils
+
+try:
+    import json
+except ImportError: # pragma: no cover - Python 2.5
+    import simplejson as json
+
+# Behaves as a singleton, see getInstance, which returns None if tracing is not enabled
+class ReplayTracer:
+    instance = None
+    checkedEnvironment = False
+    summaryCount = 20
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.events = []
+        self.threadIds = {}
+        self.lock = Lock()
+        self.startTime = time.time()
+        self.currentCommand = None
+        self.commandTimes = []
+        atexit.register(self.write)
+
+    @classmethod
+    def getInstance(cls):
+        if not cls.checkedEnvironment:
+            cls.checkedEnvironment = True
+            fileName = os.getenv("USECASE_REPLAY_TRACE")
+            if fileName:
+                cls.instance = cls(fileName)
+        return cls.instance
+
+    def getTimestamp(self, t):
+        # Microseconds, as the format requires
+        return int((t - self.startTime) * 1000000)
+
+    def getThreadId(self):
+        thread = currentThread()
+        self.lock.acquire()
+        try:
+            if thread not in self.threadIds:
+                self.threadIds[thread] = len(self.threadIds) + 1
+                self.events.append({ "name" : "thread_name", "ph" : "M", "pid" : os.getpid(), "tid" : self.threadIds[thread],
+                                     "args" : { "name" : thread.getName() } })
+            return self.threadIds[thread]
+        finally:
+            self.lock.release()
+
+    def addSpan(self, name, category, startTime, args={}):
+        endTime = time.time()
+        event = { "name" : name, "cat" : category, "ph" : "X", "pid" : os.getpid(), "tid" : self.getThreadId(),
+                  "ts" : self.getTimestamp(startTime), "dur" : self.getTimestamp(endTime) - self.getTimestamp(startTime) }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+        if self.currentCommand is not None and category != "command":
+            phaseTimes = self.currentCommand[1]
+            phaseTimes[name] = phaseTimes.get(name, 0.0) + endTime - startTime
+
+    def addCounter(self, name, values):
+        self.events.append({ "name" : name, "ph" : "C", "pid" : os.getpid(), "ts" : self.getTimestamp(time.time()),
+                             "args" : values })
+
+    def wrap(self, name, category, method, argsMethod=None):
+        def tracedMethod(*args, **kw):
+            startTime = time.time()
+            try:
+                return method(*args, **kw)
+            finally:
+                self.addSpan(name, category, startTime, argsMethod and argsMethod(*args))
+        return tracedMethod
+
+    def traceMethods(self, obj, category, methodNames):
+        # Replaces the methods on this instance only, with versions that record how long they take
+        for methodName in methodNames:
+            method = getattr(obj, methodName, None)
+            if method is not None:
+                setattr(obj, methodName, self.wrap(methodName, category, method))
+
+    def traceCommands(self, obj, methodName):
+        method = getattr(obj, methodName)
+        def tracedMethod(command, *args, **kw):
+            startTime = time.time()
+            self.currentCommand = command, {}
+            try:
+                return method(command, *args, **kw)
+            finally:
+                phaseTimes = self.currentCommand[1]
+                self.currentCommand = None
+                self.addSpan(command, "command", startTime)
+                self.commandTimes.append((time.time() - startTime, command, phaseTimes))
+        setattr(obj, methodName, tracedMethod)
+
+    def traceWait(self, eventNames, startTime, completed):
+        self.addSpan("wait for " + ", ".join(eventNames), "wait", startTime, { "completed" : completed })
+
+    def getSummary(self):
+        slowest = sorted(self.commandTimes, key=lambda info: -info[0])[:self.summaryCount]
+        if not slowest:
+            return "No commands were replayed.\n"
+        phaseNames = sorted(set((name for _, _, phaseTimes in slowest for name in phaseTimes.keys())))
+        headerRow = [ "Command", "Total (ms)" ] + [ name + " (ms)" for name in phaseNames ]
+        rows = []
+        for totalTime, command, phaseTimes in slowest:
+            rows.append([ command, "%.1f" % (1000 * totalTime) ] + \
+                        [ "%.1f" % (1000 * phaseTimes.get(name, 0.0)) for name in phaseNames ])
+        totalTime = sum((info[0] for info in self.commandTimes))
+        text = "Slowest " + str(len(slowest)) + " of " + str(len(self.commandTimes)) + " commands, which took " + \
+               ("%.3f" % totalTime) + " seconds in total:\n"
+        return text + GridFormatterWithHeader([ headerRow ], rows, len(headerRow)).__str__() + "\n"
+
+    def getSummaryFileName(self):
+        return os.path.splitext(self.fileName)[0] + "_summary.txt"
+
+    def write(self):
+        f = open(self.fileName, "w")
+        try:
+            json.dump({ "traceEvents" : self.events, "displayTimeUnit" : "ms" }, f)
+        finally:
+            f.close()
+        f = encodingutils.openEncoded(self.getSummaryFileName(), "w")
+        try:
+            f.write(self.getSummary())
+        finally:
+            f.close()
@@ -0,0 +1,137 @@
+
+""" On-disk cache of parsed UI map files. Large UI maps take a while to parse with ConfigParser,
+and many StoryText processes typically start up reading the same ones. So the parsed sections are
+stored in a cache directory, keyed on the UI map file's absolute path, and reused as long as
+the file has not changed. The UI map files themselves remain the only thing that is ever written to. """
+
+import os, encodingutils, privatedir
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from hashlib import md5
+except ImportError: # pragma: no cover - Python 2.4
+    from md5 import new as md5
+
+# Increase if the contents of ParsedUIMapFile change
+formatVersion = 2
+
+# The contents of one UI map file, as plain data.
+# sections is a list of (sectionName, [ (optionName, value), ... ]) as ConfigParser reads them,
+# defaults is the [ (optionName, value), ... ] from its [DEFAULT] section,
+# duplicates is the sections that appeared more than once and need warning about
+class ParsedUIMapFile:
+    def __init__(self, sections, defaults, duplicates, regexSectionNames):
+        self.sections = sections
+        self.defaults = defaults
+        self.duplicates = duplicates
+        self.regexSectionNames = regexSectionNames
+
+    def toData(self):
+        return self.sections, self.defaults, self.duplicates, self.regexSectionNames
+
+    @classmethod
+    def fromData(cls, data):
+        return cls(*data)
+
+
+# Files already loaded or stored by this process are also kept in memory, keyed on the absolute path
+# with their stamp. Mostly useful where processes are forked after loading them, see batch.py
+class UIMapCache:
+    loadedFiles = {}
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    @classmethod
+    def create(cls):
+        # Setting the variable to an empty string turns caching off.
+        # The cache is unpickled, so it is only used if nobody else can write to it
+        cacheDir = privatedir.find("STORYTEXT_UIMAP_CACHE", "uimap_cache")
+        if cacheDir:
+            return cls(cacheDir)
+
+    def getCacheFile(self, fileName):
+        path = os.path.abspath(fileName)
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        key = md5(path).hexdigest()
+        return os.path.join(self.cacheDir, key + ".pickle")
+
+    def getStamp(self, fileName):
+        try:
+            statInfo = os.stat(fileName)
+            return statInfo.st_mtime, statInfo.st_size
+        except OSError:
+            pass
+
+    def getContentHash(self, fileName):
+        try:
+            f = open(fileName, "rb")
+            try:
+                return md5(f.read()).hexdigest()
+            finally:
+                f.close()
+        except IOError:
+            pass
+
+    def getHeader(self, fileName):
+        return formatVersion, os.path.abspath(fileName), encodingutils.getLocaleEncoding()
+
+    def load(self, fileName):
+        stamp = self.getStamp(fileName)
+        if stamp is None:
+            return
+        loadedStamp, parsedFile = self.loadedFiles.get(os.path.abspath(fileName), (None, None))
+        if loadedStamp == stamp:
+            return parsedFile
+        try:
+            f = open(self.getCacheFile(fileName), "rb")
+            try:
+                header, cachedStamp, contentHash, data = pickle.loads(f.read())
+            finally:
+                f.close()
+        except Exception:
+            # Missing, or written by some other version: just parse the file again
+            return
+        if header != self.getHeader(fileName):
+            return
+        if cachedStamp != stamp:
+            # Touched maybe, but possibly not changed
+            if contentHash != self.getContentHash(fileName):
+                return
+            self.writeCacheFile(fileName, stamp, contentHash, data)
+        parsedFile = ParsedUIMapFile.fromData(data)
+        self.loadedFiles[os.path.abspath(fileName)] = stamp, parsedFile
+        return parsedFile
+
+    def store(self, fileName, parsedFile):
+        stamp = self.getStamp(fileName)
+        contentHash = self.getContentHash(fileName)
+        if stamp is not None and contentHash is not None:
+            self.loadedFiles[os.path.abspath(fileName)] = stamp, parsedFile
+            self.writeCacheFile(fileName, stamp, contentHash, parsedFile.toData())
+
+    def writeCacheFile(self, fileName, stamp, contentHash, data):
+        # Write to a temporary file and rename it into place, so that other processes
+        # reading the cache at the same time never see a partially written file
+        cacheFile = self.getCacheFile(fileName)
+        tmpFile = cacheFile + "." + str(os.getpid()) + ".tmp"
+        try:
+            f = open(tmpFile, "wb")
+            try:
+                pickle.dump((self.getHeader(fileName), stamp, contentHash, data), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.pathsep == ";" and os.path.exists(cacheFile): # Windows, can't rename onto an existing file
+                os.remove(cacheFile)
+            os.rename(tmpFile, cacheFile)
+        except (IOError, OSError):
+            # Not being able to cache isn't a problem, it just makes the next startup slower
+            if os.path.exists(tmpFile):
+                try:
+                    os.remove(tmpFile)
+                except OSError:
+                    pass
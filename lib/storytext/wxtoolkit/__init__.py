@@ -373,7 +373,7 @@ class UIMap(storytext.guishared.UIMap):
     
     def monitor(self, widget, *args):
         if widget.widget not in self.windows:
-            self.windows.append(widget.widget)
+            self.windows.add(widget.widget)
             storytext.guishared.UIMap.monitor(self, widget, *args)
             if hasattr(widget, "Bind"):
                 def OnPaint(event):
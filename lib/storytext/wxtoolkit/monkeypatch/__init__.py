@@ -74,3 +74,6 @@ class ProxyWidget(WidgetBase):
     
     def findPossibleUIMapIdentifiers(self):
         return ["Title=" + self.title, "Type=" + self.getType()]
+
+    def getUIMapIdentifiers(self):
+        return self.findPossibleUIMapIdentifiers()
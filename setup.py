@@ -76,7 +76,7 @@ if windows:
             newscripts.append(script + ".exe")
         scripts = newscripts
 
-packages = [ "storytext" ]
+packages = [ "storytext", "storytext.benchmark" ]
 package_data = {}
 sdist = "sdist" in sys.argv
 if jython or sdist:
@@ -0,0 +1,59 @@
+""" Checks that files in directories inotify can't watch are polled instead, and that being called back
+from there can watch further files. Run with "python -m unittest discover tests" from the top directory. """
+
+import os, sys, shutil, tempfile, unittest
+from threading import Thread, Event
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from storytext import filepolling
+
+# Calls back as soon as it's asked to watch, as if the file had already changed
+class ChangedFileWatcher:
+    def watch(self, fileName, callback):
+        callback()
+
+
+class InotifyFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        try:
+            self.watcher = filepolling.InotifyFileWatcher()
+        except (ImportError, OSError, AttributeError):
+            self.watcher = None # Not on Linux, nothing to test
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def watchInThread(self, fileName, callback):
+        thread = Thread(target=self.watcher.watch, args=(fileName, callback))
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(5)
+        return not thread.isAlive()
+
+    def testFileInMissingDirectoryIsPolled(self):
+        if self.watcher is None:
+            return
+        dirName = os.path.join(self.workDir, "missing")
+        fileName = os.path.join(dirName, "file")
+        changed = Event()
+        self.assert_(self.watchInThread(fileName, changed.set))
+        self.assertNotEqual(self.watcher.pollingWatcher, None)
+        os.mkdir(dirName)
+        open(fileName, "w").close()
+        changed.wait(5)
+        self.assert_(changed.isSet())
+
+    def testCallbackFromFallbackCanWatchAgain(self):
+        if self.watcher is None:
+            return
+        self.watcher.pollingWatcher = ChangedFileWatcher()
+        fileName = os.path.join(self.workDir, "missing", "file")
+        otherFileName = os.path.join(self.workDir, "other")
+        def watchOtherFile():
+            self.watcher.watch(otherFileName, lambda: None)
+        self.assert_(self.watchInThread(fileName, watchOtherFile), "deadlocked watching from a callback")
+        self.assertEqual([ f.fileName for f in self.watcher.watchedFiles ], [ otherFileName ])
+
+
+if __name__ == "__main__":
+    unittest.main()
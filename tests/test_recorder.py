@@ -0,0 +1,140 @@
+""" Checks that the recorder's way of splitting "wait for" lines, when part of one completes a shortcut,
+finds the same splits that its original exhaustive search did. That search is kept here to compare with.
+Run with "python -m unittest discover tests" from the top directory. """
+
+import os, sys, random, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from storytext import recorder, replayer
+
+# The original recorder.partitions, copied from stackoverflow. It finds all partitions of a set.
+def partitions(set_):
+    if not set_:
+        yield []
+        return
+    for i in xrange(2**len(set_)/2):
+        parts = [set(), set()]
+        for item in set_:
+            parts[i&1].add(item)
+            i >>= 1
+        for b in partitions(parts[1]):
+            yield [parts[0]]+b
+
+# The original RecordScript.splitLine, which looked at every partition
+def splitLineWithPartitions(line):
+    eventPairs = set()
+    parsedEvents = replayer.parseWaitCommand(line)
+    for part in partitions(parsedEvents):
+        if len(part) == 2:
+            pair = frozenset([ replayer.assembleWaitCommand(part[0]), replayer.assembleWaitCommand(part[1])])
+            eventPairs.add(pair)
+
+    for i, (baseEvent, count) in enumerate(parsedEvents):
+        otherEvents = parsedEvents[:i] + parsedEvents[i+1:]
+        if count > 1:
+            for j in range(1, count):
+                currEvent = [ (baseEvent, j) ]
+                currOthers = otherEvents + [ (baseEvent, count - j)]
+                parts = (replayer.assembleWaitCommand(currEvent), replayer.assembleWaitCommand(currOthers))
+                partSet = frozenset(parts)
+                eventPairs.add(partSet if len(partSet) == 2 else parts)
+    return eventPairs
+
+def makeEvents(generator, repeats=True):
+    # Few names, so that events are sometimes repeated. Some contain '.', which matches anything in shortcuts
+    names = [ "job 1 finished", "job 2 finished", "job.3 finished", "data loaded", "window.shown", "jobs done" ]
+    if repeats:
+        chosen = [ generator.choice(names) for _ in range(generator.randint(1, 6)) ]
+    else:
+        chosen = generator.sample(names, generator.randint(1, 6))
+    return [ (name, generator.randint(1, 3)) for name in chosen ]
+
+def makeLine(events):
+    return replayer.assembleWaitCommand(events)
+
+def makeShortcutCommand(generator, events):
+    # Usually some of the line's events, sometimes with part of their count, sometimes something else
+    choice = generator.random()
+    if choice < 0.15:
+        return makeLine(makeEvents(generator))
+    part = [ (name, generator.randint(1, count)) for name, count in generator.sample(events, generator.randint(1, len(events))) ]
+    if choice < 0.3:
+        # Matches events with a different character in the same place
+        name, count = part[0]
+        pos = generator.randrange(len(name))
+        part[0] = name[:pos] + "." + name[pos + 1:], count
+    return makeLine(part)
+
+
+class SplitLineTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = random.Random(42)
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def makeRecordScript(self, shortcutCommands):
+        shortcuts = []
+        for command in shortcutCommands:
+            # New names each time, as the parsed script cache remembers files by name
+            fileName = os.path.join(self.workDir, "shortcut_" + str(len(os.listdir(self.workDir))) + ".usecase")
+            f = open(fileName, "w")
+            f.write("start jobs\n" + command + "\n")
+            f.close()
+            shortcuts.append(replayer.ReplayScript(fileName))
+        script = recorder.RecordScript(os.path.join(self.workDir, "recorded.usecase"), shortcuts)
+        script.record("start jobs")
+        return script
+
+    def findCompletions(self, script, eventPairs):
+        # Everything findPartLineCompleting could choose, which depends on the order of the pairs
+        completions = set()
+        for eventPair in eventPairs:
+            partLine1, partLine2 = (tuple(eventPair) * 2)[:2] # Both parts are the same if the events are repeated
+            for partLine, otherPartLine in [ (partLine1, partLine2), (partLine2, partLine1) ]:
+                partTracker = script.findCompletedTracker(partLine)
+                if partTracker:
+                    completions.add((partLine, partTracker, otherPartLine))
+        return completions
+
+    def countEvents(self, *lines):
+        counts = {}
+        for line in lines:
+            for baseEvent, count in replayer.parseWaitCommand(line):
+                counts[baseEvent] = counts.get(baseEvent, 0) + count
+        return counts
+
+    def checkFindPossibleSplits(self, repeats):
+        for _ in range(300):
+            events = makeEvents(self.generator, repeats)
+            line = makeLine(events)
+            shortcutCommands = [ makeShortcutCommand(self.generator, events) for _ in range(self.generator.randint(1, 3)) ]
+            script = self.makeRecordScript(shortcutCommands)
+            if not script.isSplittable(line):
+                continue
+            expected = self.findCompletions(script, splitLineWithPartitions(line))
+            partLine, partTracker, otherPartLine = script.findPartLineCompleting(script.findPossibleSplits(line))
+            message = line + " with shortcuts " + repr(shortcutCommands)
+            if not repeats:
+                if expected:
+                    self.assert_((partLine, partTracker, otherPartLine) in expected, message)
+                else:
+                    self.assertEqual(partLine, None, message)
+            else:
+                # The exhaustive search used sets, so lost repeated events: it can't find everything here
+                if expected:
+                    self.assertNotEqual(partLine, None, message)
+                if partLine is not None:
+                    self.assertEqual(self.countEvents(partLine, otherPartLine), self.countEvents(line), message)
+            script.close()
+
+    def testFindPossibleSplitsCompletesShortcutsAsBefore(self):
+        # The recorder counts repeated events, so lines it splits don't usually have them
+        self.checkFindPossibleSplits(repeats=False)
+
+    def testFindPossibleSplitsWithRepeatedEvents(self):
+        self.checkFindPossibleSplits(repeats=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
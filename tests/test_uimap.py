@@ -0,0 +1,69 @@
+""" Checks that finding the UI map entries a command refers to sees the values ConfigParser gives,
+including those from [DEFAULT] and those referring to other values.
+Run with "python -m unittest discover tests" from the top directory. """
+
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from storytext import guishared
+
+class UIMapValueTest(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.origCacheDir = os.getenv("STORYTEXT_UIMAP_CACHE")
+        os.environ["STORYTEXT_UIMAP_CACHE"] = ""
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+        if self.origCacheDir is None:
+            del os.environ["STORYTEXT_UIMAP_CACHE"]
+        else:
+            os.environ["STORYTEXT_UIMAP_CACHE"] = self.origCacheDir
+
+    def makeFileHandler(self, *texts):
+        fileNames = []
+        for i, text in enumerate(texts):
+            fileName = os.path.join(self.workDir, "ui_map" + str(i) + ".conf")
+            f = open(fileName, "w")
+            f.write(text)
+            f.close()
+            fileNames.append(fileName)
+        return guishared.UIMapFileHandler(fileNames)
+
+    def testPlainValues(self):
+        handler = self.makeFileHandler("[Name=ok]\nClicked = press ok\n\n[Name=text]\nModified = enter text\n")
+        self.assertEqual(handler.findSectionsAndOptions("press ok"), [ ("Name=ok", "Clicked") ])
+        self.assertEqual(handler.splitOptionValue("enter text = hello"), ("enter text", "= hello"))
+
+    def testValuesFromDefault(self):
+        handler = self.makeFileHandler("[DEFAULT]\nClosed = close window\n\n[Name=ok]\nClicked = press ok\n\n" + \
+                                       "[Name=dialog]\nClicked = press dialog\n")
+        self.assertEqual(handler.findSectionsAndOptions("close window"), [ ("Name=ok", "Closed"), ("Name=dialog", "Closed") ])
+        self.assertEqual(handler.findSectionsAndOptions("press dialog"), [ ("Name=dialog", "Clicked") ])
+        self.assertEqual(handler.splitOptionValue("close window now"), ("close window", "now"))
+
+    def testValuesFromDefaultInOneOfSeveralFiles(self):
+        handler = self.makeFileHandler("[DEFAULT]\nClosed = close window\n\n[Name=ok]\nClicked = press ok\n",
+                                       "[Name=dialog]\nClicked = press dialog\n")
+        self.assertEqual(handler.findSectionsAndOptions("close window"), [ ("Name=ok", "Closed"), ("Name=dialog", "Closed") ])
+
+    def testValuesFromDefaultWhenCached(self):
+        os.environ["STORYTEXT_UIMAP_CACHE"] = os.path.join(self.workDir, "cache")
+        text = "[DEFAULT]\nClosed = close window\n\n[Name=ok]\nClicked = press ok\n"
+        self.makeFileHandler(text)
+        handler = self.makeFileHandler(text)
+        self.assertEqual(handler.findSectionsAndOptions("close window"), [ ("Name=ok", "Closed") ])
+
+    def testInterpolatedValues(self):
+        handler = self.makeFileHandler("[Name=ok]\nname = ok\nClicked = press %(name)s\n")
+        self.assertEqual(handler.findSectionsAndOptions("press ok"), [ ("Name=ok", "Clicked") ])
+        self.assertEqual(handler.findSectionsAndOptions("press %(name)s"), [])
+        self.assertEqual(handler.splitOptionValue("press ok = 1"), ("press ok", "= 1"))
+
+    def testValuesInterpolatedAfterUpdate(self):
+        handler = self.makeFileHandler("[Name=ok]\nname = ok\nClicked = press ok\n")
+        handler.updateOptionValue("Name=ok", "Clicked", "press %(name)s button")
+        self.assertEqual(handler.findSectionsAndOptions("press ok button"), [ ("Name=ok", "Clicked") ])
+
+
+if __name__ == "__main__":
+    unittest.main()